@@ -1,6 +1,7 @@
 __all__=[
     "autopyscf",
     "average_tools",
+    "basislibrary",
     "bundler",
     "cifparser",
     "crystal2pyscf",
@@ -13,10 +14,14 @@ __all__=[
     "postprocess",
     "propertiesreader",
     "pyscf2qwalk",
+    "qwalklog",
     "qwalkrunner",
     "runner",
     "paths",
+    "statestore",
     "submitter",
+    "taskfarm",
     "trialfunc",
     "variance",
+    "workflow",
   ]
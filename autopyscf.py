@@ -150,7 +150,7 @@ class PySCFWriter:
 
 ####################################################
 
-from xml.etree.ElementTree import ElementTree
+import basislibrary
 
 def generate_pbc_basis(xml_name,symbol,min_exp=0.2,naug=2,alpha=3,
                        cutoff=0.2,basis_name='vtz',
@@ -159,26 +159,18 @@ def generate_pbc_basis(xml_name,symbol,min_exp=0.2,naug=2,alpha=3,
   transition_metals=["Sc","Ti","V","Cr","Mn","Fe","Co","Ni","Cu","Zn"]
   if symbol in transition_metals:
     nangular['s']=min(nangular['s'],2)
-  tree = ElementTree()
-  tree.parse(xml_name)
-  element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-  basis_path = './Basis-set[@name="{}"]/Contraction'.format(basis_name)
   allbasis=[]
 
   # add in the first nangular basis functions.
   found_orbitals = []  
-  for contraction in element.findall(basis_path):
-    angular = contraction.get('Angular_momentum')
+  for contraction in basislibrary.basis_contractions(xml_name,symbol,basis_name):
+    angular = contraction['angular']
     if found_orbitals.count(angular) >= nangular[angular]:
       continue
-    nterms = 0
+    keep = contraction['exp'] > cutoff
+    nterms = int(keep.sum())
     basis_sec=symbol+" " + angular +"\n"
-    for basis_term in contraction.findall('./Basis-term'):
-      exp = basis_term.get('Exp')
-      coeff = basis_term.get('Coeff')
-      if float(exp) > cutoff:
-        basis_sec += '  {} {} \n'.format(exp, coeff)
-        nterms+=1
+    basis_sec+=''.join(['  {} {} \n'.format(exp, coeff) for (exp,coeff),k in zip(contraction['text'],keep) if k])
     if nterms > 0:
       allbasis.append(basis_sec)
       found_orbitals.append(angular)
@@ -1,14 +1,184 @@
 from __future__ import print_function
 import os
+import re
 import sys
+import json
+import socket
 import numpy as np
 import subprocess as sub
 import shutil
+import signal
+import threading
+import time
 import submitter
 
+####################################################
+class LocalPool:
+  ''' Runs jobs from local runners concurrently, packing them onto the free cores of this machine.
+  Each job is a list of lines run in order in its directory; a job starts once enough cores are free.
+  Output is streamed to a file rather than kept in memory.
+  The state and exit codes of a job can also be kept in a status file, so they can be looked up by a later
+  process (e.g. the next run of a driver) with read_status.'''
+  def __init__(self,ncores=None):
+    '''
+    Args:
+      ncores (int): number of cores that can be used at once (default: all cores on the machine).
+    '''
+    if ncores is None: ncores=os.cpu_count()
+    self.ncores=ncores
+    self.free=ncores
+    self.jobs={}
+    self.cond=threading.Condition()
+
+  #-------------------------------------
+  def submit(self,jobid,lines,ncores,loc,outfn,statusfn=None):
+    ''' Start a job as soon as `ncores` cores are free. Returns immediately.
+    Args:
+      jobid (str): identifier used to look up the job later.
+      lines (list): shell commands, run in order. Stops at the first failure.
+      ncores (int): cores the job occupies (capped at the size of the pool).
+      loc (str): directory the commands run in.
+      outfn (str): file where stdout and stderr of all commands go.
+      statusfn (str): file where the state of the job is kept (see read_status).
+    '''
+    ncores=min(ncores,self.ncores)
+    job={'jobid':jobid,'lines':lines,'ncores':ncores,'exitcodes':[],'state':'queued','proc':None,'statusfn':statusfn}
+    with self.cond:
+      self.jobs[jobid]=job
+      self._record(job)
+    worker=threading.Thread(target=self._run,args=(job,loc,outfn))
+    worker.start()
+
+  #-------------------------------------
+  def _run(self,job,loc,outfn):
+    with self.cond:
+      while self.free < job['ncores'] and job['state']!='cancelled':
+        self.cond.wait()
+      if job['state']=='cancelled':
+        return
+      self.free-=job['ncores']
+      job['state']='running'
+      self._record(job)
+    try:
+      with open(outfn,'a') as outf:
+        for line in job['lines']:
+          with self.cond:
+            if job['state']=='cancelled': break
+            # Own process group, so cancel stops the whole command (e.g. mpirun and its ranks).
+            job['proc']=sub.Popen(line,shell=True,cwd=loc,stdout=outf,stderr=sub.STDOUT,start_new_session=True)
+            self._record(job)
+          job['exitcodes'].append(job['proc'].wait())
+          if job['exitcodes'][-1]!=0: break
+    finally:
+      with self.cond:
+        self.free+=job['ncores']
+        if job['state']!='cancelled':
+          job['state']='done' if all([c==0 for c in job['exitcodes']]) else 'failed'
+        self._record(job)
+        self.cond.notify_all()
+
+  #-------------------------------------
+  def _record(self,job):
+    ''' Write the state of job to its status file. Call with the lock held.'''
+    if job['statusfn'] is None:
+      return
+    pid=job['proc'].pid if job['proc'] is not None and job['state']=='running' else None
+    record={'jobid':job['jobid'],'state':job['state'],'exitcodes':job['exitcodes'],
+        'owner':os.getpid(),'pid':pid,'host':socket.gethostname()}
+    with open(job['statusfn']+'.tmp','w') as outf:
+      json.dump(record,outf)
+    os.replace(job['statusfn']+'.tmp',job['statusfn'])
+
+  #-------------------------------------
+  def status(self,jobid,statusfn=None):
+    ''' 'queued', 'running', 'done', 'failed', 'cancelled' or 'unknown' (not run by this pool and no status file).
+    Jobs not run by this pool are looked up in statusfn (see read_status).'''
+    if jobid not in self.jobs:
+      return read_status(statusfn,jobid)['state']
+    return self.jobs[jobid]['state']
+
+  #-------------------------------------
+  def exitcodes(self,jobid,statusfn=None):
+    ''' Exit codes of the commands of a job that have finished so far.'''
+    if jobid not in self.jobs:
+      return read_status(statusfn,jobid)['exitcodes']
+    return list(self.jobs[jobid]['exitcodes'])
+
+  #-------------------------------------
+  def cancel(self,jobid):
+    ''' Stop a job: it won't start if queued, and the running command is terminated.'''
+    with self.cond:
+      job=self.jobs.get(jobid)
+      if job is None or job['state'] not in ('queued','running'):
+        return
+      job['state']='cancelled'
+      if job['proc'] is not None and job['proc'].poll() is None:
+        os.killpg(job['proc'].pid,signal.SIGTERM)
+      self.cond.notify_all()
+
+  #-------------------------------------
+  def wait(self):
+    ''' Block until all jobs are finished.'''
+    with self.cond:
+      while any([job['state'] in ('queued','running') for job in self.jobs.values()]):
+        self.cond.wait()
+
+# Shared by all local runners in this process.
+local_pool=LocalPool()
+
+####################################################
+def _alive(pid):
+  if pid is None:
+    return False
+  try:
+    os.kill(pid,0)
+  except OSError:
+    return False
+  return True
+
+def read_status(statusfn,jobid):
+  ''' State of a job run by a LocalPool of another process, from its status file.
+  A job recorded as queued or running is 'failed' if neither the process that ran it (the driver) nor its 
+  current command is still alive.
+  Args:
+    statusfn (str): status file given to LocalPool.submit. 
+    jobid (str): job that should be recorded there.
+  Returns:
+    dict: 'state' ('unknown' if the file is missing or is about another job) and 'exitcodes'.
+  '''
+  if statusfn is None or not os.path.exists(statusfn):
+    return {'state':'unknown','exitcodes':[]}
+  with open(statusfn,'r') as inpf:
+    record=json.load(inpf)
+  if record['jobid']!=jobid:
+    return {'state':'unknown','exitcodes':[]}
+  if record['state'] in ('queued','running') and record['host']==socket.gethostname():
+    if not any([_alive(pid) for pid in (record['owner'],record['pid'])]):
+      record['state']='failed'
+  return record
+
+####################################################
+def walltime_seconds(walltime):
+  ''' Convert a walltime string like '48:00:00' (or '30:00', '120') to seconds. None if walltime is None.'''
+  if walltime is None:
+    return None
+  seconds=0
+  for field in str(walltime).split(':'):
+    seconds=seconds*60+int(field)
+  return seconds
+
+####################################################
+def _statusfn(jobid):
+  ''' Status file of a RunnerLocal job ([jobname].local.status next to its output). None for older job ids.'''
+  base=jobid.rsplit('@',1)[0]
+  if not os.path.isabs(base):
+    return None
+  return base+'.local.status'
+
 ####################################################
 class RunnerLocal:
-  ''' Object that can accumulate jobs to run and run them together locally.'''
+  ''' Object that can accumulate jobs to run and run them together locally.
+  Jobs from different runners run concurrently, packed onto the cores of the machine (see LocalPool).'''
   def __init__(self,np='allprocs',nn=1):
     ''' Note: exelines are prefixed by appropriate mpirun commands.'''
 
@@ -16,10 +186,31 @@ class RunnerLocal:
     self.np=np
     self.nn=nn
     self.jobname='none, this runs with out queueing.'
+    self.queueid=[]
+    self.exitcodes=[]
 
   #-------------------------------------
   def check_status(self):
-    return 'done'
+    ''' Returns 'running' while any of the jobs is queued or running in the local pool (a manager may have
+    several concurrent jobs), otherwise the status of the last job.
+    Exit codes of its commands are stored in self.exitcodes.'''
+    if len(self.queueid)==0:
+      return 'done'
+    if any([local_pool.status(qid,_statusfn(qid)) in ('queued','running') for qid in self.queueid]):
+      return 'running'
+    status=local_pool.status(self.queueid[-1],_statusfn(self.queueid[-1]))
+    self.exitcodes=local_pool.exitcodes(self.queueid[-1],_statusfn(self.queueid[-1]))
+    if status in ('queued','running'):
+      return 'running'
+    if status=='failed':
+      print(self.__class__.__name__,": job %s failed with exit codes %s"%(self.queueid[-1],self.exitcodes))
+    return status
+
+  #-------------------------------------
+  def cancel(self):
+    ''' Stop the jobs of this runner that are queued or running.'''
+    for qid in self.queueid:
+      local_pool.cancel(qid)
 
   #-------------------------------------
   def add_task(self,exestr):
@@ -42,25 +233,75 @@ class RunnerLocal:
     self.exelines.append(cmdstr)
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,loc=None):
+    ''' Start the series of commands in the local pool and return without waiting.
+    Output is written to [jobname].local.out.
+    Args:
+      jobname (str): name of the job.
+      loc (str): directory where the commands are run (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
+    if loc is None:
+      loc=os.getcwd()
 
     if len(self.exelines)==0:
       return ''
-    
-    try:
-      for line in self.exelines:
-        result = sub.check_output(line,shell=True)
-        print(self.__class__.__name__,": executed %s"%line)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error: {0}".format(err))
+
+    if self.np=='allprocs':
+      ncores=local_pool.ncores
+    else:
+      ncores=self.nn*self.np
+
+    # The job id names its directory, so the status file can be found from it after a restart.
+    jobid="%s@%s"%(os.path.join(os.path.abspath(loc),jobname),time.time())
+    outfn=os.path.join(os.path.abspath(loc),jobname+'.local.out')
+    local_pool.submit(jobid,self.exelines,ncores,os.path.abspath(loc),outfn,_statusfn(jobid))
+    self.queueid.append(jobid)
+    print(self.__class__.__name__,": started %s on %d cores (output in %s)"%(jobname,ncores,outfn))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return ''
 
+####################################################
+def scratch_lines(loc,scratch,outputs):
+  ''' Shell lines moving a job into node-local scratch, and bringing its outputs back when it exits.
+
+  Every file of loc is linked into the scratch directory, so inputs are read from where they are; outputs that
+  already exist (e.g. logs that are appended to) are copied instead. When the job exits, including when it is 
+  killed at the walltime (SIGTERM), the outputs written in scratch are copied back to loc (each to a temporary name, 
+  then renamed into place) and scratch is removed.
+  The queue's delay between SIGTERM and SIGKILL (kill_delay) has to leave time for the copy.
+  Files not matching outputs are left behind.
+  Args:
+    loc (str): directory of the job.
+    scratch (str): node-local directory to run in, e.g. '$TMPDIR'. May use shell variables.
+    outputs (list): file names or shell patterns, relative to loc, to copy back.
+  Returns:
+    list: lines for the job script, to run after `cd loc` and before the commands.
+  '''
+  pats=' '.join(outputs)
+  return [
+      "scratch=%s/job.${PBS_JOBID:-$$}"%scratch,
+      "mkdir -p $scratch",
+      "for f in %s/*; do [ -f \"$f\" ] && ln -s \"$f\" $scratch/; done"%loc,
+      "for f in %s; do [ -f \"$f\" ] && cp -p --remove-destination \"$f\" $scratch/; done"%pats,
+      # Copied next to the destination and renamed over it, so the old file is never left half written.
+      "stageout() { cd $scratch; for f in %s; do [ -f \"$f\" ] && [ ! -L \"$f\" ] && "
+      "cp -p \"$f\" \"%s/$f.stage$$\" && mv -f \"%s/$f.stage$$\" \"%s/$f\"; done; cd %s; rm -rf $scratch; }"%(pats,loc,loc,loc,loc),
+      "trap stageout EXIT",
+      "trap 'exit 143' TERM",
+      "cd $scratch",
+    ]
+
+####################################################
+def depend_header(depends):
+  ''' PBS lines making a job wait for the jobs in depends to finish successfully.'''
+  if len(depends)==0:
+    return []
+  return ["#PBS -W depend=afterok:%s"%':'.join(depends)]
+
 ####################################################
 class RunnerPBS:
   ''' Object that can accumulate jobs to run and run them together in one submission. '''
@@ -69,9 +310,14 @@ class RunnerPBS:
                     jobname='AGRunner',
                     np='allprocs',nn=1,
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    scratch=None
                     ):
-    ''' Note: exelines are prefixed by appropriate mpirun commands.'''
+    ''' Note: exelines are prefixed by appropriate mpirun commands.
+    scratch (str): node-local directory (e.g. '$TMPDIR') to run the jobs in, instead of their directory on the 
+      shared file system. Only the outputs declared with stage() are copied back (see scratch_lines).
+      The scratch directory is only on the first node, so this is for single-node jobs (nn=1).
+    '''
 
     # Good prefix choices (Blue Waters).
     # These are needed for Crystal runs.
@@ -91,11 +337,31 @@ class RunnerPBS:
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
     self.queueid=[]
+    self.depends=[] # Queue ids the next submission waits for (afterok).
+    self.scratch=scratch
+    self.outputs=[] # Files copied back from scratch.
+    if scratch is not None and nn>1:
+      raise AssertionError("RunnerPBS: scratch is node-local, so only the first of %d nodes would see it; use nn=1."%nn)
 
   #-------------------------------------
   def check_status(self):
     return submitter.check_PBS_stati(self.queueid)
 
+  #-------------------------------------
+  def stage(self,outputs):
+    ''' Declare outputs of the jobs, to be copied back if they are run in scratch.
+    Args:
+      outputs (list): file names or shell patterns, relative to the job directory.
+    '''
+    self.outputs+=[out for out in outputs if out not in self.outputs]
+
+  #-------------------------------------
+  def cancel(self):
+    ''' Delete the jobs of this runner that are still queued or running.'''
+    deleted=submitter.cancel_jobs(self.queueid)
+    if len(deleted)>0:
+      print(self.__class__.__name__,": deleted %s"%deleted)
+
   #-------------------------------------
   def add_command(self,cmdstr):
     ''' Accumulate commands that don't get an MPI command.
@@ -124,10 +390,17 @@ class RunnerPBS:
       self.exelines.append("mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,loc=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name of the job in the queue.
+      loc (str): directory where the job is run and the qsub file is written (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
+    if loc is None:
+      loc=os.getcwd()
+    loc=os.path.abspath(loc)
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -138,6 +411,12 @@ class RunnerPBS:
     else:
       ppnstr=':ppn=%d'%self.np
 
+    staging=[]
+    if self.scratch is not None:
+      if self.nn>1:
+        raise AssertionError("%s: %d nodes, but %s is only on the first."%(self.__class__.__name__,self.nn,self.scratch))
+      staging=["#PBS -S /bin/bash"]+scratch_lines(loc,self.scratch,self.outputs)
+
     jobout=jobname+'.qsub.out'
     # Submit all jobs.
     qsub=[
@@ -147,20 +426,23 @@ class RunnerPBS:
         "#PBS -j oe ",
         "#PBS -N %s "%jobname,
         "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
-      ] + self.prefix + self.exelines + self.postfix
-    qsubfile=jobname+".qsub"
+      ] + depend_header(self.depends) + staging[:1] + [
+        "cd %s"%loc,
+      ] + staging[1:] + self.prefix + self.exelines + self.postfix
+    qsubfile=os.path.join(loc,jobname+".qsub")
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsub))
     try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
+      result = sub.check_output("qsub %s"%(qsubfile),shell=True,cwd=loc)
       self.queueid.append(result.decode().split()[0].split('.')[0])
+      submitter.clear_status_cache()
       print(self.__class__.__name__,": Submitted as %s"%self.queueid)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
+    self.depends=[]
     return qsubfile
 
 ####################################################
@@ -173,9 +455,15 @@ class RunnerBW:
                     jobname='AGRunner',
                     np=32,nn=1,
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    scratch=None
                     ):
-    ''' Note: exelines are prefixed by appropriate aprun commands.'''
+    ''' Note: exelines are prefixed by appropriate aprun commands.
+    scratch: not supported. The job script runs on a service (MOM) node, which doesn't share local disk with the
+      compute nodes aprun starts the programs on, so it can't stage files into their scratch.
+    '''
+    if scratch is not None:
+      raise NotImplementedError("RunnerBW: node-local scratch staging isn't supported (see RunnerPBS for it).")
 
     # Good prefix choices (Blue Waters).
     # These are needed for Crystal runs.
@@ -197,11 +485,19 @@ class RunnerBW:
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
     self.queueid=[]
+    self.depends=[] # Queue ids the next submission waits for (afterok).
 
   #-------------------------------------
   def check_status(self):
     return submitter.check_BW_stati(self.queueid)
 
+  #-------------------------------------
+  def cancel(self):
+    ''' Delete the jobs of this runner that are still queued or running.'''
+    deleted=submitter.cancel_jobs(self.queueid)
+    if len(deleted)>0:
+      print(self.__class__.__name__,": deleted %s"%deleted)
+
   def add_command(self,cmdstr):
     ''' Accumulate commands that don't get an MPI command.
     Args: 
@@ -229,10 +525,17 @@ class RunnerBW:
     return ret
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,loc=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name of the job in the queue.
+      loc (str): directory where the job is run and the qsub file is written (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
+    if loc is None:
+      loc=os.getcwd()
+    loc=os.path.abspath(loc)
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -248,20 +551,23 @@ class RunnerBW:
         "#PBS -j oe ",
         "#PBS -N %s "%jobname,
         "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
+      ] + depend_header(self.depends) + [
+        "cd %s"%loc,
       ] + self.prefix + self.exelines + self.postfix
-    qsubfile=jobname+".qsub"
+    qsubfile=os.path.join(loc,jobname+".qsub")
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsub))
     try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
+      result = sub.check_output("qsub %s"%(qsubfile),shell=True,cwd=loc)
       self.queueid.append(result.decode().split()[0].split('.')[0])
+      submitter.clear_status_cache()
       print(self.__class__.__name__,": Submitted as %s"%self.queueid)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
+    self.depends=[]
     return qsubfile
 
 ####################################################
@@ -283,6 +589,10 @@ class FakeRunner:
   def check_status(self):
     return 'unknown'
 
+  #-------------------------------------
+  def cancel(self):
+    pass
+
   def add_command(self,cmdstr):
     pass
 
@@ -295,7 +605,7 @@ class FakeRunner:
     return False
 
   #-------------------------------------
-  def submit(self,jobname=None):
+  def submit(self,jobname=None,loc=None):
     ''' Submit series of commands.'''
     return ''
 
@@ -335,9 +645,12 @@ class PySCFRunnerLocal:
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,loc=None):
     ''' Submit series of commands.
-    Note: jobname is not used because it doesn't submit anything.'''
+    Note: jobname is not used because it doesn't submit anything.
+    Args:
+      loc (str): directory where the commands are run (default: current directory).
+    '''
     sys.path=ppath+sys.path
 
     if len(self.exelines)==0:
@@ -346,7 +659,7 @@ class PySCFRunnerLocal:
 
     try:
       for line in self.exelines:
-        result = sub.check_output(line,shell=True)
+        result = sub.check_output(line,shell=True,cwd=loc)
         print(self.__class__.__name__,": executed %s"%line)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error: {0}".format(err))
@@ -410,15 +723,17 @@ class PySCFRunnerPBS(RunnerPBS):
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,loc=None):
     ''' Submit any accumulated tasks.
 
     Args:
       jobname (str): name to appear in the queue.
       ppath (list): python path needed for the run (default: current path).
+      loc (str): directory where the job is run and the qsub file is written (default: current directory).
     '''
       
     if ppath is None: ppath=sys.path
+    if loc is None: loc=os.getcwd()
 
     if len(self.exelines)==0: 
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -447,12 +762,13 @@ class PySCFRunnerPBS(RunnerPBS):
          "export PYTHONPATH=%s"%(':'.join(ppath)),
          "cwd=`pwd`"
        ] + self.prefix + self.exelines + self.postfix
-    qsubfile=jobname+".qsub"
+    qsubfile=os.path.join(loc,jobname+".qsub")
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsublines))
     try: 
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
+      result = sub.check_output("qsub %s"%(qsubfile),shell=True,cwd=loc)
       self.queueid.append(result.decode().split()[0].split('.')[0])
+      submitter.clear_status_cache()
       print(self.__class__.__name__,": Submitted as %s"%self.queueid)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
@@ -460,5 +776,129 @@ class PySCFRunnerPBS(RunnerPBS):
     # Clear out the lines to set up for the next job.
     self.exelines=[]
 
-# TODO Specialize a runner for running QWalk jobs in the same directory together. 
-# Should just have to specialize the run command.
+####################################################
+_redirect=re.compile(r'\s*(?:&>|2?>>?)\s*\S+')
+
+def mpmd_line(launcher,tasks):
+  ''' One MPMD launch running several programs side by side, like `mpirun -n 4 qwalk a : -n 8 qwalk b`.
+  Shell redirections are dropped from the commands, since they would apply to the whole launch;
+  QWalk still writes its own .o and .log files, and the rest goes to the job output.
+  Args:
+    launcher (str): 'mpirun' or 'aprun'.
+    tasks (list): (ranks, command, directory) for each program. directory is passed to mpirun as -wdir, and 
+      must be None for aprun.
+  Returns:
+    str: command line.
+  '''
+  parts=[]
+  for ranks,cmd,wdir in tasks:
+    part="-n %d "%ranks
+    if wdir is not None:
+      if launcher!='mpirun':
+        raise AssertionError("mpmd_line: %s can't set the directory of each program."%launcher)
+      part+="-wdir %s "%wdir
+    parts.append(part+_redirect.sub('',cmd))
+  return launcher+' '+' : '.join(parts)
+
+####################################################
+class RunnerMPMD(RunnerPBS):
+  ''' RunnerPBS that runs consecutive tasks together as one MPMD mpirun launch, instead of one after another.
+  Meant for several small QWalk runs in the same directory (e.g. the runs of QWalkManager.plan_restart): they 
+  share one allocation and one MPI startup. The job asks for enough nodes for the largest launch.
+  Commands from add_command run between launches, so a task that must wait for one still does.
+  '''
+  launcher='mpirun'
+  mpmd=True
+
+  def __init__(self,*args,**kwargs):
+    ''' Takes the arguments of RunnerPBS; np must be a number of cores per node.'''
+    RunnerPBS.__init__(self,*args,**kwargs)
+    if self.np=='allprocs':
+      raise AssertionError("%s needs np set to the cores per node to size the launches."%self.__class__.__name__)
+    self.tasks=[] # (ranks, command) waiting to be merged.
+    self.width=0  # Ranks of the largest launch of the next submission.
+
+  #-------------------------------------
+  def add_task(self,exestr,ranks=None):
+    ''' Accumulate executable commands to be launched together.
+    Args: 
+      exestr (str): executible statement. 
+      ranks (int): MPI ranks for this task. Default: nn*np.
+    '''
+    if ranks is None: ranks=self.nn*self.np
+    self.tasks.append((ranks,exestr))
+
+  #-------------------------------------
+  def _merge(self):
+    ''' Turn the waiting tasks into one launch line.'''
+    if len(self.tasks)==0:
+      return
+    ranks=sum([r for r,cmd in self.tasks])
+    if len(self.tasks)==1:
+      self.exelines.append("%s -n %d %s"%(self.launcher,ranks,self.tasks[0][1]))
+    else:
+      self.exelines.append(mpmd_line(self.launcher,[(r,cmd,None) for r,cmd in self.tasks]))
+    self.width=max(self.width,ranks)
+    self.tasks=[]
+
+  #-------------------------------------
+  def add_command(self,cmdstr):
+    self._merge()
+    self.exelines.append(cmdstr)
+
+  #-------------------------------------
+  def release_commands(self):
+    self._merge()
+    self.width=0
+    return RunnerPBS.release_commands(self)
+
+  #-------------------------------------
+  def submit(self,jobname=None,loc=None):
+    ''' Submit the accumulated commands, with the tasks merged. See RunnerPBS.submit.'''
+    self._merge()
+    nn=self.nn
+    self.nn=max(nn,-(-self.width//self.np))
+    try:
+      return RunnerPBS.submit(self,jobname,loc)
+    finally:
+      self.nn=nn
+      self.width=0
+
+####################################################
+class RunnerBWMPMD(RunnerBW):
+  ''' RunnerBW that runs consecutive tasks together as one MPMD aprun launch (see RunnerMPMD).
+  aprun starts every program in the job directory, so the tasks must be run from there.'''
+  launcher='aprun'
+  mpmd=True
+
+  def __init__(self,*args,**kwargs):
+    ''' Takes the arguments of RunnerBW.'''
+    RunnerBW.__init__(self,*args,**kwargs)
+    self.tasks=[]
+    self.width=0
+
+  add_task=RunnerMPMD.add_task
+  _merge=RunnerMPMD._merge
+
+  #-------------------------------------
+  def add_command(self,cmdstr):
+    self._merge()
+    self.exelines.append(cmdstr)
+
+  #-------------------------------------
+  def release_commands(self):
+    self._merge()
+    self.width=0
+    return RunnerBW.release_commands(self)
+
+  #-------------------------------------
+  def submit(self,jobname=None,loc=None):
+    ''' Submit the accumulated commands, with the tasks merged. See RunnerBW.submit.'''
+    self._merge()
+    nn=self.nn
+    self.nn=max(nn,-(-self.width//self.np))
+    try:
+      return RunnerBW.submit(self,jobname,loc)
+    finally:
+      self.nn=nn
+      self.width=0
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 ''' Simple utilities for interacting with autogen runs.'''
 
-import pickle as pkl
 import sys
 import argparse
+import statestore
+from manager_tools import load_state, save_state
 
 def get_info(pickle):
   print("Info about %s..."%pickle)
-  man=pkl.load(open(pickle,'rb'))
+  man=load_state(pickle)
 
   print("  Queue id: {}".format(man.runner.queueid))
   try:
@@ -23,16 +24,19 @@ def set_attribute(pickle,attr,val):
     val: value of attribute to set.
   '''
   print("Setting %s in %s..."%(attr,pickle))
-  man=pkl.load(open(pickle,'rb'))
+  man=load_state(pickle)
   man.__dict__[attr]=val
-  pkl.dump(man,open(pickle,'wb'))
+  save_state(pickle,man)
 
 if __name__=='__main__':
 
   parser=argparse.ArgumentParser("Autogen untilities.")
   parser.add_argument('manager',type=str,help='Pickle file to look at.')
+  parser.add_argument('--store',type=str,default=None,help='State database, if the project uses one (see statestore.py).')
   # Can add more options as needed.
 
   args=parser.parse_args()
+  if args.store is not None:
+    statestore.use_store(args.store)
   get_info(args.manager)
   
@@ -1,3 +1,7 @@
+import numpy as np
+import threading
+from manager_tools import load_state, save_state, state_exists
+
 
 
 ################################################
@@ -43,10 +47,15 @@ def check_opts(opts):
       Make sure all of %s are set."""%(key,', '.join(check))
 
 ################################################
-def kaverage(name,data):
-  ''' kaverage the data for each property.'''
+def kaverage(name,data,weights=None):
+  ''' kaverage the data for each property.
+  Args:
+    name (str): average generator name.
+    data (list): results for each k-point.
+    weights (list): weight of each k-point, e.g. eigsys['kpt_weights'] from crystal2qmc.read_kred. Default: uniform.
+  '''
   if name=='average_derivative_dm':
-    return _kaverage_deriv(data)
+    return _kaverage_deriv(data,weights)
   elif name=='region_fluctuation':
     return [] # TODO
   else:
@@ -55,77 +64,175 @@ def kaverage(name,data):
     You should implement it, it should be easy!"""%name)
 
 ################################################
-def _kaverage_tbdm(data):
-  nkpt=len(data)
-  nstates=len(data[0]['states'])
-  res={'obdm':{},'tbdm':{}}
+_obdm_keys=['up','down']
+_tbdm_keys=['upup','updown','downup','downdown']
 
-  # Wait, do we need this? This is already in tbdm, no?
-  for key in ['up','down']:
-    res['obdm'][key]=[
-        [
-          sum([
-            data[i]['obdm'][key][k][l]
-            for i in range(nkpt)
-          ])/nkpt 
-          for l in range(nstates)
-        ] 
-        for k in range(nstates)
-      ] 
-
-  for key in ['upup','updown','downup','downdown']:
-    res['tbdm'][key]=[
-        [
-          [
-            [
-              sum([
-                data[i]['tbdm'][key][k][l][m][n]
-                for i in range(nkpt)
-              ])/nkpt 
-              for n in range(nstates)
-            ] 
-            for m in range(nstates)
-          ]
-          for l in range(nstates)
-        ] 
-        for k in range(nstates)
-      ] 
+def _tbdm_channels(data):
+  ''' (path, array) of each density matrix in a tbdm result.'''
+  return [(('obdm',key),np.asarray(data['obdm'][key],dtype=float)) for key in _obdm_keys]+\
+         [(('tbdm',key),np.asarray(data['tbdm'][key],dtype=float)) for key in _tbdm_keys]
+
+def _tbdm_result(sums,prefix=()):
+  res={'obdm':{},'tbdm':{}}
+  for mat,keys in [('obdm',_obdm_keys),('tbdm',_tbdm_keys)]:
+    for key in keys:
+      res[mat][key]=sums[prefix+(mat,key)]
   return res
 
 ################################################
-def _kaverage_deriv(data):
-  res={}
-  nparm=len(data[0]['dpenergy']['vals'])
-  nkpt=len(data)
-  nstates=len(data[0]['tbdm']['states'])
-
-  # Parameters with one value per parameter values.
-  for prop in ['dpenergy','dpwf']:
-    res[prop]=[
-        sum([
-          data[i][prop]['vals'][j]
-          for i in range(nkpt)
-        ])/nkpt
-        for j in range(nparm)
-      ]
-    res['%s_err'%prop]=[
-        (sum([
-          data[i][prop]['err'][j]**2
-          for i in range(nkpt)
-        ])/nkpt)**0.5
-        for j in range(nparm)
+class KAverage:
+  ''' Running weighted k-point average of average_derivative_dm results.
+
+  K-point results are added one at a time, and only weighted sums are kept, so memory is one k-point's data
+  plus the sums. Errors are combined like the values, as the weighted mean of the squared errors.
+  With a file name, the sums are saved after each addition (see manager_tools.save_state), 
+  so drivers run repeatedly can add each k-point as its manager finishes.
+  '''
+  def __init__(self,name='average_derivative_dm',fn=None):
+    '''
+    Args:
+      name (str): average generator whose results are averaged (only average_derivative_dm is implemented).
+      fn (str): where to save the sums. If it exists, the previous sums are loaded.
+    '''
+    if name!='average_derivative_dm':
+      raise NotImplementedError("KAverage: '%s' can't be averaged yet."%name)
+    self.name=name
+    self.fn=fn
+    self.weight=0.0
+    self.sums={}    # Channel path -> weighted sum.
+    self.added=[]   # Keys of the k-points already included.
+    self.nparm=None
+
+    if fn is not None and state_exists(fn):
+      old=load_state(fn)
+      self.weight,self.sums,self.added,self.nparm=old.weight,old.sums,old.added,old.nparm
+
+  #------------------------------------------------
+  def add(self,data,weight=1.0,key=None):
+    ''' Add the results of one k-point.
+    Args:
+      data (dict): average_derivative_dm results of the k-point (gosling layout).
+      weight (float): weight of the k-point.
+      key (str): identifies the k-point, so it's only added once. 
+    Returns:
+      bool: whether it was added.
+    '''
+    if key is not None and key in self.added:
+      return False
+    nparm=len(data['dprdm'])
+    if self.nparm is None: 
+      self.nparm=nparm
+    elif nparm!=self.nparm:
+      raise AssertionError("KAverage: k-point has %d parameters, but the others have %d."%(nparm,self.nparm))
+
+    channels=[]
+    for prop in ['dpenergy','dpwf']:
+      channels.append(((prop,),np.asarray(data[prop]['vals'],dtype=float)))
+      channels.append((('%s_err'%prop,),np.asarray(data[prop]['err'],dtype=float)**2))
+    channels+=[(('tbdm',)+path,mat) for path,mat in _tbdm_channels(data['tbdm'])]
+    # Parameter derivatives: one [parameter, ...] array per channel.
+    for path,mat in _tbdm_channels(data['dprdm'][0]['tbdm']):
+      stack=np.empty((nparm,)+mat.shape)
+      stack[0]=mat
+      for j in range(1,nparm):
+        stack[j]=data['dprdm'][j]['tbdm'][path[0]][path[1]]
+      channels.append((('dprdm',)+path,stack))
+
+    for path,val in channels:
+      if path in self.sums:
+        self.sums[path]+=weight*val
+      else:
+        self.sums[path]=weight*val
+    self.weight+=weight
+    if key is not None:
+      self.added.append(key)
+    if self.fn is not None:
+      save_state(self.fn,self)
+    return True
+
+  #------------------------------------------------
+  def add_manager(self,manager,weight=1.0):
+    ''' Add the results of a finished QWalkManager, once. Does nothing if it hasn't finished.
+    Args:
+      manager (QWalkManager): manager of the k-point run, with this average generator in its extra_observables.
+        Its reader output must be in the gosling layout (qwalklog.summarize or gosling).
+      weight (float): weight of its k-point.
+    Returns:
+      bool: whether it was added. False, with a message, if the results aren't in the manager's output.
+    '''
+    if not manager.completed or manager.path+manager.name in self.added:
+      return False
+    data=manager.reader.output.get('properties',{}).get(gosling_key(self.name))
+    if data is None:
+      print("KAverage: no %s results in the output of %s; is it in extra_observables?"%\
+          (gosling_key(self.name),manager.logname))
+      return False
+    return self.add(data,weight,key=manager.path+manager.name)
+
+  #------------------------------------------------
+  def result(self):
+    ''' The averages so far, in the layout of _kaverage_deriv.'''
+    if self.weight==0:
+      return {}
+    mean={path:val/self.weight for path,val in self.sums.items()}
+    res={}
+    for prop in ['dpenergy','dpwf']:
+      res[prop]=mean[(prop,)]
+      res['%s_err'%prop]=mean[('%s_err'%prop,)]**0.5
+    res['tbdm']=_tbdm_result(mean,('tbdm',))
+    dprdm=_tbdm_result(mean,('dprdm',))
+    res['dprdm']=[
+        {mat:{key:val[j] for key,val in dprdm[mat].items()} for mat in dprdm}
+        for j in range(self.nparm)
       ]
+    return res
+
+################################################
+_accumulate_lock=threading.Lock()
+def accumulate(fn,manager,weight=1.0):
+  ''' Add a finished manager's k-point to the KAverage saved in fn (created if needed).
+  Safe to call from managers advanced in threads.
+  Returns:
+    bool: whether it was added.
+  '''
+  with _accumulate_lock:
+    return KAverage(fn=fn).add_manager(manager,weight)
 
-  res['tbdm']=_kaverage_tbdm([data[k]['tbdm'] for k in range(nkpt)])
+################################################
+def _kaverage_tbdm(data,weights=None):
+  ''' Average the density matrices over k-points.
+  Args:
+    data (list): gosling tbdm results for each k-point.
+    weights (list): weight of each k-point (default uniform).
+  Returns:
+    dict: 'obdm' ('up','down') and 'tbdm' ('upup','updown','downup','downdown') as arrays.
+  '''
+  res={'obdm':{},'tbdm':{}}
 
-  res['dprdm']=[
-      _kaverage_tbdm(
-        [data[k]['dprdm'][i]['tbdm'] for k in range(nkpt)]
-      ) for i in range(nparm)
-    ]
+  # Wait, do we need this? This is already in tbdm, no?
+  for key in _obdm_keys:
+    res['obdm'][key]=np.average([d['obdm'][key] for d in data],axis=0,weights=weights)
 
+  for key in _tbdm_keys:
+    res['tbdm'][key]=np.average([d['tbdm'][key] for d in data],axis=0,weights=weights)
   return res
 
+################################################
+def _kaverage_deriv(data,weights=None):
+  ''' Average the density matrix derivatives over k-points (see KAverage).
+  Args:
+    data (list): results for each k-point.
+    weights (list): weight of each k-point (default uniform).
+  Returns:
+    dict: 'dpenergy', 'dpwf' and their '_err' as arrays over parameters, 'tbdm' (see _kaverage_tbdm), and
+      'dprdm', a list over parameters of averaged density matrices (views of one array per channel).
+  '''
+  if weights is None: weights=np.ones(len(data))
+  acc=KAverage()
+  for d,w in zip(data,weights):
+    acc.add(d,w)
+  return acc.result()
+
 ################################################
 def gosling_key(input_keyword):
   ''' Hack because gosling doesn't name json keys the same as the input keywords for QWalk '''
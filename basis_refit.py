@@ -2,7 +2,8 @@ import numpy as np
 import scipy.optimize as optimize
 import scipy
 from math import factorial
-from xml.etree.ElementTree import ElementTree,SubElement,Element
+from xml.etree.ElementTree import Element
+import basislibrary
 from scipy.integrate import quad
 ####################################################
 
@@ -67,8 +68,8 @@ def fit_exp_all(basis,expnew):
 ####################################################
 
 if __name__=="__main__":
-  tree=ElementTree()
-  tree.parse("BFD_Library.xml")
+  # A fresh tree, because the contractions are replaced in place.
+  tree=basislibrary.parse_tree("BFD_Library.xml")
   root=tree.getroot()
   df={'symbol':[],'shell':[],'err':[],'angular':[],'ebase':[]}
   for child in root:
@@ -0,0 +1,118 @@
+'''
+Access to the BFD basis set and pseudopotential (ECP) libraries (BFD_Library.xml and friends).
+
+Each XML file is parsed once per process, and parsed again only if the file changes.
+Writers should look up elements here instead of parsing the XML themselves.
+The numbers are given both as arrays and as the original text, so inputs written from the text are unchanged.
+'''
+
+import os
+import threading
+import numpy as np
+from xml.etree.ElementTree import ElementTree
+
+# Parsed libraries: absolute path -> (mtime, size, {symbol: element data}).
+_libraries={}
+_lock=threading.Lock()
+
+###################################################################
+def parse_tree(xml_name):
+  ''' Parse the XML file into a new ElementTree (not cached), for when the library itself will be modified.'''
+  tree=ElementTree()
+  tree.parse(xml_name)
+  return tree
+
+###################################################################
+def _floats(text):
+  ''' Convert to an array, with nan for text that isn't a number (the library has a few typos).'''
+  vals=[]
+  for t in text:
+    try:
+      vals.append(float(t))
+    except (TypeError,ValueError):
+      vals.append(np.nan)
+  return np.array(vals)
+
+def _components(element,path):
+  comps=element.findall(path)
+  text=[(c.find('./Exp').text,c.find('./Coeff').text,c.find('./r_to_n').text) for c in comps]
+  return {
+      'exp':_floats([t[0] for t in text]),
+      'coeff':_floats([t[1] for t in text]),
+      'r_to_n':np.array([int(t[2]) for t in text],dtype=int),
+      'text':text
+    }
+
+def _read_element(element):
+  ''' Collect everything the writers use from one Pseudopotential element.'''
+  data={
+      'eff_core_charge':element.find('./Effective_core_charge').text,
+      'local':_components(element,'./Gaussian_expansion/Local_component'),
+      'nonlocal':_components(element,'./Gaussian_expansion/Non-local_component'),
+      'proj':np.array([int(p.text) for p in element.findall('./Gaussian_expansion/Non-local_component/Proj')],dtype=int),
+      'basis':{}
+    }
+  for basis_set in element.findall('./Basis-set'):
+    contractions=data['basis'].setdefault(basis_set.get('name'),[])
+    for contraction in basis_set.findall('./Contraction'):
+      text=[(term.get('Exp'),term.get('Coeff')) for term in contraction.findall('./Basis-term')]
+      contractions.append({
+          'angular':contraction.get('Angular_momentum'),
+          'exp':_floats([t[0] for t in text]),
+          'coeff':_floats([t[1] for t in text]),
+          'text':text
+        })
+  return data
+
+###################################################################
+def load_library(xml_name):
+  ''' Parsed contents of a library file, from the cache if the file hasn't changed.
+  Args:
+    xml_name (str): path to the XML library.
+  Returns:
+    dict: symbol -> element data (see element()).
+  '''
+  path=os.path.abspath(xml_name)
+  stat=os.stat(path)
+  with _lock:
+    cached=_libraries.get(path)
+    if cached is not None and cached[0]==stat.st_mtime and cached[1]==stat.st_size:
+      return cached[2]
+  elements={}
+  for element in parse_tree(path).getroot().findall('./Pseudopotential'):
+    symbol=element.get('symbol')
+    if symbol not in elements:
+      elements[symbol]=_read_element(element)
+  with _lock:
+    _libraries[path]=(stat.st_mtime,stat.st_size,elements)
+  return elements
+
+###################################################################
+def element(xml_name,symbol):
+  ''' Library entry for one element.
+  Args:
+    xml_name (str): path to the XML library.
+    symbol (str): element symbol.
+  Returns:
+    dict:
+      'eff_core_charge' (str): effective core charge as written in the library.
+      'local', 'nonlocal' (dict): ECP components, with arrays 'exp', 'coeff', 'r_to_n', and 'text' (list of (exp,coeff,r_to_n) strings).
+        Numbers that can't be read from the library are nan in the arrays.
+      'proj' (array): projector angular momentum of each non-local component.
+      'basis' (dict): basis set name -> list of contractions, each with 'angular', arrays 'exp' and 'coeff', and 'text' (list of (exp,coeff) strings).
+  '''
+  elements=load_library(xml_name)
+  if symbol not in elements:
+    raise KeyError("Element %s not found in %s."%(symbol,xml_name))
+  return elements[symbol]
+
+###################################################################
+def basis_contractions(xml_name,symbol,basis_name='vtz'):
+  ''' Contractions of basis set basis_name for symbol (see element()).'''
+  return element(xml_name,symbol)['basis'].get(basis_name,[])
+
+###################################################################
+def clear_cache():
+  ''' Forget all parsed libraries.'''
+  with _lock:
+    _libraries.clear()
@@ -1,6 +1,13 @@
 import numpy as np
 import subprocess as sub
 import os
+import re
+import sys
+import submitter
+import taskfarm
+from autorunner import walltime_seconds, mpmd_line, scratch_lines, depend_header
+
+_task=re.compile(r'\s*(?:-n\s+(\d+)\s+)?(.*)$')
 
 class Bundler:
   ''' Class for handling the bundling of several jobs of approximately the same 
@@ -12,9 +19,14 @@ class Bundler:
                     mode='xe',
                     account='batr',
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    taskfarm=True,
+                    margin=1.5
                     ):
-    ''' npb is the number of nodes desired per bundle. '''
+    ''' npb is the number of nodes desired per bundle. 
+    With taskfarm, the managers' commands are run concurrently by taskfarm.py, which starts each manager's
+    commands as soon as nodes are free; otherwise they are run one after another in the job script.
+    margin is the factor on the expected time of a bundle used for its walltime (see submit).'''
     self.npb=npb
     self.ppn=ppn
     self.jobname=jobname
@@ -26,53 +38,132 @@ class Bundler:
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
+    self.taskfarm=taskfarm
+    self.margin=margin
     self.queueid=[]
 
-  def submit(self,mgrs,jobname=None):
-    ''' Submit a list of managers in bundles.
+  def check_status(self):
+    ''' Status of the bundles submitted by this Bundler (shares the scheduler status cache with the runners).'''
+    if self.mode=='xe':
+      return submitter.check_BW_stati(self.queueid)
+    return submitter.check_PBS_stati(self.queueid)
+
+  def estimate_time(self,mgr):
+    ''' Expected run time of a manager's commands in seconds: the length of its last task farm run if there was one,
+    otherwise its runner's walltime, otherwise the bundle walltime.'''
+    record=taskfarm.task_record(mgr.path,mgr.name)
+    if record is not None and record['state']=='done':
+      return record['stop']-record['start']
+    walltime=walltime_seconds(getattr(mgr.runner,'walltime',None))
+    if walltime is not None:
+      return walltime
+    return walltime_seconds(self.walltime)
+
+  def pack(self,nodes,times):
+    ''' Group jobs into bundles, first fit decreasing by area (nodes x time).
+    Each bundle lasts as long as its longest job and has at most npb nodes. A job fits in a bundle if it's no longer
+    and the bundle's area has room for it, adding nodes only if that doesn't add idle area 
+    (with the task farm, short jobs fill the nodes next to long ones).
+    Without the task farm, jobs in a bundle run one after another, so their times add up instead.
+    Args:
+      nodes (list): nodes of each job.
+      times (list): expected time of each job.
+    Returns:
+      (list,float): list of bundles (dicts with 'jobs' (indices), 'nodes', 'time'), and the packing efficiency
+        (area of the jobs / area of the bundles).
+    '''
+    order=sorted(range(len(nodes)),key=lambda i:-nodes[i]*times[i])
+    maxtime=walltime_seconds(self.walltime)
+    bundles=[]
+    for i in order:
+      area=nodes[i]*times[i]
+      for bundle in bundles:
+        if self.taskfarm:
+          # Nodes needed to hold the area in the bundle's time; only grow them if it doesn't waste more.
+          width=max(bundle['nodes'],nodes[i],int(np.ceil((bundle['area']+area)/bundle['time'])))
+          fits=times[i]<=bundle['time'] and width<=self.npb and \
+              (width==bundle['nodes'] or width*bundle['time']-bundle['area']-area<=(bundle['nodes']*bundle['time']-bundle['area']))
+        else:
+          width=bundle['nodes']
+          fits=nodes[i]<=bundle['nodes'] and bundle['time']+times[i]<=maxtime
+        if fits:
+          bundle['jobs'].append(i)
+          bundle['area']+=area
+          bundle['nodes']=width
+          if not self.taskfarm: bundle['time']+=times[i]
+          break
+      else:
+        bundles.append({'jobs':[i],'nodes':nodes[i],'time':times[i],'area':area})
+    used=sum([bundle['nodes']*bundle['time'] for bundle in bundles])
+    efficiency=sum([n*t for n,t in zip(nodes,times)])/used if used>0 else 1.0
+    return bundles,efficiency
+
+  def submit(self,mgrs,jobname=None,times=None):
+    ''' Submit a list of managers in bundles, packed by node count and expected time (see pack).
+    Each bundle asks for its expected time (with some margin), up to the bundler's walltime.
     Args:
       mgrs (list): list of managers to submit.
       jobname (str): what will appear in qstat.
+      times (list): expected time of each manager in seconds (default: see estimate_time).
+    Returns:
+      float: packing efficiency.
     '''
     print(self.__class__.__name__,"Submitting bundles of jobs.")
     if jobname is None: jobname=self.jobname
+    if times is None: times=[self.estimate_time(mgr) for mgr in mgrs]
 
-    assign=np.cumsum([mgr.runner.nn for mgr in mgrs])
-    assign=((assign-0.1)//self.npb).astype(int)
+    bundles,efficiency=self.pack([mgr.runner.nn for mgr in mgrs],times)
+    print(self.__class__.__name__,"%d managers in %d bundles, packing efficiency %.0f%%."%(len(mgrs),len(bundles),100*efficiency))
 
-    print(assign)
+    maxtime=walltime_seconds(self.walltime)
+    for bidx,bundle in enumerate(bundles):
+      walltime=min(maxtime,int(self.margin*bundle['time'])+60)
+      # The nodes the efficiency was computed for: without the task farm, the most any one manager needs.
+      self._submit_bundle([mgrs[i] for i in bundle['jobs']],"%s_%d"%(jobname,bidx),
+          nn=bundle['nodes'],
+          walltime="%d:%02d:%02d"%(walltime//3600,walltime%3600//60,walltime%60))
+    return efficiency
 
-    for bidx in range(assign[-1]+1):
-      self._submit_bundle(np.array(mgrs)[assign==bidx],"%s_%d"%(jobname,bidx))
-
-  def _submit_bundle(self,mgrs,jobname=None,nn=None):
+  def _submit_bundle(self,mgrs,jobname=None,nn=None,walltime=None):
     ''' Submit a set of runners that require the correct number of nodes.
     This is usually called by submit, after it determines the break-up of jobs.
     Args: 
       mgrs (list): list of managers ready for submission. 
       jobname (str): what appears in qstat.
       nn (int): number of nodes to be used for all jobs (default:sum of nn in each manager).
+      walltime (str): walltime of the bundle (default: self.walltime).
     '''
     if nn is None:      nn=sum([mgr.runner.nn for mgr in mgrs])
     if jobname is None: jobname=self.jobname
+    if walltime is None: walltime=self.walltime
     cwd=os.getcwd()
 
     qsublines=[
         "#PBS -q %s"%self.queue,
         "#PBS -l nodes=%i:ppn=%i:%s"%(nn,self.ppn,self.mode),
-        "#PBS -l walltime=%s"%self.walltime,
+        "#PBS -l walltime=%s"%walltime,
         "#PBS -j oe ",
         "#PBS -A %s"%self.account,
         "#PBS -N %s "%jobname,
         "#PBS -o %s.out "%jobname,
         "cd %s"%cwd
       ] + self.prefix
-    for mgr in mgrs:
-      # This might be better without an error-out.
-      lines=mgr.release_commands()
-      if len(lines)>0:
-        qsublines+=["cd %s"%mgr.path]+lines+["cd %s"%cwd]
-    qsublines+=["wait"]+self.postfix
+    if self.taskfarm:
+      tasks=[]
+      for mgr in mgrs:
+        lines=mgr.release_commands()
+        if len(lines)>0:
+          tasks.append({'name':mgr.name,'loc':mgr.path,'lines':lines,'nn':mgr.runner.nn,'np':mgr.runner.np})
+      manifest=os.path.join(cwd,jobname+".tasks.json")
+      taskfarm.write_manifest(manifest,tasks,self.ppn)
+      qsublines+=["%s %s %s"%(sys.executable,os.path.abspath(taskfarm.__file__),manifest)]+self.postfix
+    else:
+      for mgr in mgrs:
+        # This might be better without an error-out.
+        lines=mgr.release_commands()
+        if len(lines)>0:
+          qsublines+=["cd %s"%mgr.path]+lines+["cd %s"%cwd]
+      qsublines+=self.postfix
 
     qsubfile=jobname+".qsub"
     with open(qsubfile,'w') as f:
@@ -80,11 +171,163 @@ class Bundler:
     try:
       result=sub.check_output("qsub %s"%(qsubfile),shell=True)
       queueid=result.decode().split()[0].split('.')[0]
+      self.queueid.append(queueid)
+      submitter.clear_status_cache()
       print("Submitted as %s"%queueid)
     except sub.CalledProcessError:
       print("Error submitting job. Check queue settings.")
+      return
 
     for mgr in mgrs:
       mgr.update_queueid(queueid)
 
+#######################################################################
+def submit_array(mgrs,jobname='AGArray',loc=None):
+  ''' Submit the commands of many managers as one PBS job array (qsub -J), one array index per manager.
+  The managers' runners must ask for the same resources (queue, walltime, nodes, cores, prefix, postfix and the 
+  jobs they depend on); the first one's are used. Each index runs in its runner's scratch, if it has one.
+  Each manager gets its subjob id (e.g. 1234[5]) through update_queueid, 
+  and the status of all of them comes from one qstat (see submitter.qstat_table).
+  PBS doesn't take an array of one index, so a single manager is submitted as a plain job.
+  Args:
+    mgrs (list): managers with commands to run.
+    jobname (str): name of the array in the queue.
+    loc (str): where the array script and the per-index command files are written (default: current directory).
+  Returns:
+    str: queue id of the array, or None if nothing was submitted.
+  '''
+  if loc is None: loc=os.getcwd()
+  loc=os.path.abspath(loc)
+  runner=mgrs[0].runner
+  resources=['queue','walltime','nn','np','prefix','postfix','depends']
+  for mgr in mgrs[1:]:
+    for key in resources:
+      if getattr(mgr.runner,key,None)!=getattr(runner,key,None):
+        raise AssertionError("submit_array: %s has a different %s than %s."%(mgr.logname,key,mgrs[0].logname))
+
+  blocks=[]
+  for mgr in mgrs:
+    lines=mgr.release_commands()
+    if len(lines)>0:
+      blocks.append((mgr,lines))
+  if len(blocks)==0:
+    return None
+
+  taskdir=os.path.join(loc,jobname+".array")
+  if not os.path.exists(taskdir): os.mkdir(taskdir)
+  for idx,(mgr,lines) in enumerate(blocks):
+    staging=[]
+    if getattr(mgr.runner,'scratch',None) is not None:
+      if mgr.runner.nn>1:
+        raise AssertionError("submit_array: %s has %d nodes, but %s is only on the first."%\
+            (mgr.logname,mgr.runner.nn,mgr.runner.scratch))
+      staging=scratch_lines(os.path.abspath(mgr.path),mgr.runner.scratch,mgr.runner.outputs)
+    with open(os.path.join(taskdir,"%d.sh"%idx),'w') as outf:
+      outf.write('\n'.join(["cd %s"%os.path.abspath(mgr.path)]+staging+lines)+'\n')
+
+  if runner.np=='allprocs':
+    ppnstr=',flags=allprocs'
+  else:
+    ppnstr=':ppn=%d'%runner.np
+  qsub=[
+      "#PBS -q %s"%runner.queue,
+      "#PBS -l nodes=%i%s"%(runner.nn,ppnstr),
+      "#PBS -l walltime=%s"%runner.walltime,
+      "#PBS -j oe ",
+      "#PBS -N %s "%jobname,
+      "#PBS -o %s.out "%jobname,
+    ] + depend_header(getattr(runner,'depends',[]))
+  if len(blocks)>1:
+    qsub+=["#PBS -J 0-%d"%(len(blocks)-1)]+runner.prefix+["bash %s/${PBS_ARRAY_INDEX}.sh"%taskdir]+runner.postfix
+  else:
+    qsub+=runner.prefix+["bash %s/0.sh"%taskdir]+runner.postfix
+  qsubfile=os.path.join(loc,jobname+".qsub")
+  with open(qsubfile,'w') as f:
+    f.write('\n'.join(qsub))
+  try:
+    result=sub.check_output("qsub %s"%(qsubfile),shell=True,cwd=loc)
+  except sub.CalledProcessError as err:
+    print("submit_array: Error submitting job. Check queue settings.\n\t{0}".format(err))
+    return None
+  queueid=result.decode().split()[0].split('.')[0] # Like 1234[].
+  submitter.clear_status_cache()
+  print("submit_array: Submitted %d managers as %s"%(len(blocks),queueid))
+
+  for idx,(mgr,lines) in enumerate(blocks):
+    if hasattr(mgr.runner,'depends'): mgr.runner.depends=[]
+    mgr.update_queueid(queueid.replace('[]','[%d]'%idx))
+  return queueid
+
+#######################################################################
+def submit_mpmd(mgrs,jobname='AGMPMD',loc=None):
+  ''' Submit the tasks of many managers as one job with a single MPMD mpirun launch 
+  (see autorunner.mpmd_line), each program started in its manager's directory. 
+  Many small QWalk runs then share one allocation and one MPI startup. Commands that aren't MPI tasks run
+  in the manager's directory before the launch if they come before its tasks, and after it otherwise.
+  Since everything in the launch runs at once, each manager may only have one mpirun line: tasks that must run
+  one after another (e.g. CRYSTAL then properties) can't be launched this way.
+  The job asks for enough nodes for all the ranks, with the first manager's runner's queue, walltime, cores 
+  per node, prefix and postfix.
+  Args:
+    mgrs (list): managers whose runners are RunnerPBS (or RunnerMPMD) with np set.
+    jobname (str): name of the job in the queue.
+    loc (str): where the qsub file is written (default: current directory).
+  Returns:
+    str: queue id of the job, or None if nothing was submitted.
+  '''
+  if loc is None: loc=os.getcwd()
+  loc=os.path.abspath(loc)
+  runner=mgrs[0].runner
+  if runner.np=='allprocs':
+    raise AssertionError("submit_mpmd: np of the runners must be set to size the launch.")
+
+  for mgr in mgrs:
+    nmpi=len([line for line in mgr.runner.exelines if line.startswith('mpirun ')])
+    if nmpi>1:
+      raise AssertionError("submit_mpmd: %s has %d tasks, which must run one after another."%(mgr.logname,nmpi))
+
+  before,tasks,after,launched=[],[],[],[]
+  for mgr in mgrs:
+    path=os.path.abspath(mgr.path)
+    ntask=len(tasks)
+    lines=mgr.release_commands()
+    if len(lines)>0:
+      launched.append(mgr)
+    for line in lines:
+      if not line.startswith('mpirun '):
+        (before if len(tasks)==ntask else after).append("(cd %s && %s)"%(path,line))
+        continue
+      for part in line[len('mpirun '):].split(' : '):
+        match=_task.match(part)
+        if match.group(1) is None:
+          tasks.append((mgr.runner.nn*mgr.runner.np,match.group(2),path))
+        else:
+          tasks.append((int(match.group(1)),match.group(2),path))
+  if len(tasks)==0:
+    return None
+
+  nn=-(-sum([t[0] for t in tasks])//runner.np)
+  qsub=[
+      "#PBS -q %s"%runner.queue,
+      "#PBS -l nodes=%i:ppn=%d"%(nn,runner.np),
+      "#PBS -l walltime=%s"%runner.walltime,
+      "#PBS -j oe ",
+      "#PBS -N %s "%jobname,
+      "#PBS -o %s.out "%jobname,
+      "cd %s"%loc,
+    ] + runner.prefix + before + [mpmd_line('mpirun',tasks)] + after + runner.postfix
+  qsubfile=os.path.join(loc,jobname+".qsub")
+  with open(qsubfile,'w') as f:
+    f.write('\n'.join(qsub))
+  try:
+    result=sub.check_output("qsub %s"%(qsubfile),shell=True,cwd=loc)
+  except sub.CalledProcessError as err:
+    print("submit_mpmd: Error submitting job. Check queue settings.\n\t{0}".format(err))
+    return None
+  queueid=result.decode().split()[0].split('.')[0]
+  submitter.clear_status_cache()
+  print("submit_mpmd: Submitted %d tasks of %d managers on %d nodes as %s"%(len(tasks),len(launched),nn,queueid))
 
+  for mgr in launched:
+    mgr.update_queueid(queueid)
+  return queueid
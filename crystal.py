@@ -7,7 +7,7 @@ from pymatgen.io.cif import CifParser
 from pymatgen.io.xyz import XYZ
 from pymatgen.core.periodic_table import Element
 from crystal2qmc import periodic_table # TODO should this be in crystal2qmc?
-from xml.etree.ElementTree import ElementTree
+import basislibrary
 import numpy as np
 import os
 
@@ -217,12 +217,23 @@ class CrystalWriter:
 
   #-----------------------------------------------
   def write_crys_input(self,filename):
-    outstr=self.crystal_input()
+    # A relative xml_name is taken from the directory of the input, as when managers ran in their directory.
+    self._libdir=os.path.dirname(os.path.abspath(filename))
+    try:
+      outstr=self.crystal_input()
+    finally:
+      del self._libdir
     with open(filename,'w') as outf:
       outf.write(outstr)
       outf.close()
     self.completed=True
 
+  #-----------------------------------------------
+  def library(self):
+    ''' Path of the basis and pseudopotential library. A relative xml_name is resolved from the directory of 
+    the input being written (see write_crys_input), or else from the current directory.'''
+    return os.path.join(getattr(self,'_libdir',''),self.xml_name)
+
   #-----------------------------------------------
   def write_prop_input(self,filename):
     outstr=self.properties_input()
@@ -369,31 +380,23 @@ class CrystalWriter:
       maxorb=4
       nangular['s']=2
     
-    tree = ElementTree()
-    tree.parse(self.xml_name)
-    element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-    atom_charge = int(element.find('./Effective_core_charge').text)
+    element = basislibrary.element(self.library(),symbol)
+    atom_charge = int(element['eff_core_charge'])
     if symbol in self.initial_charges.keys():
       atom_charge-=self.initial_charges[symbol]
-    basis_path = './Basis-set[@name="{}"]/Contraction'.format(basis_name)
     found_orbitals = []
     totcharge=0
     ret=[]
     ncontract=0
-    for contraction in element.findall(basis_path):
-        angular = contraction.get('Angular_momentum')
+    for contraction in element['basis'].get(basis_name,[]):
+        angular = contraction['angular']
         if found_orbitals.count(angular) >= nangular[angular]:
             continue
 
         #Figure out which coefficients to print out based on the minimal exponent
-        nterms = 0
-        basis_part=[]
-        for basis_term in contraction.findall('./Basis-term'):
-            exp = basis_term.get('Exp')
-            coeff = basis_term.get('Coeff')
-            if float(exp) > self.cutoff:
-                basis_part += ['  {} {}'.format(exp, coeff)]
-                nterms+=1
+        keep = contraction['exp'] > self.cutoff
+        nterms = int(keep.sum())
+        basis_part = ['  {} {}'.format(exp, coeff) for (exp,coeff),k in zip(contraction['text'],keep) if k]
         #now write the header 
         if nterms > 0:
           found_orbitals.append(angular)          
@@ -440,40 +443,106 @@ class CrystalWriter:
     Returns:
         list of lines of pseudopotential section (edit by Brian Busemeyer).
     """
-    tree = ElementTree()
-    tree.parse(self.xml_name)
-    element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-    eff_core_charge = element.find('./Effective_core_charge').text
-    local_path = './Gaussian_expansion/Local_component'
-    non_local_path = './Gaussian_expansion/Non-local_component'
-    local_list = element.findall(local_path)
-    non_local_list = element.findall(non_local_path)
+    element = basislibrary.element(self.library(),symbol)
+    eff_core_charge = element['eff_core_charge']
+    local_list = element['local']['text']
+    non_local_list = element['nonlocal']['text']
     nlocal = len(local_list)
     m = [0, 0, 0, 0, 0]
-    proj_path = './Gaussian_expansion/Non-local_component/Proj'
-    proj_list = element.findall(proj_path)
-    for projector in proj_list:
-        m[int(projector.text)] += 1
+    for projector in element['proj']:
+        m[projector] += 1
     strlist = []
     strlist.append('INPUT')
     strlist.append(' '.join(map(str,[eff_core_charge,nlocal,
                                      m[0],m[1],m[2],m[3],m[4]])))
-    for local_component in local_list:
-        exp_gaus = local_component.find('./Exp').text
-        coeff_gaus = local_component.find('./Coeff').text
-        r_to_n = local_component.find('./r_to_n').text
+    for exp_gaus, coeff_gaus, r_to_n in local_list:
         strlist.append(' '.join([exp_gaus, coeff_gaus,r_to_n]))
-    for non_local_component in non_local_list:
-        exp_gaus = non_local_component.find('./Exp').text
-        coeff_gaus = non_local_component.find('./Coeff').text
-        r_to_n = non_local_component.find('./r_to_n').text
+    for exp_gaus, coeff_gaus, r_to_n in non_local_list:
         strlist.append(' '.join([exp_gaus, coeff_gaus,r_to_n]))
     return strlist
 import os 
 
 
 ###################################################################
+import re
+_scan_lines=re.compile(rb'^[^\n]*(?:ENDED|DETOT|TOTAL ATOMIC SPINS|TOTAL ATOMIC CHARGES)[^\n]*$',re.M)
+_scan_marklen=256
+
+def scan_output(outfilename,state=None):
+  """ Scan a CRYSTAL output in one pass for the lines the reader uses.
+
+  The returned state remembers how far the file was read, so the next call only scans the text appended since.
+  Only complete lines are read; a spin or charge section that isn't finished yet is read on the next call. 
+  If the file was rewritten (e.g. by a restart), it's scanned again from the start.
+  Args:
+    outfilename (str): CRYSTAL output.
+    state (dict): state from the previous call for this file, or None to scan the whole file.
+  Returns:
+    dict: state, with
+      'ended' (str): first line containing ENDED, or None.
+      'scf' (str): 'converged' or 'too_many_cycles' from the last SCF ENDED line, or None.
+      'total_energy', 'last_energy' (float): energy of a converged SCF, or of the last unconverged one.
+      'etot', 'detot' (array): ETOT and DETOT of each SCF cycle.
+      'mag_moments', 'atomic_charges' (array): last TOTAL ATOMIC SPINS and CHARGES, or None.
+  """
+  size=os.path.getsize(outfilename)
+  with open(outfilename,'rb') as inpf:
+    if state is not None and state['offset']<=size:
+      inpf.seek(state['offset']-len(state['mark']))
+      if inpf.read(len(state['mark']))!=state['mark']:
+        state=None
+    else:
+      state=None
+    if state is None:
+      state={'file':os.path.abspath(outfilename),'offset':0,'mark':b'',
+          'ended':None,'scf':None,'total_energy':None,'last_energy':None,
+          'etot':np.zeros(0),'detot':np.zeros(0),'mag_moments':None,'atomic_charges':None}
+      inpf.seek(0)
+    buf=inpf.read()
+  buf=buf[:buf.rfind(b'\n')+1]
+  consumed=len(buf)
+
+  etot=[]
+  detot=[]
+  for match in _scan_lines.finditer(buf):
+    line=match.group()
+    if b'ENDED' in line:
+      text=line.decode(errors='replace')
+      if state['ended'] is None: 
+        state['ended']=text
+      if 'SCF ENDED - CONVERGENCE ON ENERGY' in text:
+        state['scf']='converged'
+        state['total_energy']=float(text.split()[8])
+      elif 'SCF ENDED - TOO MANY CYCLES' in text:
+        state['scf']='too_many_cycles'
+        state['last_energy']=float(text.split()[8])
+    elif b'DETOT' in line:
+      words=line.split()
+      try:
+        etot.append(float(words[3]))
+        detot.append(float(words[5]))
+      except (IndexError,ValueError):
+        pass
+    else:
+      if b'SPINS' in line:
+        key,stops='mag_moments',[b'TTT']
+      else:
+        key,stops='atomic_charges',[b'SUMMED',b'TTT']
+      ends=[buf.find(stop,match.end()) for stop in stops]
+      ends=[end for end in ends if end>=0]
+      if len(ends)==0:
+        # Section not finished; read it next time.
+        consumed=match.start()
+        break
+      state[key]=np.array(buf[match.end():buf.rfind(b'\n',0,min(ends))].split(),dtype=float)
+
+  state['etot']=np.concatenate([state['etot'],etot])
+  state['detot']=np.concatenate([state['detot'],detot])
+  state['offset']+=consumed
+  state['mark']=(state['mark']+buf[:consumed])[-_scan_marklen:]
+  return state
 
+###################################################################
 class CrystalReader:
   """ Extract properties of crystal run. 
   output values are stored in self.output dictionary when collect() is run. 
@@ -481,6 +550,11 @@ class CrystalReader:
   def __init__(self):
     self.completed=False
     self.output={}
+    self.scan=None # Output scanned so far (see scan_output).
+
+    # SCF heuristics for check_outputfile.
+    self.acceptable_scf=10.0 # Most the energy may rise after the first cycle (sum of DETOT) before giving up.
+    self.stall_cycles=50 # Give up if |DETOT| hasn't reached a new low in this many cycles (0 to never).
 
     
 #-------------------------------------------------      
@@ -491,40 +565,18 @@ class CrystalReader:
     status='killed'
     self.completed=False
     if os.path.isfile(outfilename):
-      f = open(outfilename, 'r')
-      try:
-        lines = f.readlines()
-      except UnicodeDecodeError:
-        self.completed=False
-        lines = []
-        print(self.__class__.__name__,": Crystal output is unreadable, this usually happens when the process as been killed.")
-      for li,line in enumerate(lines):
-        if 'SCF ENDED - CONVERGENCE ON ENERGY' in line:
-          self.output['total_energy']=float(line.split()[8])    
-          print(self.__class__.__name__,": SCF ended converging on %f"%self.output['total_energy'])
-          status='done'
-          self.completed=True
-        elif 'SCF ENDED - TOO MANY CYCLES' in line:
-          last=float(line.split()[8])
-          print("SCF ended at %f Ha without convergence"%last)
-          status='killed'
-          self.completed=False
-
-        elif 'TOTAL ATOMIC SPINS' in line:
-          moms = []
-          shift = 1
-          while "TTT" not in lines[li+shift]:
-            moms += map(float,lines[li+shift].split())
-            shift += 1
-          self.output['mag_moments']=moms
-
-        elif 'TOTAL ATOMIC CHARGES' in line:
-          chgs = []
-          shift = 1
-          while ("SUMMED" not in lines[li+shift]) and ("TTT" not in lines[li+shift]):
-            chgs += map(float,lines[li+shift].split())
-            shift += 1
-          self.output['atomic_charges']=chgs
+      self.scan=scan_output(outfilename,self.scan)
+      if self.scan['scf']=='converged':
+        self.output['total_energy']=self.scan['total_energy']
+        print(self.__class__.__name__,": SCF ended converging on %f"%self.output['total_energy'])
+        status='done'
+        self.completed=True
+      elif self.scan['scf']=='too_many_cycles':
+        print("SCF ended at %f Ha without convergence"%self.scan['last_energy'])
+      if self.scan['mag_moments'] is not None:
+        self.output['mag_moments']=self.scan['mag_moments'].tolist()
+      if self.scan['atomic_charges'] is not None:
+        self.output['atomic_charges']=self.scan['atomic_charges'].tolist()
     else:
       # Just to be sure/clear...
       self.completed=False
@@ -537,42 +589,41 @@ class CrystalReader:
 
 
 #-------------------------------------------------      
-  # This can be made more efficient if it's a problem: searches whole file for
-  # each query.
-  def check_outputfile(outfilename,acceptable_scf=10.0):
-    """ Check output file. 
+  def check_outputfile(self,outfilename,acceptable_scf=None):
+    """ Check output file. Only the text added since the last check is read, so this can follow a running job.
 
     Return values:
     no_record, not_started, ok, too_many_cycles, finished (fall-back),
-    scf_fail, not_enough_decrease, divergence, not_finished
+    scf_fail, not_enough_decrease, divergence, stalled, not_finished
     """
-    if os.path.isfile(outfilename):
-      outf = open(outfilename,'r',errors='ignore')
-    else:
+    if acceptable_scf is None: acceptable_scf=self.acceptable_scf
+    if not os.path.isfile(outfilename):
       return "not_started"
+    self.scan=scan_output(outfilename,self.scan)
 
-    outlines = outf.readlines()
-    reslines = [line for line in outlines if "ENDED" in line]
-
-    if len(reslines) > 0:
-      if "CONVERGENCE" in reslines[0]:
+    if self.scan['ended'] is not None:
+      if "CONVERGENCE" in self.scan['ended']:
         return "ok"
-      elif "TOO MANY CYCLES" in reslines[0]:
+      elif "TOO MANY CYCLES" in self.scan['ended']:
         return "too_many_cycles"
       else: 
         return "finished"
       
-    detots = [float(line.split()[5]) for line in outlines if "DETOT" in line]
-    if len(detots) == 0:
+    detots=self.scan['detot']
+    if detots.size == 0:
       return "scf_fail"
 
-    detots_net = sum(detots[1:])
+    detots_net = detots[1:].sum()
     if detots_net > acceptable_scf:
       return "not_enough_decrease"
 
-    etots = [float(line.split()[3]) for line in outlines if "DETOT" in line]
-    if etots[-1] > 0:
+    if self.scan['etot'][-1] > 0:
       return "divergence"
+
+    if self.stall_cycles > 0 and detots.size > self.stall_cycles+1:
+      best=np.abs(detots[1:-self.stall_cycles]).min()
+      if np.abs(detots[-self.stall_cycles:]).min() >= best:
+        return "stalled"
     
     return "not_finished"
   
@@ -6,6 +6,11 @@ A casual user would be interested in convert_crystal.
 from __future__ import division,print_function
 import numpy as np
 import sys
+import os
+import re
+import mmap
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 def error(message,errortype):
   print(message)
@@ -27,7 +32,9 @@ def convert_crystal(
     base="qwalk",
     propoutfn="prop.in.o",
     realonly=False,
-    nvirtual=50):
+    nvirtual=50,
+    path='',
+    nproc=1):
   """
   Uses rountines in this library to convert crystal files into qwalk files in one call.
   Files are named by [base]_[kindex].sys etc.
@@ -36,8 +43,10 @@ def convert_crystal(
     propoutfn (str): name of either crystal or properties output file.
     realonly (bool): whether to only the real kpoints.
     nvirtual (int): number of virtual orbtials to include in orbitals section.
+    path (str): directory containing GRED.DAT, KRED.DAT and propoutfn. QWalk files are written here too.
+    nproc (int): number of processes writing k-points in parallel.
   Returns:
-    dict: files produced by this call.
+    dict: files produced by this call (relative to path), and the k-points ('kpoints') and their weights ('kweights').
   """
   # kfmt='coord' is probably a bad thing because it doesn't always work and can 
   # lead to unexpected changes in file name conventions.
@@ -45,11 +54,11 @@ def convert_crystal(
   # keeps track of the files that get produced.
   files={}
 
-  info, lat_parm, ions, basis, pseudo = read_gred()
-  eigsys = read_kred(info,basis)
+  info, lat_parm, ions, basis, pseudo = read_gred(os.path.join(path,"GRED.DAT"))
+  eigsys = read_kred(info,basis,os.path.join(path,"KRED.DAT"))
 
   if eigsys['nspin'] > 1:
-    eigsys['totspin'] = read_outputfile(propoutfn)
+    eigsys['totspin'] = read_outputfile(os.path.join(path,propoutfn))
   else:
     eigsys['totspin'] = 0
 
@@ -64,6 +73,7 @@ def convert_crystal(
   #  All the files that will get produced.
   files={
       'kpoints':{},
+      'kweights':{},
       'basis':base+".basis",
       'jastrow2':base+".jast2",
       'orbplot':{},
@@ -71,33 +81,89 @@ def convert_crystal(
       'sys':{},
       'slater':{}
     }
-  write_basis(basis,ions,files['basis'])
-  write_jast2(lat_parm,ions,files['jastrow2'])
+  write_basis(basis,ions,os.path.join(path,files['basis']))
+  write_jast2(lat_parm,ions,os.path.join(path,files['jastrow2']))
  
+  kpts=[]
   for kpt in eigsys['kpt_coords']:
     if eigsys['ikpt_iscmpx'][kpt] and realonly: continue
     kidx=eigsys['kpt_index'][kpt]
     files['kpoints'][kidx]=kpt
+    files['kweights'][kidx]=float(eigsys['kpt_weights'][kidx])
     files['orbplot'][kidx]="%s_%d.plot"%(base,kidx)
     files['slater'][kidx]="%s_%d.slater"%(base,kidx)
     files['orb'][kidx]="%s_%d.orb"%(base,kidx)
     files['sys'][kidx]="%s_%d.sys"%(base,kidx)
-    write_slater(basis,eigsys,kpt,
-        outfn=files['slater'][kidx],
-        orbfn=files['orb'][kidx],
-        basisfn=files['basis'],
-        maxmo_spin=maxmo_spin)
-    write_orbplot(basis,eigsys,kpt,
-        outfn=files['orbplot'][kidx],
-        orbfn=files['orb'][kidx],
-        basisfn=files['basis'],
-        sysfn=files['sys'][kidx],
-        maxmo_spin=maxmo_spin)
-    write_orb(eigsys,basis,ions,kpt,files['orb'][kidx],maxmo_spin)
-    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,files['sys'][kidx])
+    kpts.append(kpt)
 
+  # Each k-point is independent. Processes only share the metadata; they read their eigenvectors from KRED.DAT.
+  shared=(lat_parm,basis,eigsys,pseudo,ions,files,maxmo_spin,path)
+  if nproc > 1 and len(kpts) > 1:
+    with ProcessPoolExecutor(max_workers=nproc,initializer=_init_kpoint_worker,initargs=shared) as pool:
+      list(pool.map(_convert_kpoint,kpts))
+  else:
+    for kpt in kpts:
+      _convert_kpoint(kpt,shared)
+
+  return files
+
+###############################################################################
+def save_files(files,fname):
+  ''' Save the file names returned by convert_crystal as JSON, e.g. for a manager to pick up after a batch job.'''
+  with open(fname,'w') as outf:
+    json.dump({key:(list(val.items()) if type(val)==dict else val) for key,val in files.items()},outf)
+
+def load_files(fname):
+  ''' Read file names saved by save_files, as convert_crystal returned them.'''
+  with open(fname,'r') as inpf:
+    saved=json.load(inpf)
+  files={key:(dict(val) if type(val)==list else val) for key,val in saved.items()}
+  files['kpoints']={kidx:tuple(kpt) for kidx,kpt in files['kpoints'].items()}
   return files
 
+###############################################################################
+# Per-k-point part of convert_crystal, which can run in worker processes.
+_kpoint_shared=None
+
+def _init_kpoint_worker(*shared):
+  global _kpoint_shared
+  _kpoint_shared=shared
+
+def _convert_kpoint(kpt,shared=None):
+  if shared is None: shared=_kpoint_shared
+  lat_parm,basis,eigsys,pseudo,ions,files,maxmo_spin,path=shared
+  kidx=eigsys['kpt_index'][kpt]
+  write_slater(basis,eigsys,kpt,
+      outfn=os.path.join(path,files['slater'][kidx]),
+      orbfn=files['orb'][kidx],
+      basisfn=files['basis'],
+      maxmo_spin=maxmo_spin)
+  write_orbplot(basis,eigsys,kpt,
+      outfn=os.path.join(path,files['orbplot'][kidx]),
+      orbfn=files['orb'][kidx],
+      basisfn=files['basis'],
+      sysfn=files['sys'][kidx],
+      maxmo_spin=maxmo_spin)
+  write_orb(eigsys,basis,ions,kpt,os.path.join(path,files['orb'][kidx]),maxmo_spin)
+  write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,os.path.join(path,files['sys'][kidx]))
+
+###############################################################################
+def read_fortran_numbers(fname):
+  ''' Read every number in a Fortran-formatted file into one array.
+
+  Fortran drops the space between fields when a negative number fills its field (e.g. "1.0E+00-2.0E+00"),
+  so a space is inserted before each '-' that isn't part of an exponent before converting.
+  Args:
+    fname (str): path to the file.
+  Returns:
+    array: all the numbers as floats, in order.
+  '''
+  raw = np.fromfile(fname,dtype=np.uint8)
+  minus = np.flatnonzero(raw==ord('-'))
+  glued = minus[raw[minus-1]!=ord('E')]
+  raw = np.insert(raw,glued,ord(' '))
+  return np.fromstring(raw.tobytes(),sep=' ')
+
 ###############################################################################
 def read_gred(gred="GRED.DAT"):
   ''' Read the structure, basis, and pseudopotential from the GRED.DAT file.
@@ -116,34 +182,28 @@ def read_gred(gred="GRED.DAT"):
   basis = {}
   pseudo = {}
 
-  gred = open(gred,'r').read()
-
-  # Fix numbers with no space between them.
-  gred = gred.replace("-"," -")
-  gred = gred.replace("E -","E-") 
-
-  gred_words = gred.split()
-  nparms = [int(w) for w in gred_words[1:4]]
+  gred_words = read_fortran_numbers(gred)
+  nparms = gred_words[1:4].astype(int).tolist()
   cursor = 4
 
   # These follow naming of cryapi_inp (but "inf" -> "info").
-  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
-  itol = [int(w) for w in gred_words[cursor+nparms[0]:cursor+nparms[1]]]
-  par  = [int(w) for w in gred_words[cursor+nparms[1]:cursor+nparms[2]]]
+  info = gred_words[cursor          :cursor+nparms[0]].astype(int).tolist()
+  itol = gred_words[cursor+nparms[0]:cursor+nparms[1]].astype(int).tolist()
+  par  = gred_words[cursor+nparms[1]:cursor+nparms[2]].astype(int).tolist()
   cursor += sum(nparms)
 
   lat_parm['struct_dim'] = int(info[9])
 
   # Lattice parameters.
   lat_parm['latvecs'] = \
-      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
+      gred_words[cursor:cursor+9].copy().reshape(3,3).T.round(15)
   if (lat_parm['latvecs'] > 100).any():
     print("Lattice parameter larger than 100 A! Reducing to 100.")
     print("If this is a dimension < 3 system, there is no cause for alarm.")
     print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
     lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
   cursor += 9
-  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
+  prim_trans= gred_words[cursor:cursor+9].copy().reshape(3,3)
   cursor += 9
   lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
   cursor += info[1] + 48*48 + 9*info[1] + 3*info[1] # Skip symmetry part.
@@ -153,10 +213,10 @@ def read_gred(gred="GRED.DAT"):
 
   # Some of ion information.
   natoms = info[23]
-  ions['charges'] = [float(w) for w in gred_words[cursor:cursor+natoms]]
+  ions['charges'] = gred_words[cursor:cursor+natoms].tolist()
   cursor += natoms
   # Atom positions.
-  atom_poss = np.array(gred_words[cursor:cursor+3*natoms],dtype=float)
+  atom_poss = gred_words[cursor:cursor+3*natoms].copy()
   ions['positions'] = atom_poss.reshape(natoms,3)
   cursor += 3*natoms
 
@@ -164,57 +224,57 @@ def read_gred(gred="GRED.DAT"):
   nshells = info[19]
   nprim   = info[74]
   # Formal charge of shell.
-  basis['charges'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  basis['charges'] = gred_words[cursor:cursor+nshells].copy()
   cursor += nshells
   # "Adjoined gaussian" of shells.
-  basis['adj_gaus'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  basis['adj_gaus'] = gred_words[cursor:cursor+nshells].copy()
   cursor += nshells
   # Position of shell.
-  shell_poss = np.array(gred_words[cursor:cursor+3*nshells],dtype=float)
+  shell_poss = gred_words[cursor:cursor+3*nshells].copy()
   basis['positions'] = shell_poss.reshape(nshells,3)
   cursor += 3*nshells
   # Primitive gaussian exponents.
-  basis['prim_gaus'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['prim_gaus'] = gred_words[cursor:cursor+nprim].copy()
   cursor += nprim
   # Coefficients of s, p, d, and (?).
-  basis['coef_s'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_s'] = gred_words[cursor:cursor+nprim].copy()
   cursor += nprim
-  basis['coef_p'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_p'] = gred_words[cursor:cursor+nprim].copy()
   cursor += nprim
-  basis['coef_dfg'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_dfg'] = gred_words[cursor:cursor+nprim].copy()
   cursor += nprim
-  basis['coef_max'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_max'] = gred_words[cursor:cursor+nprim].copy()
   cursor += nprim
   # Skip "old normalization"
   cursor += 2*nprim
   # Atomic numbers.
-  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  ions['atom_nums'] = gred_words[cursor:cursor+natoms].astype(int)
   cursor += natoms
   # First shell of each atom (skip extra number after).
-  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  basis['first_shell'] = gred_words[cursor:cursor+natoms].astype(int)
   cursor += natoms + 1
   # First primitive of each shell (skips an extra number after).
-  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['first_prim'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells + 1
   # Number of prims per shell.
-  basis['prim_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['prim_shell'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells
   # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
-  basis['shell_type'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['shell_type'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells
   # Number of atomic orbtials per shell.
-  basis['nao_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['nao_shell'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells
   # First atomic orbtial per shell (skip extra number after).
-  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['first_ao'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells + 1
   # Atom to which each shell belongs.
-  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['atom_shell'] = gred_words[cursor:cursor+nshells].astype(int)
   cursor += nshells
 
   # Pseudopotential information.
   # Pseudopotential for each element.
-  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  pseudo_atom = gred_words[cursor:cursor+natoms].astype(int)
   cursor += natoms
   cursor += 1 # skip INFPOT
   ngauss = int(gred_words[cursor])
@@ -225,18 +285,18 @@ def read_gred(gred="GRED.DAT"):
   numpseudo = int(gred_words[cursor])
   cursor += 1
   # Exponents of r^l prefactor.
-  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
+  r_exps = -1*gred_words[cursor:cursor+ngauss].astype(int)
   cursor += ngauss
   # Number of Gaussians for angular momenutum j
-  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
+  n_per_j = gred_words[cursor:cursor+headlen].astype(int)
   cursor += headlen
   # index of first n_per_j for each pseudo.
-  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
+  pseudo_start = gred_words[cursor:cursor+numpseudo].astype(int)
   cursor += numpseudo + 1
   # Actual floats of pseudopotential.
-  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  exponents = gred_words[cursor:cursor+ngauss].copy()
   cursor += ngauss
-  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  prefactors = gred_words[cursor:cursor+ngauss].copy()
   cursor += ngauss
   # Store information nicely.
   npjlen = int(headlen / len(pseudo_start))
@@ -254,7 +314,7 @@ def read_gred(gred="GRED.DAT"):
 
   ## Density matrix information.
   # This is impossible to figure out.  See `cryapi_inp.f`.
-  #atomic_charges = np.array(gred_words[cursor:cursor+natoms],dtype=float)
+  #atomic_charges = gred_words[cursor:cursor+natoms].copy()
   #cursor += natoms
   #mvlaf = info[55] #???
   ## Skip symmetry information.
@@ -263,6 +323,91 @@ def read_gred(gred="GRED.DAT"):
 
   return info, lat_parm, ions, basis, pseudo
 
+###############################################################################
+# Byte offsets of the eigenvectors in KRED.DAT, saved next to it.
+def index_kred(kred="KRED.DAT"):
+  ''' Find where the header and each eigenvector block of KRED.DAT start.
+
+  The result is saved in a sidecar file (kred+'.idx'), and reused as long as the size and modification
+  time of KRED.DAT are unchanged.
+  Args:
+    kred (str): path to KRED.DAT.
+  Returns:
+    dict: 'header_end' (bytes before the eigenvectors), 'kpt_file_start' (kpt tuple -> list of byte offsets, one per spin).
+  '''
+  stat = os.stat(kred)
+  idxfn = kred+'.idx'
+  if os.path.exists(idxfn):
+    try:
+      with open(idxfn,'r') as inpf:
+        saved = json.load(inpf)
+      if saved['size']==stat.st_size and saved['mtime']==stat.st_mtime:
+        return {
+            'header_end':saved['header_end'],
+            'kpt_file_start':{tuple(kpt):offsets for kpt,offsets in saved['kpt_file_start']}
+          }
+    except (ValueError,KeyError):
+      pass # Corrupted or old index, rebuild it.
+
+  index = scan_kred(kred)
+  try:
+    with open(idxfn,'w') as outf:
+      json.dump({
+          'size':stat.st_size,
+          'mtime':stat.st_mtime,
+          'header_end':index['header_end'],
+          'kpt_file_start':[[list(kpt),offsets] for kpt,offsets in index['kpt_file_start'].items()]
+        },outf)
+  except OSError:
+    print("Warning: couldn't save KRED index %s."%idxfn)
+  return index
+
+###############################################################################
+def scan_kred(kred="KRED.DAT"):
+  ''' Scan KRED.DAT for the start of the eigenvectors. Use index_kred to avoid repeating the scan. 
+  Args:
+    kred (str): path to KRED.DAT.
+  Returns:
+    dict: see index_kred.
+  '''
+  kpt_file_start = {}
+  with open(kred,'rb') as kredf, mmap.mmap(kredf.fileno(),0,access=mmap.ACCESS_READ) as kredm:
+    # Stop at eigenvectors. The word count is to avoid stopping early for gamma-only calculations.
+    nwords = 0
+    prev = 0
+    header_end = None
+    for match in _kred_gamma_line.finditer(kredm):
+      nwords += len(kredm[prev:match.start()].split())
+      prev = match.start()
+      if nwords > 13:
+        header_end = match.start()
+        break
+    if header_end is None:
+      raise AssertionError("Couldn't find the eigenvectors in %s."%kred)
+    kpt_file_start[(0,0,0)] = [match.end()]
+
+    # Each eigenvector block starts after a line with the three k-point coordinates (33 characters).
+    # Line lengths are found from the newline positions, a chunk at a time to bound memory.
+    data = np.frombuffer(kredm,dtype=np.uint8)
+    lastnl = match.end()-1
+    for chunk in range(match.end(),data.size,_kred_chunk):
+      newlines = np.flatnonzero(data[chunk:chunk+_kred_chunk]==ord('\n')) + chunk
+      if newlines.size==0: continue
+      linelens = np.diff(newlines,prepend=lastnl)
+      for nl in newlines[linelens==34]:
+        kpt = tuple([int(i) for i in kredm[nl-33:nl].split()])
+        if kpt in kpt_file_start:
+          kpt_file_start[kpt].append(int(nl)+1)
+        else:
+          kpt_file_start[kpt] = [int(nl)+1]
+      lastnl = newlines[-1]
+    del data # Release the mmap.
+
+  return {'header_end':header_end,'kpt_file_start':kpt_file_start}
+
+_kred_gamma_line = re.compile(rb'^          0          0          0\n',re.M)
+_kred_chunk = 1<<26
+
 ###############################################################################
 # Reads in kpoints and eigen{values,vectors} from KRED.DAT.
 def read_kred(info,basis,kred="KRED.DAT"):
@@ -275,7 +420,6 @@ def read_kred(info,basis,kred="KRED.DAT"):
     eigsys (dict): orbitals from the SCF calculation. 
   '''
 
-  charcount=0
   eigsys = {
       'nkpts_dir':None,
       'recip_vecs':None,
@@ -289,15 +433,11 @@ def read_kred(info,basis,kred="KRED.DAT"):
       'kred':kred
     }
 
-  kred = open(kred)
-  kred_words = []
-  for lin in kred:
-    charcount+=len(lin)
-    # Stop at eigenvectors. The second condition is to avoid stopping early for gamma-only calculations.
-    if lin=='          0          0          0\n' and len(kred_words)>13:
-      break # We'll do the eigenvectors one at a time to save memory.
-    kred_words += lin.split()
-  eigsys['kpt_file_start'][(0,0,0)]=[charcount]
+  # The eigenvectors are looked up one at a time later to save memory, we only note where they are.
+  index = index_kred(kred)
+  eigsys['kpt_file_start'] = index['kpt_file_start']
+  with open(kred,'r') as kredf:
+    kred_words = kredf.read(index['header_end']).split()
 
   cursor = 0
 
@@ -343,17 +483,6 @@ def read_kred(info,basis,kred="KRED.DAT"):
   eigsys['nao'] = sum(basis['nao_shell'])
   eigsys['nbands'] = int(round(nevals / nikpts / eigsys['nspin']))
   
-  # Here we simply mark where the eigenvectors are for later lookup.
-  for line in kred:
-    llen=len(line)
-    charcount+=llen
-    if llen==34:
-      kpt=tuple([int(i) for i in line.split()])
-      if kpt in eigsys['kpt_file_start']:
-        eigsys['kpt_file_start'][kpt].append(charcount)
-      else:
-        eigsys['kpt_file_start'][kpt] = [charcount]
-
   ## It's probably true that kpt_coords == ikpt_coords, with repitition for spin
   ## up and spin down, because we only read in inequivilent kpoints. However,
   ## ordering might be different, and the ordering is correct for kpt_coords.
@@ -379,16 +508,13 @@ def eigvec_lookup(kpt,eigsys,spin=0):
   ncpnts = int(eigsys['nbands']* eigsys['nao'])
   if eigsys['ikpt_iscmpx'][kpt]:
     ncpnts *= 2
-  linesperkpt = ncpnts//4 + int(ncpnts%4>0)
 
-  kredf = open(eigsys['kred'],'r')
-  kredf.seek(eigsys['kpt_file_start'][kpt][spin])
-  eigvec=[]
-  for li,line in enumerate(kredf):
-    if li==linesperkpt: break
-    eigvec+=line.split()
-
-  eigvec = np.array(eigvec,dtype=float)
+  # The block ends at most where the next one starts.
+  start = eigsys['kpt_file_start'][kpt][spin]
+  later = [off for offs in eigsys['kpt_file_start'].values() for off in offs if off > start]
+  with open(eigsys['kred'],'rb') as kredf, mmap.mmap(kredf.fileno(),0,access=mmap.ACCESS_READ) as kredm:
+    end = min(later) if len(later)>0 else len(kredm)
+    eigvec = np.fromstring(kredm[start:end],sep=' ',count=ncpnts)
 
   if eigsys['ikpt_iscmpx'][kpt]:
     eigvec=eigvec.reshape(ncpnts//2,2)
@@ -564,7 +690,6 @@ def normalize_eigvec(eigvec,basis):
       
 ###############################################################################
 def write_orb(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1):
-  outf=open(outfn,'w')
   if maxmo_spin < 0:
     maxmo_spin=basis['nmo']
 
@@ -574,30 +699,40 @@ def write_orb(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1):
   for shidx in range(len(basis['nao_shell'])):
     nao_atom[basis['atom_shell'][shidx]-1] += basis['nao_shell'][shidx]
   #nao_atom = int(round(sum(basis['nao_shell']) / len(ions['positions'])))
-  coef_cnt = 1
   totnmo = maxmo_spin*eigsys['nspin'] #basis['nmo'] * eigsys['nspin']
-  for moidx in np.arange(totnmo)+1:
-    for atidx in atidxs+1:
-      for aoidx in np.arange(nao_atom[atidx-1])+1:
-        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
-            .format(moidx,aoidx,atidx,coef_cnt))
-        coef_cnt += 1
-  eigvec_flat = [e[0:maxmo_spin].flatten() for s in range(eigsys['nspin']) for e in eigvecs[s]]
-  print_cnt = 0
-  outf.write("COEFFICIENTS\n")
+
+  # Index lines: (MO, AO on atom, atom, coefficient number); the AO and atom columns repeat for each MO.
+  atoms = np.repeat(atidxs+1,nao_atom[atidxs])
+  aos = np.concatenate([np.arange(nao_atom[atidx])+1 for atidx in atidxs])
+  index = np.empty((totnmo*aos.size,4),dtype=int)
+  index[:,0] = np.repeat(np.arange(totnmo)+1,aos.size)
+  index[:,1] = np.tile(aos,totnmo)
+  index[:,2] = np.tile(atoms,totnmo)
+  index[:,3] = np.arange(index.shape[0])+1
+
+  eigvec_flat = np.concatenate([eigvecs[s][:,0:maxmo_spin].ravel() for s in range(eigsys['nspin'])])
   if eigsys['ikpt_iscmpx'][kpt]: #complex coefficients
-    for eigv in eigvec_flat: #zip(eigreal_flat,eigimag_flat):
-      for r,i in zip(eigv.real,eigv.imag):
-        outf.write("({:<.12e},{:<.12e}) "\
-            .format(r,i))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
+    coefs = np.empty((eigvec_flat.size,2))
+    coefs[:,0] = eigvec_flat.real
+    coefs[:,1] = eigvec_flat.imag
+    coeffmt = "(%.12e,%.12e) "
   else: #Real coefficients
-    for eigr in eigvec_flat:
-      for r in eigr:
-        outf.write("{:< 15.12e} ".format(r))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
+    coefs = eigvec_flat.real.reshape(-1,1)
+    coeffmt = "%- 15.12e "
+
+  with open(outfn,'w') as outf:
+    _write_rows(outf," %5d %5d %5d %5d\n",index)
+    outf.write("COEFFICIENTS\n")
+    # Five coefficients per line.
+    nfull = coefs.shape[0]//5
+    _write_rows(outf,coeffmt*5+"\n",coefs[:nfull*5].reshape(-1,5*coefs.shape[1]))
+    _write_rows(outf,coeffmt*(coefs.shape[0]-nfull*5),coefs[nfull*5:].reshape(1,-1))
+
+def _write_rows(outf,rowfmt,table,chunk=4096):
+  ''' Write each row of a 2D array with the printf-style format rowfmt, many rows per write.'''
+  for start in range(0,table.shape[0],chunk):
+    rows = table[start:start+chunk]
+    outf.write((rowfmt*rows.shape[0])%tuple(rows.ravel().tolist()))
 
 ###############################################################################
 # TODO Generalize to no pseudopotential.
@@ -827,7 +962,12 @@ if __name__ == "__main__":
       help="[=False] Convert only real kpoints.")
   parser.add_argument('-v','--nvirtual',type=int,default=50,
       help="[=50] Number of unoccupied or virtual orbitals to allow access to.")
+  parser.add_argument('-n','--nproc',type=int,default=1,
+      help="[=1] Number of processes converting k-points in parallel.")
+  parser.add_argument('-f','--files',type=str,default=None,
+      help="[=None] Save the names of the files produced to this JSON file (see load_files).")
   args=parser.parse_args()
 
-  convert_crystal(args.base,args.propout,args.kset,args.nvirtual)
-
+  files=convert_crystal(args.base,args.propout,args.real,args.nvirtual,nproc=args.nproc)
+  if args.files is not None:
+    save_files(files,args.files)
@@ -1,10 +1,11 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, load_state, save_state, state_exists, link_file, prune_backups
 from crystal import CrystalReader
 from propertiesreader import PropertiesReader
-from autorunner import RunnerPBS
+from autorunner import RunnerPBS, RunnerLocal
 import os
-import pickle as pkl
-import shutil as sh
+import sys
+import time
+from copy import deepcopy
 import crystal2qmc
 from autopaths import paths
 
@@ -13,7 +14,7 @@ class CrystalManager:
   Has authority over file names associated with this task."""
   def __init__(self,writer,runner,creader=None,name='crystal_run',path=None,
       preader=None,prunner=None,
-      trylev=False,bundle=False,max_restarts=2):
+      trylev=False,bundle=False,max_restarts=2,watch=True,pipeline=False,nproc=1,keep_backups=None):
     ''' CrystalManager manages the writing of a Crystal input file, it's running, and keeping track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -26,6 +27,14 @@ class CrystalManager:
       trylev (bool): When restarting use LEVSHIFT option to encourage convergence, then do a rerun without LEVSHIFT.
       bundle (bool): Whether you'll use a bundling tool to run these jobs.
       max_restarts (int): maximum number of times you'll allow restarting before giving up (and manually intervening).
+      watch (bool): While CRYSTAL runs, check its SCF on every step and cancel and restart it as soon as it
+        fails the reader's heuristics (see CrystalReader.check_outputfile). Only done with trylev, since otherwise
+        the restart would repeat the same run, and not for bundled jobs or in scratch (runner.scratch), where the 
+        output is only copied back at the end.
+      pipeline (bool): Run properties and the QWalk conversion in the same job as CRYSTAL, right after a converged SCF,
+        instead of in later jobs (prunner isn't used).
+      nproc (int): processes for converting k-points to QWalk (see crystal2qmc.convert_crystal).
+      keep_backups (int): keep the numbered input, output and fort.79 backups of only this many restarts (None keeps all).
     '''
     # Where to save self.
     self.name=name
@@ -57,11 +66,19 @@ class CrystalManager:
     self.propinpfn=self.name+'.prop'
     self.crysoutfn=self.crysinpfn+'.o'
     self.propoutfn=self.propinpfn+'.o'
+    self.filesfn=self.name+'.qwfiles.json'
+    # Copied back if the runners run in node-local scratch.
+    for run in (self.runner,self.prunner):
+      if hasattr(run,'stage'):
+        run.stage([self.crysoutfn,self.propoutfn,'fort.9','fort.79','fort.98','GRED.DAT','KRED.DAT',
+            self.filesfn,self.name+'.basis',self.name+'.jast2',self.name+'_[0-9]*'])
     self.restarts=0
+    self.queued=None # When CRYSTAL was last queued, so an older output isn't watched.
     self.completed=False
     self.bundle=bundle
     self.qwfiles={ 
         'kpoints':[],
+        'kweights':{},
         'basis':'',
         'jastrow2':'',
         'orbplot':{},
@@ -75,17 +92,20 @@ class CrystalManager:
     self.max_restarts=max_restarts
     self.savebroy=[]
     self.lev=False
+    self.watch=watch
+    self.pipeline=pipeline
+    self.nproc=nproc
+    self.keep_backups=keep_backups
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    if state_exists(self.path+self.pickle):
       #print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=load_state(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #------------------------------------------------
   def recover(self,other):
@@ -96,20 +116,20 @@ class CrystalManager:
     update_attributes(copyto=self,copyfrom=other,
         skip_keys=['writer','runner','creader','preader','prunner','lev','savebroy',
                    'path','logname','name',
-                   'trylev','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles','bundle_ready','scriptfile'])
+                   'trylev','max_restarts','bundle','watch','pipeline','nproc','keep_backups'],
+        take_keys=['restarts','completed','qwfiles','bundle_ready','scriptfile','queued'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname','mode','account','prefix','postfix'],
+        skip_keys=['queue','walltime','np','nn','jobname','exitcodes','mode','account','prefix','postfix','scratch','outputs'],
         take_keys=['queueid'])
     update_attributes(copyto=self.prunner,copyfrom=other.prunner,
-        skip_keys=['queue','walltime','np','nn','jobname','mode','account','prefix','postfix'],
+        skip_keys=['queue','walltime','np','nn','jobname','exitcodes','mode','account','prefix','postfix','scratch','outputs'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.creader,copyfrom=other.creader,
         skip_keys=[],
-        take_keys=['completed','output'])
+        take_keys=['completed','output','scan'])
 
     update_attributes(copyto=self.preader,copyfrom=other.preader,
         skip_keys=[],
@@ -124,54 +144,33 @@ class CrystalManager:
   #----------------------------------------
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
 
     # Generate input files.
     if not self.writer.completed:
       if self.writer.guess_fort is not None:
-        sh.copy(self.writer.guess_fort,'fort.20')
-      with open(self.crysinpfn,'w') as f:
-        self.writer.write_crys_input(self.crysinpfn)
-      with open(self.propinpfn,'w') as f:
-        self.writer.write_prop_input(self.propinpfn)
+        link_file(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.20')
+      self.writer.write_crys_input(self.path+self.crysinpfn)
+      self.writer.write_prop_input(self.path+self.propinpfn)
 
     # Check on the CRYSTAL run
-    status=resolve_status(self.runner,self.creader,self.crysoutfn)
+    status=resolve_status(self.runner,self.creader,self.path+self.crysoutfn,task=(self.path,self.name))
     print(self.logname,": status= %s"%(status))
 
     if status=="not_started":
-      self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+      self._queue_crystal()
+
+    elif status=="running" and self.watch and self.trylev and getattr(self.runner,'scratch',None) is None:
+      self.watch_scf()
 
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
-      status=self.creader.collect(self.crysoutfn)
+      status=self.creader.collect(self.path+self.crysoutfn)
       print(self.logname,": status %s"%status)
       if status=='killed':
-        if self.restarts >= self.max_restarts:
-          print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
-        else:
-          print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-          self.writer.restart=True
-          if self.trylev:
-            print(self.logname,": trying LEVSHIFT.")
-            self.writer.levshift=[10,1] # No mercy.
-            self.savebroy=deepcopy(self.writer.broyden)
-            self.writer.broyden=[]
-            self.lev=True
-          sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-          sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-          sh.copy('fort.79',"%d.fort.79"%(self.restarts))
-          self.writer.guess_fort='./fort.79'
-          sh.copy(self.writer.guess_fort,'fort.20')
-          self.writer.write_crys_input(self.crysinpfn)
-          self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-          self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
-          self.restarts+=1
+        self._restart()
     elif status=='done' and self.lev:
       # We used levshift to converge. Now let's restart to be sure.
       print("Recovering from LEVSHIFTer.")
@@ -179,26 +178,130 @@ class CrystalManager:
       self.writer.levshift=[]
       self.creader.completed=False
       self.lev=False
-      sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-      sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-      sh.copy('fort.79',"%d.fort.79"%(self.restarts))
-      self.writer.guess_fort='./fort.79'
-      sh.copy(self.writer.guess_fort,'fort.20')
-      self.writer.write_crys_input(self.crysinpfn)
-      sh.copy(self.crysinpfn,'INPUT')
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+      self._backup()
+      self.writer.write_crys_input(self.path+self.crysinpfn)
+      self._queue_crystal()
       self.restarts+=1
 
     # Ready for bundler or else just submit the jobs as needed.
     if not self.bundle:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,loc=self.path)
 
     self.completed=self.creader.completed
+    if self.completed and self.pipeline and not self.lev and len(self.qwfiles['slater'])==0:
+      self._collect_pipeline()
 
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    save_state(self.path+self.pickle,self)
+
+  #----------------------------------------
+  def _queue_crystal(self):
+    ''' Add the CRYSTAL run to the runner, followed by properties and the conversion in pipeline mode.'''
+    self.queued=time.time()
+    self.runner.add_command("cp %s INPUT"%self.crysinpfn)
+    self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+    if self.pipeline:
+      # Results of an earlier run mustn't be mistaken for this one's.
+      for fn in [self.filesfn,self.propoutfn]:
+        if os.path.exists(self.path+fn): os.remove(self.path+fn)
+      # Only if the SCF converged. Job scripts may hold other runs (bundles), so this mustn't exit the script;
+      # RunnerLocal runs each line on its own and stops at the first that fails.
+      converged="grep -q 'SCF ENDED - CONVERGENCE' %s"%self.crysoutfn
+      local=isinstance(self.runner,RunnerLocal)
+      self.runner.add_command(converged if local else "if %s; then"%converged)
+      self.runner.add_command("cp %s INPUT"%self.propinpfn)
+      self.runner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
+      self.runner.add_command("%s %s -b %s -p %s -n %d -f %s"%(
+        sys.executable,os.path.abspath(crystal2qmc.__file__),self.name,self.propoutfn,self.nproc,self.filesfn))
+      if not local:
+        self.runner.add_command("fi")
+
+  #----------------------------------------
+  def _collect_pipeline(self):
+    ''' Pick up the properties and conversion results of a pipeline job, if it got that far.
+    Returns:
+      bool: whether the QWalk files are ready.
+    '''
+    if not os.path.exists(self.path+self.filesfn):
+      return False
+    self.preader.collect(self.path+self.propoutfn)
+    if self.preader.completed:
+      self.qwfiles=crystal2qmc.load_files(self.path+self.filesfn)
+    return self.preader.completed
+
+  #----------------------------------------
+  def watch_scf(self):
+    ''' Check the SCF of the running CRYSTAL job (reading only the output added since the last check).
+    If it is diverging or not converging (see CrystalReader.check_outputfile), cancel the job and restart right away.
+    Only restarts that change the run (adding LEVSHIFT) are worth cancelling for, so nothing is done once LEVSHIFT
+    is on. Outputs older than the last submission are left alone, since the job hasn't started writing yet.
+    Returns:
+      str: the SCF status, or None if the output wasn't checked.
+    '''
+    outfn=self.path+self.crysoutfn
+    if self.lev or not os.path.exists(outfn) or self.queued is None or os.path.getmtime(outfn)<self.queued:
+      return None
+    scf=self.creader.check_outputfile(outfn)
+    if scf in ('divergence','not_enough_decrease','stalled'):
+      if self.bundle:
+        print(self.logname,": SCF %s, but the job is bundled with others; not cancelling it."%scf)
+      else:
+        print(self.logname,": SCF %s, cancelling the job."%scf)
+        self.runner.cancel()
+        self._restart(diverged=True)
+    return scf
+
+  #----------------------------------------
+  def _restart(self,diverged=False):
+    ''' Set up and queue a rerun of CRYSTAL, with LEVSHIFT if trylev. 
+    Args:
+      diverged (bool): the run was stopped because its SCF went bad, so don't start from its wave function.
+    '''
+    if self.restarts >= self.max_restarts:
+      print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
+      return
+    print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
+    self.writer.restart=True
+    if self.trylev:
+      print(self.logname,": trying LEVSHIFT.")
+      self.writer.levshift=[10,1] # No mercy.
+      self.savebroy=deepcopy(self.writer.broyden)
+      self.writer.broyden=[]
+      self.lev=True
+    self._backup(keep_wf=not diverged)
+    if self.writer.guess_fort is None:
+      self.writer.restart=False
+    self.writer.write_crys_input(self.path+self.crysinpfn)
+    self._queue_crystal()
+    self.restarts+=1
+
+  #----------------------------------------
+  def _backup(self,keep_wf=True):
+    ''' Keep the input and output of the last run as [restarts].[file] and set up fort.20 for the next run.
+    The output and wave functions are moved, so the old output isn't read as the next run's, and wave functions are 
+    linked instead of copied (see link_file); old backups are pruned to keep_backups.
+    Args:
+      keep_wf (bool): the last run's fort.79 becomes the guess. Otherwise the guess stays the one the last run 
+        started from.
+    '''
+    n=self.restarts
+    # Rewritten in place by the next run, so never hard linked.
+    link_file(self.path+self.crysinpfn,self.path+"%d.%s"%(n,self.crysinpfn),hardlink=False)
+    if os.path.exists(self.path+self.crysoutfn):
+      os.replace(self.path+self.crysoutfn,self.path+"%d.%s"%(n,self.crysoutfn))
+    self.creader.scan=None
+    if keep_wf:
+      # The next run writes a new fort.79, so the backup is the old file itself.
+      os.replace(self.path+'fort.79',self.path+"%d.fort.79"%n)
+      self.writer.guess_fort="./%d.fort.79"%n
+    elif self.writer.guess_fort=='./fort.79':
+      # Go back to the wave function the bad run started from.
+      self.writer.guess_fort="./%d.fort.79"%(n-1) if n>0 else None
+    protect=[]
+    if self.writer.guess_fort is not None:
+      protect.append(os.path.join(self.path,self.writer.guess_fort))
+      link_file(protect[0],self.path+'fort.20')
+    prune_backups(self.path,[self.crysinpfn,self.crysoutfn,'fort.79'],self.keep_backups,n,protect)
 
   #----------------------------------------
   def collect(self):
@@ -211,7 +314,7 @@ class CrystalManager:
   #----------------------------------------
   def submit(self):
     ''' Submit any work and update the manager.'''
-    qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+    qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,loc=self.path)
 
     self.update_pickle()
 
@@ -237,8 +340,7 @@ class CrystalManager:
   #------------------------------------------------
   def update_pickle(self):
     ''' If you make direct changes to the internals of the pickle, you need to call this to insure they are saved.'''
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #----------------------------------------
   def write_summary(self):
@@ -249,7 +351,7 @@ class CrystalManager:
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     ready=False
     if len(self.qwfiles['slater'])==0:
@@ -258,13 +360,13 @@ class CrystalManager:
       if not self.completed:
         return False
 
-      cwd=os.getcwd()
-      os.chdir(self.path)
-
       print(self.logname,": %s attempting to generate QWalk files."%self.name)
+      if self.pipeline and self._collect_pipeline():
+        self.update_pickle()
+        return True
 
       # Check on the properties run
-      status=resolve_status(self.prunner,self.preader,self.propoutfn)
+      status=resolve_status(self.prunner,self.preader,self.path+self.propoutfn,task=(self.path,self.name))
       print(self.logname,": properties status= %s"%(status))
       if status=='not_started':
         ready=False
@@ -272,19 +374,18 @@ class CrystalManager:
         self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
 
         if not self.bundle:
-          qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+          qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,loc=self.path)
       elif status=='ready_for_analysis':
-        self.preader.collect(self.propoutfn)
+        self.preader.collect(self.path+self.propoutfn)
 
       if self.preader.completed:
         ready=True
         print(self.logname,": converting crystal to QWalk input now.")
-        self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.propoutfn)
+        self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.propoutfn,path=self.path,nproc=self.nproc)
       else:
         ready=False
         print(self.logname,": conversion postponed because properties is not finished.")
 
-      os.chdir(cwd)
     else:
       ready=True
 
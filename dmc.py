@@ -15,6 +15,8 @@ class DMCWriter:
         extra_observables (list): see `average_tools.py` for how to use this.
         minblocks (int): minimum number of DMC steps to take, considering equillibration time.
         iterations (int): number of DMC steps to attempt.
+        storeconfig (bool): save the walkers at the end of the run ([infile].config), so the run can be continued.
+        readconfig (str): start from walkers saved by a previous run instead of equilibrating from scratch.
     '''
     self.trialfunc=''
     self.errtol=0.1
@@ -23,6 +25,8 @@ class DMCWriter:
     self.timestep=0.01
     self.tmoves=True
     self.savetrace=True
+    self.storeconfig=True
+    self.readconfig=''
     self.extra_observables=[]
 
     self.qmc_abr='dmc'
@@ -58,8 +62,12 @@ class DMCWriter:
       if self.tmoves:
         outlines+=['tmoves']
       if self.savetrace:
-        tracename = "%s.trace"%infile
+        tracename = "%s.trace"%os.path.basename(infile)
         outlines+=['save_trace %s'%tracename]
+      if self.storeconfig:
+        outlines+=['storeconfig %s.config'%os.path.basename(infile)]
+      if self.readconfig!='':
+        outlines+=['readconfig %s'%self.readconfig]
       for avg_opts in self.extra_observables:
         outlines+=avg.average_section(avg_opts)
       outlines+=["}"]
@@ -74,6 +82,8 @@ class DMCWriter:
 ####################################################
 import subprocess as sub
 import json
+import numpy as np
+import qwalklog
 class DMCReader:
   ''' Reads results from a DMC calculation. 
 
@@ -87,15 +97,27 @@ class DMCReader:
 
     self.errtol=errtol
     self.minblocks=minblocks
-    self.gosling="gosling"
+    self.gosling=None # Set to the gosling executable to read the results with gosling instead of qwalklog.
+    self.logstate={} # Blocks read so far by qwalklog, for each log file (also kept with gosling, to plan restarts).
 
   def read_outputfile(self,outfile):
     ''' Read output file results.
 
     Args:
-      outfile (str): output to read.
+      outfile (str or list): output to read. Several outputs are treated as independent runs of the same calculation.
     '''
-    return json.loads(sub.check_output([self.gosling,"-json",outfile.replace('.o','.log')]).decode())
+    outfiles=[outfile] if type(outfile)==str else outfile
+    logfiles=[os.path.splitext(f)[0]+'.log' for f in outfiles]
+    # Only blocks added since the last collect are parsed.
+    states=[]
+    for logfile in logfiles:
+      if not os.path.exists(logfile): continue
+      key=os.path.abspath(logfile)
+      self.logstate[key]=qwalklog.read_log(logfile,self.logstate.get(key))
+      states.append(self.logstate[key])
+    if self.gosling is not None:
+      return json.loads(sub.check_output([self.gosling,"-json"]+logfiles).decode())
+    return qwalklog.summarize_runs(states)
 
   def check_complete(self):
     ''' Check if a DMC run is complete.
@@ -105,7 +127,10 @@ class DMCReader:
     completed=True
     if len(self.output)==0:
       return False # No results yet.
-    if self.output['properties']['total_energy']['error'][0] > self.errtol:
+    if 'total_energy' not in self.output['properties']:
+      print("DMC incomplete: no energy has been recorded yet.")
+      return False
+    if not self.output['properties']['total_energy']['error'][0] <= self.errtol: # Also catches nan (too few blocks).
       print("DMC incomplete: (%f) does not meet tolerance (%f)"%\
           (self.output['properties']['total_energy']['error'][0],self.errtol))
       completed=False
@@ -120,14 +145,14 @@ class DMCReader:
     ''' Collect results for an output file and resolve if the run needs to be resumed. 
 
     Args: 
-      outfiles (list): list of output file names to open and read.
+      outfile (str or list): output file name(s) to open and read (see read_outputfile).
     Returns:
       str: status of run = {'ok','restart'}
     '''
     # Gather output from files.
     self.completed=True
     status='unknown'
-    if os.path.exists(outfile):
+    if os.path.exists(outfile if type(outfile)==str else outfile[0]):
       self.output=self.read_outputfile(outfile)
       self.output['file']=outfile
 
@@ -145,3 +170,61 @@ class DMCReader:
     print("#### Diffusion Monte Carlo")
     for f,out in self.output.items():
       print(f,out)
+
+####################################################
+def plan_nblock(states,errtol,minblocks=10,sec_per_block=None,walltime=None,maxruns=8,safety=1.1,energy='total_energy',
+    rewarm=True):
+  ''' Plan the DMC blocks still needed to reach errtol, from the runs so far.
+
+  The error is fit as err ~ N^b over post-warmup prefixes of the blocks collected (b=-1/2 for blocks uncorrelated
+  beyond the autocorrelation time the reblocking finds). With too few blocks to fit, b=-1/2 is used.
+  New runs from scratch repeat the warmup of the runs so far; runs continued from saved walkers don't (rewarm=False).
+  Args:
+    states (list): qwalklog states of the runs so far (see DMCReader.logstate).
+    errtol (float): target error of the energy.
+    minblocks (int): fewest post-warmup blocks to request.
+    sec_per_block (float): time per block, if known.
+    walltime (float): seconds available to each run. If the blocks don't fit, they are split into several runs.
+    maxruns (int): most runs to split into.
+    safety (float): factor on the predicted number of blocks.
+    energy (str): property whose error is targeted.
+    rewarm (bool): whether the new runs need to equilibrate.
+  Returns:
+    dict: 'nblock' (blocks per run), 'nruns', 'needed' (post-warmup blocks still needed), 'slope' (b). None if there's no energy data.
+  '''
+  states=[s for s in states if energy in s['blocks'] and s['weights'].size>0]
+  if len(states)==0:
+    return None
+  warmups=[qwalklog.detect_warmup(s['blocks'][energy][:,0]) for s in states]
+  merged=qwalklog.merge_states(states,warmups)
+  data=merged['blocks'][energy][:,0]
+  weights=merged['weights']
+  nblocks=data.size
+  warmup=max(warmups) if rewarm else 0
+
+  slope=-0.5
+  sizes=[nblocks*k//4 for k in (1,2,3,4) if nblocks*k//4>=8]
+  if len(sizes)>=3:
+    errors=np.array([qwalklog.reblock(data[:n],weights[:n])[1] for n in sizes])
+    if np.all(errors>0):
+      # Scaling faster than 1/N or slower than N^-1/4 is noise in the fit.
+      slope=min(-0.25,max(-1.0,float(np.polyfit(np.log(sizes),np.log(errors),1)[0])))
+  error=qwalklog.reblock(data,weights)[1] if nblocks>=2 else np.nan
+
+  if not error>errtol: # Also nan: too few blocks for an error.
+    needed=max(minblocks-nblocks,minblocks if nblocks<2 else 0)
+  else:
+    total=nblocks*(errtol/error)**(1./slope)
+    needed=max(int(np.ceil(safety*total))-nblocks,minblocks)
+
+  nruns=1
+  nblock=needed+warmup
+  if sec_per_block is not None and walltime is not None and sec_per_block>0:
+    maxblock=int(walltime/sec_per_block)
+    if nblock>maxblock:
+      if maxblock<=warmup:
+        print("plan_nblock: warning, a run of %d blocks doesn't fit in the walltime even without the warmup."%(warmup+1))
+        maxblock=warmup+1
+      nruns=min(maxruns,int(np.ceil(needed/float(maxblock-warmup))))
+      nblock=min(maxblock,int(np.ceil(needed/float(nruns)))+warmup)
+  return {'nblock':nblock,'nruns':nruns,'needed':needed,'slope':slope}
@@ -1,7 +1,20 @@
 import numpy as np
 import os 
+import pickle as pkl
+import shutil
+import statestore
+import taskfarm
+try:
+  import fcntl
+except ImportError:
+  fcntl=None
 
-def resolve_status(runner,reader,outfile):
+def resolve_status(runner,reader,outfile,task=None):
+  ''' Status of a manager's run: 'done', 'running', 'failed', 'not_started' or 'ready_for_analysis'.
+  Args:
+    task (tuple): (loc, name) of the run in a task farm (see taskfarm.task_record), if it may have run in one. 
+      A farmed run that exited with an error is 'failed', so it's reported instead of being run again.
+  '''
   #Check if the reader is done
   if reader.completed:
     return 'done'
@@ -10,6 +23,14 @@ def resolve_status(runner,reader,outfile):
   currstat=runner.check_status()
   if currstat=='running':
     return currstat
+
+  if task is not None:
+    record=taskfarm.task_record(*task)
+    if record is not None and record['state']=='failed':
+      taskout=os.path.join(task[0],task[1]+'.task.out')
+      print("Task %s failed in the task farm with exit code %s (see %s). Remove %s to run it again."%\
+          (task[1],record['exitcode'],taskout,os.path.join(task[0],task[1]+'.task.json')))
+      return 'failed'
   
   #Now we are in a state where either there was an error,
   #the job hasn't been run, or we haven't collected the results
@@ -19,6 +40,100 @@ def resolve_status(runner,reader,outfile):
   #We are in an error state or we haven't collected the results. 
   return "ready_for_analysis"
 
+######################################################################
+def state_exists(fn):
+  ''' Whether a manager has been saved to pickle file fn (or under fn in the active state store).'''
+  store=statestore.active_store()
+  if store is not None and store.exists(fn):
+    return True
+  return os.path.exists(fn)
+
+######################################################################
+def load_state(fn):
+  ''' Load a saved manager. Uses the active state store (see statestore.py) if there is one, and otherwise 
+  (or if the store doesn't have it yet) the pickle file fn.'''
+  store=statestore.active_store()
+  if store is not None:
+    obj=store.load(fn)
+    if obj is not None:
+      return obj
+  with open(fn,'rb') as inpf:
+    return pkl.load(inpf)
+
+######################################################################
+def save_state(fn,obj):
+  ''' Save a manager to the active state store, or to the pickle file fn if there is no store.'''
+  store=statestore.active_store()
+  if store is not None:
+    store.save(fn,obj)
+  else:
+    save_pickle(fn,obj)
+
+######################################################################
+def save_pickle(fn,obj):
+  ''' Save a manager to the pickle file fn, even if a state store is active. 
+  For jobs that load managers on the compute nodes, where the store shouldn't be opened.'''
+  with open(fn,'wb') as outf:
+    pkl.dump(obj,outf)
+
+######################################################################
+_FICLONE=0x40049409 # Linux ioctl cloning a file's extents (reflink).
+
+def link_file(src,dst,hardlink=True):
+  ''' Give dst the contents of src, without copying the data where the file system allows.
+  Tries a reflink (copy-on-write clone, e.g. btrfs, XFS), then a hard link, then falls back to a copy.
+  An existing dst is removed first, so it is never written through.
+
+  A hard link shares the data with src: only use it if neither file will be rewritten in place. 
+  Files that will be (e.g. the wave function the next run overwrites) can be moved aside with os.replace first.
+  Args:
+    src (str): file to copy.
+    dst (str): new file.
+    hardlink (bool): allow a hard link.
+  Returns:
+    str: 'reflink', 'hardlink' or 'copy'.
+  '''
+  if os.path.lexists(dst):
+    os.remove(dst)
+  if fcntl is not None:
+    try:
+      with open(src,'rb') as inpf, open(dst,'wb') as outf:
+        fcntl.ioctl(outf.fileno(),_FICLONE,inpf.fileno())
+      shutil.copymode(src,dst)
+      return 'reflink'
+    except (IOError,OSError):
+      if os.path.lexists(dst):
+        os.remove(dst)
+      if not os.path.exists(src):
+        raise # Nothing to link; the other ways would fail the same way.
+  if hardlink:
+    try:
+      os.link(src,dst)
+      return 'hardlink'
+    except OSError:
+      pass
+  shutil.copy(src,dst)
+  return 'copy'
+
+######################################################################
+def prune_backups(path,names,keep,current,protect=()):
+  ''' Remove numbered restart backups ([i].[name]) older than the last keep restarts.
+  Args:
+    path (str): directory of the backups.
+    names (list): file names that are backed up at each restart.
+    keep (int): number of restarts to keep backups of. None keeps all.
+    current (int): number of the latest backup.
+    protect (list): paths never to remove (e.g. the current guess).
+  '''
+  if keep is None:
+    return
+  protect=[os.path.abspath(fn) for fn in protect]
+  for idx in range(current-keep+1):
+    for name in names:
+      fn=os.path.join(path,"%d.%s"%(idx,name))
+      if os.path.exists(fn) and os.path.abspath(fn) not in protect:
+        os.remove(fn)
+
 ######################################################################
 def deep_compare(d1,d2):
   '''I have to redo dict comparison because numpy will return a bool array when comparing.'''
@@ -88,3 +203,28 @@ def separate_jastrow(wffile,optimizebasis=False):
     if in_jastrow and nopen >= nclose:
       jastlines.append(line)
   return '\n'.join(jastlines)
+
+######################################################################
+def advance_all(managers,workers=8):
+  ''' Call nextstep() on many managers at once using a thread pool.
+
+  Managers work with explicit paths instead of changing directory, so they can be advanced side by side.
+  The managers passed here should be independent of each other: a manager whose trial function comes from 
+  another manager in the list may find it unfinished and export it at the same time. 
+
+  Args:
+    managers (list): managers to advance.
+    workers (int): number of threads. Most of the time is spent on qstat, file reading and submission, so this can exceed the number of cores.
+  Returns:
+    list: the exceptions raised by each manager (None if it advanced without error).
+  '''
+  from concurrent.futures import ThreadPoolExecutor
+  def _advance(mgr):
+    try:
+      mgr.nextstep()
+    except Exception as err:
+      print("%s: nextstep failed: %s"%(getattr(mgr,'logname',mgr),err))
+      return err
+    return None
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(_advance,managers))
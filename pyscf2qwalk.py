@@ -4,6 +4,7 @@ from pyscf import gto,fci, mcscf, scf,pbc
 import math
 import cmath
 import json 
+import os
 ###########################################################
 def find_label(sph_label):
   data = sph_label.split( )
@@ -500,8 +501,9 @@ def print_jastrow(mol,jastfile,optbasis=True,threebody=False):
 
 ###########################################################
 
-def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw'):
+def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw', path=''):
   # Some are one-element lists to be compatible with PBC routines.
+  # File names are relative to path, which is where they are written.
   files={
       'basis':basename+".basis",
       'jastrow2':basename+".jast2",
@@ -511,25 +513,25 @@ def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw'):
       'orb':[basename+".orb"]
     }
 
-  print_orb(mol,mf,open(files['orb'][0],'w'))
-  print_basis(mol,open(files['basis'],'w'))
-  print_sys(mol,open(files['sys'][0],'w'))
-  print_jastrow(mol,open(files['jastrow2'],'w'))
-  print_jastrow(mol,open(files['jastrow3'],'w'),threebody=True)
+  print_orb(mol,mf,open(os.path.join(path,files['orb'][0]),'w'))
+  print_basis(mol,open(os.path.join(path,files['basis']),'w'))
+  print_sys(mol,open(os.path.join(path,files['sys'][0]),'w'))
+  print_jastrow(mol,open(os.path.join(path,files['jastrow2']),'w'))
+  print_jastrow(mol,open(os.path.join(path,files['jastrow3']),'w'),threebody=True)
 
   if method == 'scf':
-    print_slater(mol,mf,files['orb'][0],files['basis'],open(files['slater'][0],'w'))
+    print_slater(mol,mf,files['orb'][0],files['basis'],open(os.path.join(path,files['slater'][0]),'w'))
   elif method == 'mcscf':
     files['ci']=basename+".ci.json"
-    print_cas_slater(mf,files['orb'][0], files['basis'],open(files['slater'][0],'w'), 
-                     tol,open(files['ci'],'w'))
+    print_cas_slater(mf,files['orb'][0], files['basis'],open(os.path.join(path,files['slater'][0]),'w'), 
+                     tol,open(os.path.join(path,files['ci']),'w'))
   else:
     raise NotImplementedError("Conversion not available yet.")
 
   return files
 ###########################################################
 
-def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw'):
+def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw',path=''):
   files={
       'basis':basename+".basis",
       'jastrow2':basename+".jast2",
@@ -538,31 +540,33 @@ def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw'):
       'slater':["%s_%i.slater"%(basename,nk) for nk in range(mf.kpts.shape[0])]
     }
 
-  print_basis(cell,open(files['basis'],'w'))
-  print_jastrow(cell,open(files['jastrow2'],'w'))
+  print_basis(cell,open(os.path.join(path,files['basis']),'w'))
+  print_jastrow(cell,open(os.path.join(path,files['jastrow2']),'w'))
   
   kpoints=cell.get_scaled_kpts(mf.kpts)
   for i in range(mf.kpts.shape[0]):
     print_slater(cell,mf,files['orb'][i],files['basis'],
-                 open(files['slater'][i],'w'),k=i)
-    print_sys(cell,open(files['sys'][i],'w'),kpoint=2.*kpoints[i,:])
-    print_orb(cell,mf,open(files['orb'][i],'w'),k=i)
+                 open(os.path.join(path,files['slater'][i]),'w'),k=i)
+    print_sys(cell,open(os.path.join(path,files['sys'][i]),'w'),kpoint=2.*kpoints[i,:])
+    print_orb(cell,mf,open(os.path.join(path,files['orb'][i]),'w'),k=i)
 
   return files
   
 ###########################################################
 
-def print_qwalk(mol,mf,method='scf',tol=0.01,basename='qw'):
-  ''' Convenience function for converting any PySCF object. '''
+def print_qwalk(mol,mf,method='scf',tol=0.01,basename='qw',path=''):
+  ''' Convenience function for converting any PySCF object. 
+  Files are written into directory path, and the returned names are relative to it.'''
   if isinstance(mol,pbc.gto.Cell):
-    return print_qwalk_pbc(mol,mf,method,tol,basename)
+    return print_qwalk_pbc(mol,mf,method,tol,basename,path)
   else:
-    return print_qwalk_mol(mol,mf,method,tol,basename)
+    return print_qwalk_mol(mol,mf,method,tol,basename,path)
   
 ###########################################################
 
-def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw'):
-  ''' Convenience function for converting using only the chkfile.'''
+def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw',path=''):
+  ''' Convenience function for converting using only the chkfile.
+  Files are written into directory path, and the returned names are relative to it.'''
   from pyscf import lib
   import pyscf
 
@@ -578,7 +582,7 @@ def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw'):
       self.__dict__=lib.chkfile.load(chkfile,'scf')
 
   mf=FakeMF(chkfile)  
-  return print_qwalk(mol,mf,basename=basename)
+  return print_qwalk(mol,mf,basename=basename,path=path)
   
 ###########################################################
 
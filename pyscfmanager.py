@@ -1,9 +1,7 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, load_state, save_state, state_exists, link_file
 from autopyscf import PySCFReader,dm_from_chkfile
 from autorunner import PySCFRunnerPBS
 import os
-import shutil as sh 
-import pickle as pkl
 import pyscf2qwalk
 from autopaths import paths
 
@@ -56,15 +54,14 @@ class PySCFManager:
     self.restarts=0
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    if state_exists(self.path+self.pickle):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=load_state(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #------------------------------------------------
   def recover(self,other):
@@ -76,7 +73,7 @@ class PySCFManager:
         take_keys=['restarts','completed','qwfiles'])
 
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','exitcodes'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
@@ -88,37 +85,37 @@ class PySCFManager:
         take_keys=['completed','dm_generator'])
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
     
   #------------------------------------------------
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
 
     if not self.writer.completed:
-      self.writer.pyscf_input(self.driverfn,self.chkfile)
+      self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,task=(self.path,self.name))
     print(self.logname,": %s status= %s"%(self.name,status))
 
     if status=="not_started":
       self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile))
     elif status=="ready_for_analysis":
-      status=self.reader.collect(self.outfile,self.chkfile)
+      status=self.reader.collect(self.path+self.outfile,self.path+self.chkfile)
       if status=='killed':
         print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-        sh.copy(self.driverfn,"%d.%s"%(self.restarts,self.driverfn))
-        sh.copy(self.outfile,"%d.%s"%(self.restarts,self.outfile))
-        sh.copy(self.chkfile,"%d.%s"%(self.restarts,self.chkfile))
-        if os.path.exists(self.chkfile):
+        # Rewritten in place by the next run, so never hard linked.
+        link_file(self.path+self.driverfn,self.path+"%d.%s"%(self.restarts,self.driverfn),hardlink=False)
+        link_file(self.path+self.outfile,self.path+"%d.%s"%(self.restarts,self.outfile),hardlink=False)
+        # The next run starts from the backup and writes a new chkfile, so the old one is just moved.
+        if os.path.exists(self.path+self.chkfile):
+          os.replace(self.path+self.chkfile,self.path+"%d.%s"%(self.restarts,self.chkfile))
+        if os.path.exists(self.path+"%d.%s"%(self.restarts,self.chkfile)):
           self.writer.dm_generator=dm_from_chkfile("%d.%s"%(self.restarts,self.chkfile))
-        self.writer.pyscf_input(self.driverfn,self.chkfile)
+        self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
         self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile))
         self.restarts+=1
       elif status=='done':
@@ -127,23 +124,20 @@ class PySCFManager:
     # Ready for bundler or else just submit the jobs as needed.
     if self.bundle:
       self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile,self.driverfn)
+      self.bundle_ready=self.runner.script(self.path+self.scriptfile,self.driverfn)
     else:
-      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']])
+      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']],loc=self.path)
 
     self.completed=self.reader.completed
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    save_state(self.path+self.pickle,self)
 
   #------------------------------------------------
   def update_queueid(self,qid):
     ''' If a bundler handles the submission, it can update the queue info with this.'''
     self.runner.queueid.append(qid)
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
     self._runready=False # After running, we won't run again without more analysis.
       
   #------------------------------------------------
@@ -152,25 +146,21 @@ class PySCFManager:
     Returns:
       bool: whether it was successful.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     if len(self.qwfiles['slater'])==0:
       self.nextstep()
       if not self.completed:
         return False
       print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
-      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.chkfile)
-      os.chdir(cwd)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.path+self.chkfile,path=self.path)
+    save_state(self.path+self.pickle,self)
     return True
 
   #----------------------------------------
   def status(self):
     ''' Determine the course of action based on info from reader and runner.'''
-    current_status = resolve_status(self.runner,self.reader,self.outfile)
+    current_status = resolve_status(self.runner,self.reader,self.path+self.outfile,task=(self.path,self.name))
     if current_status == 'done':
       return 'ok'
     elif current_status == 'retry':
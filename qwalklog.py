@@ -0,0 +1,422 @@
+'''
+Reading QWalk .log files and reblocking their results, without calling gosling.
+
+QWalk appends one record per block to the .log file (see Properties_block::storeToLog), like
+  dmc { 
+    label dmc
+    totweight 1024 
+    total_energy0 { -4.12 0.031 } 
+    kinetic0 { 3.2 0.9 } 
+    ...
+    average_generator { vals { 0.1 0.2 } vars { 0.01 0.02 } } 
+  }
+A property section holds the block average and variance of the property; a number at the end of its name
+is the wave function it is for. Sections that contain other sections (the average generators, e.g.
+average_derivative_dm or tbdm_basis from extra_observables) are kept whole: each array inside is 
+averaged over blocks like a property.
+Errors are estimated from the fluctuations between blocks, so they don't depend on the variances QWalk writes.
+
+The reader is incremental: the state returned by read_log remembers how far the file was read,
+so the next call only parses blocks appended since.
+'''
+
+import os
+import re
+import numpy as np
+
+_token=re.compile(rb'[{}]|[^\s{}]+')
+_function=re.compile(r'^(.*?)(\d+)$')
+
+###################################################################
+def _number(tok):
+  try:
+    return float(tok)
+  except ValueError:
+    return None
+
+###################################################################
+class _Section:
+  ''' A {} section of a record while it is parsed.'''
+  def __init__(self,name):
+    self.name=name
+    self.numbers=[]
+    self.keys={}      # Scalar values, like totweight 1024.
+    self.words=[]     # Words without a value, like the type of an average generator.
+    self.sections=[]
+
+  def leaf(self):
+    ''' Whether it only holds numbers.'''
+    return len(self.sections)==0 and len(self.keys)==0 and len(self.words)==0
+
+  def nested(self):
+    ''' Contents as a dict: keys, lone words under 'words', numbers under 'vals', and subsections by name. 
+    Repeated names get .1, .2... appended.'''
+    out=dict(self.keys)
+    if len(self.words)>0:
+      out['words']=list(self.words)
+    if len(self.numbers)>0:
+      out['vals']=np.array(self.numbers)
+    for sec in self.sections:
+      name=sec.name
+      count=1
+      while name in out:
+        name="%s.%d"%(sec.name,count)
+        count+=1
+      out[name]=np.array(sec.numbers) if sec.leaf() else sec.nested()
+    return out
+
+###################################################################
+def _record(top):
+  ''' Flatten a parsed top-level section into a record.
+  Returns:
+    dict: 'name', the scalar keys, property name -> (averages, variances) arrays by wave function, and 
+      'averages' -> nested dict of the average generator sections.
+  '''
+  record={'name':top.name}
+  record.update(top.keys)
+  props={}
+  averages=_Section('')
+  for sec in top.sections:
+    if not sec.leaf():
+      averages.sections.append(sec)
+      continue
+    match=_function.match(sec.name)
+    name,func=(match.group(1),int(match.group(2))) if match else (sec.name,0)
+    props.setdefault(name,{})[func]=sec.numbers
+  for name,funcs in props.items():
+    nfunc=max(funcs.keys())+1
+    if len(funcs)!=nfunc or name in record:
+      continue # Not a property.
+    avg=np.array([funcs[f][0] if len(funcs[f])>0 else np.nan for f in range(nfunc)])
+    var=np.array([funcs[f][1] if len(funcs[f])>1 else np.nan for f in range(nfunc)])
+    record[name]=(avg,var)
+  if len(averages.sections)>0:
+    record['averages']=averages.nested()
+  return record
+
+###################################################################
+def parse_records(buf):
+  ''' Parse the complete top-level records in buf.
+  Args:
+    buf (bytes): text of the log.
+  Returns:
+    (list,int): records (see _record), and the number of bytes read (up to the end of the last complete record).
+  '''
+  records=[]
+  consumed=0
+  stack=[]     # Open sections.
+  key=None     # Key waiting for a scalar value.
+  prev=None    # Word that may name the next section.
+  pending=None # Key given a word as its value, in case the word turns out to name a section.
+  for match in _token.finditer(buf):
+    tok=match.group()
+    if tok==b'{':
+      name=prev.decode() if prev is not None else ''
+      if len(stack)>0 and pending is not None:
+        # The word after pending names this section, so pending stood alone (like a generator type).
+        del stack[-1].keys[pending]
+        stack[-1].words.append(pending)
+      key=pending=prev=None
+      sec=_Section(name)
+      if len(stack)>0:
+        stack[-1].sections.append(sec)
+      stack.append(sec)
+    elif tok==b'}':
+      if key is not None and len(stack)>0:
+        stack[-1].words.append(key)
+      key=pending=prev=None
+      if len(stack)==0:
+        continue # Stray brace; skip.
+      sec=stack.pop()
+      if len(stack)==0:
+        records.append(_record(sec))
+        consumed=match.end()
+    elif len(stack)==0:
+      prev=tok
+    else:
+      num=_number(tok)
+      pending=None
+      if num is not None:
+        if key is not None:
+          stack[-1].keys[key]=num
+          key=None
+        else:
+          stack[-1].numbers.append(num)
+        prev=None
+      elif key is not None:
+        stack[-1].keys[key]=tok.decode()
+        pending=key
+        key=None
+        prev=tok
+      else:
+        key=tok.decode()
+        prev=tok
+  return records,consumed
+
+###################################################################
+def read_log(logfile,state=None):
+  ''' Read the block records from a QWalk log file.
+
+  Args:
+    logfile (str): path to the .log file.
+    state (dict): state from the previous call for this file, to only read new blocks. None reads all.
+  Returns:
+    dict: state with 'blocks' (property name -> array of block averages indexed by [block, wave function]),
+      'averages' (path of each array in the average generator sections, like 'average_generator/vals',
+      -> array indexed by [block, ...]), 'generators' (type of each average generator section, by name),
+      and 'weights' (array of block weights).
+      Pass it back in to continue reading.
+  '''
+  stat=os.stat(logfile)
+  with open(logfile,'rb') as inpf:
+    head=inpf.read(256)
+  if state is None or state.get('file')!=os.path.abspath(logfile) \
+      or state['offset']>stat.st_size or state['head']!=head[:len(state['head'])]:
+    state={'file':os.path.abspath(logfile),'offset':0,'head':head,'blocks':{},'averages':{},'generators':{},
+        'weights':np.zeros(0)}
+
+  if stat.st_size>state['offset']:
+    with open(logfile,'rb') as inpf:
+      inpf.seek(state['offset'])
+      records,consumed=parse_records(inpf.read())
+    state['offset']+=consumed
+    state['head']=head
+    _append(state,records)
+  return state
+
+###################################################################
+def _leaves(nested,prefix=''):
+  ''' (path, array) of every array in a nested dict.'''
+  out=[]
+  for name,val in nested.items():
+    if isinstance(val,dict):
+      out+=_leaves(val,prefix+name+'/')
+    elif isinstance(val,np.ndarray):
+      out.append((prefix+name,val))
+  return out
+
+###################################################################
+def _stack(old,new,nold,nnew):
+  ''' Append the per-block arrays in new (name -> list of arrays) to old, keeping only those in every block.'''
+  for name,vals in new.items():
+    if len(vals)!=nnew or len(set([v.shape for v in vals]))!=1:
+      continue # Not in every block.
+    vals=np.array(vals)
+    if nold==0:
+      old[name]=vals
+    elif name in old and old[name].shape[1:]==vals.shape[1:]:
+      old[name]=np.concatenate([old[name],vals])
+  # Entries missing from the new blocks can't be continued.
+  for name in list(old.keys()):
+    if old[name].shape[0]!=nold+nnew:
+      del old[name]
+
+def _append(state,records):
+  ''' Add the block averages in records to state.'''
+  if len(records)==0: return
+  nold=state['weights'].size
+  weights=np.array([rec.get('totweight',1.0) for rec in records],dtype=float)
+  props={}
+  averages={}
+  for rec in records:
+    for name,val in rec.items():
+      if isinstance(val,tuple):
+        props.setdefault(name,[]).append(val[0])
+    for path,val in _leaves(rec.get('averages',{})):
+      averages.setdefault(path,[]).append(val)
+    for name,sec in rec.get('averages',{}).items():
+      if isinstance(sec,dict):
+        state.setdefault('generators',{})[name]=sec.get('type',(sec.get('words') or [None])[0])
+  _stack(state['blocks'],props,nold,len(records))
+  state.setdefault('averages',{})
+  _stack(state['averages'],averages,nold,len(records))
+  state['weights']=np.concatenate([state['weights'],weights])
+
+###################################################################
+def reblock(data,weights,minbins=16):
+  ''' Error of the weighted mean of correlated blocks by reblocking.
+
+  Consecutive blocks are averaged in bins of 1,2,4,... blocks. The error estimate rises with the bin size until
+  the bins are uncorrelated; the largest estimate among levels with at least minbins bins is used.
+  Args:
+    data (array): block averages indexed by [block, ...].
+    weights (array): weight of each block.
+    minbins (int): fewest bins to trust an error estimate.
+  Returns:
+    (array,array,array): mean, error, and autocorrelation time (in blocks) of each component.
+  '''
+  data=np.asarray(data,dtype=float)
+  weights=np.asarray(weights,dtype=float)
+  shape=(-1,)+(1,)*(data.ndim-1)
+  mean=(weights.reshape(shape)*data).sum(axis=0)/weights.sum()
+  if data.shape[0]<2:
+    return mean,np.full(mean.shape,np.nan),np.ones(mean.shape)
+
+  errors=[]
+  binsize=1
+  while data.shape[0]//binsize>=min(minbins,data.shape[0]):
+    nbins=data.shape[0]//binsize
+    if nbins<2: break
+    # Most recent blocks are kept when the blocks don't divide evenly.
+    binned=data[-nbins*binsize:].reshape((nbins,binsize)+data.shape[1:])
+    binw=weights[-nbins*binsize:].reshape(nbins,binsize)
+    wsum=binw.sum(axis=1)
+    binmean=(binw.reshape((nbins,binsize)+(1,)*(data.ndim-1))*binned).sum(axis=1)/wsum.reshape(shape)
+    # Weighted variance of the mean, with the effective number of bins.
+    wnorm=wsum/wsum.sum()
+    var=(wnorm.reshape(shape)*(binmean-mean)**2).sum(axis=0)
+    neff=1./(wnorm**2).sum()
+    errors.append(np.sqrt(var/(neff-1)))
+    binsize*=2
+  errors=np.array(errors)
+  error=errors.max(axis=0)
+  with np.errstate(divide='ignore',invalid='ignore'):
+    autocorr=np.where(errors[0]>0,(error/errors[0])**2,1.0)
+  return mean,error,autocorr
+
+###################################################################
+def detect_warmup(series,maxfrac=0.5):
+  ''' Number of initial blocks to discard, by the marginal standard error rule (MSER).
+  The cut d minimizes the variance of the remaining blocks divided by their number squared.
+  Args:
+    series (array): one value per block, e.g. the total energy.
+    maxfrac (float): never discard more than this fraction of the blocks.
+  Returns:
+    int: number of warmup blocks.
+  '''
+  series=np.asarray(series,dtype=float)
+  n=series.size
+  if n<4: return 0
+  # Sums over the tail series[d:] for each cut d.
+  tailsum=np.cumsum(series[::-1])[::-1]
+  tailsq=np.cumsum((series**2)[::-1])[::-1]
+  remaining=np.arange(n,0,-1)
+  sqdev=tailsq-tailsum**2/remaining
+  mser=sqdev/remaining**2
+  maxcut=max(1,int(maxfrac*n))
+  return int(np.argmin(mser[:maxcut]))
+
+###################################################################
+def summarize(state,warmup=None,energy='total_energy'):
+  ''' Reblocked averages of everything read so far, in the layout of `gosling -json`.
+  Args:
+    state (dict): from read_log, or merged states (see merge_states).
+    warmup (int): number of blocks to skip. Default: detected from the energy.
+    energy (str): property used for warmup detection.
+  Returns:
+    dict: 'properties' (name -> {'value','error','autocorr'} lists by function), 'averages' (path in the average
+      generator sections -> {'value','error'}), 'total blocks', 'warmup blocks'.
+      The average generators that gosling reports (see generator_properties) are also under 'properties'.
+  '''
+  blocks=state['blocks']
+  nblocks=state['weights'].size
+  if warmup is None:
+    if energy in blocks and nblocks>0:
+      warmup=detect_warmup(blocks[energy][:,0])
+    else:
+      warmup=0
+  out={'properties':{},'averages':{},'total blocks':nblocks,'warmup blocks':warmup}
+  if nblocks-warmup<1:
+    return out
+  for name,data in blocks.items():
+    mean,error,autocorr=reblock(data[warmup:],state['weights'][warmup:])
+    out['properties'][name]={'value':mean.tolist(),'error':error.tolist(),'autocorr':autocorr.tolist()}
+  for name,data in state.get('averages',{}).items():
+    mean,error,autocorr=reblock(data[warmup:],state['weights'][warmup:])
+    out['averages'][name]={'value':mean.tolist(),'error':error.tolist()}
+  out['properties'].update(generator_properties(out['averages'],state.get('generators',{})))
+  return out
+
+###################################################################
+_obdm_keys=['up','down']
+_tbdm_keys=['upup','updown','downup','downdown']
+
+def _square(vals,ndim):
+  ''' Reshape a flat matrix to ndim axes of equal length.'''
+  vals=np.asarray(vals)
+  size=int(round(vals.size**(1.0/ndim)))
+  return vals.reshape((size,)*ndim).tolist()
+
+def _tbdm(parts,prefix):
+  ''' gosling's tbdm entry from the reblocked tbdm_basis arrays under prefix.'''
+  res={'obdm':{},'tbdm':{}}
+  for mat,keys,ndim in [('obdm',_obdm_keys,2),('tbdm',_tbdm_keys,4)]:
+    for key in keys:
+      avg=parts[prefix+'%s_%s'%(mat,key)]
+      res[mat][key]=_square(avg['value'],ndim)
+      res[mat][key+'_err']=_square(avg['error'],ndim)
+  return res
+
+###################################################################
+def generator_properties(averages,generators):
+  ''' The average generator results in the layout gosling gives them under 'properties'.
+
+  tbdm_basis sections hold obdm_up, obdm_down and tbdm_upup, tbdm_updown, tbdm_downup, tbdm_downdown, 
+  flattened; average_derivative_dm sections hold dpenergy and dpwf (by parameter), a tbdm_basis section,
+  and a dprdm section with a tbdm_basis section for each parameter.
+  Args:
+    averages (dict): 'averages' of summarize.
+    generators (dict): type of each average generator section, from the state.
+  Returns:
+    dict: 'tbdm' and 'derivative_dm' for the generators found. Incomplete sections are skipped.
+  '''
+  out={}
+  for name,kind in generators.items():
+    parts={path[len(name)+1:]:avg for path,avg in averages.items() if path.startswith(name+'/')}
+    try:
+      if kind=='tbdm_basis':
+        out['tbdm']=_tbdm(parts,'')
+      elif kind=='average_derivative_dm':
+        res={prop:{'vals':parts[prop]['value'],'err':parts[prop]['error']} for prop in ['dpenergy','dpwf']}
+        res['tbdm']=_tbdm(parts,'tbdm_basis/')
+        res['dprdm']=[]
+        for j in range(len(res['dpenergy']['vals'])):
+          res['dprdm'].append({'tbdm':_tbdm(parts,'dprdm/tbdm_basis%s/'%('.%d'%j if j>0 else ''))})
+        out['derivative_dm']=res
+    except KeyError:
+      continue # Not in every block, or not in this layout.
+  return out
+
+###################################################################
+def merge_states(states,skip=None):
+  ''' Join the blocks of several runs, in order, as though they were one run.
+  Args:
+    states (list): states from read_log.
+    skip (list): number of blocks to drop from the start of each run (default none).
+  Returns:
+    dict: state with the blocks of all runs (properties missing from any run are dropped).
+  '''
+  if skip is None: skip=[0]*len(states)
+  pairs=[(s,k) for s,k in zip(states,skip) if s['weights'].size>k]
+  if len(pairs)==0:
+    return {'blocks':{},'averages':{},'generators':{},'weights':np.zeros(0)}
+  merged={'weights':np.concatenate([s['weights'][k:] for s,k in pairs]),
+      'generators':dict(pairs[0][0].get('generators',{}))}
+  for part in ('blocks','averages'):
+    first=pairs[0][0].get(part,{})
+    names=set(first.keys())
+    for s,k in pairs[1:]:
+      names=set([n for n in s.get(part,{}) if n in names and s[part][n].shape[1:]==first[n].shape[1:]])
+    merged[part]={n:np.concatenate([s[part][n][k:] for s,k in pairs]) for n in names}
+  return merged
+
+###################################################################
+def summarize_runs(states,energy='total_energy'):
+  ''' Like summarize, for several independent runs of the same calculation.
+  The warmup of each run is detected and dropped separately before the blocks are combined.
+  Args:
+    states (list): states from read_log, one per run.
+    energy (str): property used for warmup detection.
+  Returns:
+    dict: see summarize. 'total blocks' and 'warmup blocks' are summed over the runs.
+  '''
+  warmups=[]
+  for state in states:
+    if energy in state['blocks']:
+      warmups.append(detect_warmup(state['blocks'][energy][:,0]))
+    else:
+      warmups.append(0)
+  out=summarize(merge_states(states,warmups),warmup=0,energy=energy)
+  out['total blocks']=sum([state['weights'].size for state in states])
+  out['warmup blocks']=sum(warmups)
+  return out
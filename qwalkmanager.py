@@ -1,13 +1,17 @@
-from manager_tools import resolve_status, update_attributes, separate_jastrow
-from autorunner import RunnerPBS
+from manager_tools import resolve_status, update_attributes, separate_jastrow, load_state, save_state, save_pickle, state_exists
+from autorunner import RunnerPBS, walltime_seconds
+from dmc import plan_nblock
+from average_tools import accumulate
 import os
-import pickle as pkl
+import sys
+import statestore
+import trialfunc
 from autopaths import paths
 
 #######################################################################
 class QWalkManager:
   def __init__(self,writer,reader,runner=None,trialfunc=None,
-      name='qw_run',path=None,bundle=False):
+      name='qw_run',path=None,bundle=False,kaverage=None,kweight=None,chain=False):
     ''' QWalkManager managers the writing of a QWalk input files, it's running, and keeping track of the results.
     Args:
       writer (qwalk writer): writer for input.
@@ -19,6 +23,13 @@ class QWalkManager:
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
       qwalk (str): absolute path to qwalk executible.
+      kaverage (str): file (relative to path, or absolute) of an average_tools.KAverage shared by the k-points,
+        which the results are added to when the run finishes.
+      kweight (float): weight of this run's k-point in kaverage. Default: the weight CRYSTAL gives the trial
+        function's k-point (qwfiles['kweights'] of its Slater manager), or 1.0 if it has none.
+      chain (bool): If the trial function managers are still queued or running, submit right away with a dependency
+        on their jobs (runners with `depends`, like RunnerPBS). The job writes its input on the node before running.
+        A CRYSTAL upstream needs pipeline=True for this.
     '''
     self.name=name
     self.pickle="%s.pkl"%(self.name)
@@ -39,6 +50,9 @@ class QWalkManager:
     if runner is not None: self.runner=runner
     else: self.runner=RunnerPBS()
     self.bundle=bundle
+    self.kaverage=kaverage
+    self.kweight=kweight
+    self.chain=chain
 
     self.completed=False
     self.infile=name
@@ -49,17 +63,24 @@ class QWalkManager:
         'wfout':''
       }
     self.stdout="%s.out"%self.infile
+    if hasattr(self.runner,'stage'):
+      # Copied back if the runner runs in node-local scratch.
+      self.runner.stage([name+ext for name in (self.infile,self.infile+'_r[0-9]*') 
+          for ext in ('.o','.log','.config','.trace','.out','.wfout','.start')])
+    # Extra inputs written when more blocks are planned (see plan_restart). Their outputs are collected with the first.
+    self.runs=[]
+    self.lastrun=self.infile
+    self.segments={} # Input -> blocks already in its log when it was last written, for continued runs.
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    if state_exists(self.path+self.pickle):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=load_state(self.path+self.pickle)
       self.recover(old)
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #------------------------------------------------
   def recover(self,other):
@@ -68,20 +89,20 @@ class QWalkManager:
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
 
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader','path','logname','name','bundle'],
-        take_keys=['restarts','completed','trialfunc','qwfiles'])
+        skip_keys=['writer','runner','reader','path','logname','name','bundle','kaverage','kweight','chain'],
+        take_keys=['restarts','completed','trialfunc','qwfiles','runs','lastrun','segments'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','exitcodes','scratch','outputs'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
-        skip_keys=[],
-        take_keys=['completed','output'])
+        skip_keys=['gosling'],
+        take_keys=['completed','output','logstate'])
 
     updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
-        skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace'],
+        skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace','storeconfig','readconfig'],
         take_keys=['completed','tmoves','extra_observables','timestep','trialfunc'])
     if updated:
       self.writer.completed=False
@@ -90,7 +111,7 @@ class QWalkManager:
   def nextstep(self):
     ''' Perform next step in calculation. trialfunc managers are updated if they aren't completed yet.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     print(self.logname,": next step.")
 
@@ -98,43 +119,187 @@ class QWalkManager:
     if self.writer.trialfunc=='':
       print(self.logname,": checking trial function.")
       self.writer.trialfunc=self.trialfunc.export(self.path)
-
-    # Work on this job.
-    cwd=os.getcwd()
-    os.chdir(self.path)
+      if self.writer.trialfunc=='' and self.chain and not self.bundle and self._submit_chained():
+        save_state(self.path+self.pickle,self)
+        return
 
     # Write the input file.
     if not self.writer.completed:
-      self.writer.qwalk_input(self.infile)
+      self.writer.qwalk_input(self.path+self.infile)
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,task=(self.path,self.name))
     print(self.logname,": %s status= %s"%(self.name,status))
     if status=="not_started" and self.writer.completed:
-      exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-      self.runner.add_task(exestr)
+      self._add_run(self.infile,self.stdout)
       print(self.logname,": %s status= submitted"%(self.name))
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
-      status=self.reader.collect(self.outfile)
+      status=self.reader.collect(self._outfiles())
       if status=='ok':
         print(self.logname,": %s status= %s, task complete."%(self.name,status))
         self.completed=True
-      else:
+        if self.kaverage is not None:
+          accumulate(os.path.join(self.path,self.kaverage),self,self._kweight())
+      elif not self.plan_restart():
         print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
-        exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-        self.runner.add_task(exestr)
+        self._add_run(self.infile,self.stdout)
     elif status=='done':
       self.completed=True
 
     # Ready for bundler or else just submit the jobs as needed.
     if not self.bundle:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,loc=self.path)
 
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
+
+  #------------------------------------------------
+  def _add_run(self,infile,stdout):
+    ''' Queue a QWalk run of infile, marking when it starts (see plan_restart).'''
+    self.runner.add_command("touch %s.start"%infile)
+    self.runner.add_task("%s %s &> %s"%(paths['qwalk'],infile,stdout))
+
+  #------------------------------------------------
+  def _kweight(self):
+    ''' Weight of this run's k-point in kaverage (see kweight).'''
+    if self.kweight is not None:
+      return self.kweight
+    slatman=getattr(self.trialfunc,'slatman',None)
+    kpoint=getattr(self.trialfunc,'kpoint',None)
+    weights=getattr(slatman,'qwfiles',{}).get('kweights',{})
+    if kpoint not in weights:
+      print(self.logname,": no k-point weight found for %s, using 1.0."%self.name)
+      return 1.0
+    return weights[kpoint]
+
+  #------------------------------------------------
+  def _submit_chained(self):
+    ''' Submit the run to start after the jobs of the trial function managers, writing its input on the node.
+    Returns:
+      bool: whether it was submitted (or already is).
+    '''
+    if not hasattr(self.runner,'depends'):
+      return False
+    if self.runner.check_status()=='running':
+      return True # Already chained.
+    depends=[]
+    seen=[]
+    for up in [getattr(self.trialfunc,'slatman',None),getattr(self.trialfunc,'jastman',None)]:
+      if up is None or up in seen: continue
+      seen.append(up)
+      ready,up=trialfunc._export(up) # Also submits it if it wasn't yet.
+      if ready: continue
+      if not (len(up.runner.queueid)>0 and up.runner.check_status()=='running'):
+        return False # Not running, e.g. waiting for a bundler; nothing to depend on.
+      depends.append(up.runner.queueid[-1])
+    if len(depends)==0:
+      return False
+
+    # The hook never opens the state store: SQLite locking isn't safe from compute nodes on network file systems.
+    # With a store, it gets pickles of the managers instead, and the driver redoes the export from the files later.
+    if statestore.active_store() is not None:
+      for mgr in [self]+seen:
+        save_pickle(mgr.path+mgr.pickle,mgr)
+    # Run from here, since the managers' paths may be relative to it.
+    hook="(cd %s && %s %s %s)"%(os.getcwd(),sys.executable,os.path.abspath(__file__),os.path.abspath(self.path+self.pickle))
+    self.runner.depends=depends
+    self.runner.add_command(hook+" || exit 1")
+    self._add_run(self.infile,self.stdout)
+    self.runner.submit(self.path.replace('/','-')+self.name,loc=self.path)
+    print(self.logname,": %s status= submitted after %s"%(self.name,', '.join(depends)))
+    return True
+
+  #------------------------------------------------
+  def prepare_input(self):
+    ''' Export the trial function and write the input, for chained jobs (run on the node before QWalk).
+    Returns:
+      bool: whether the input was written.
+    '''
+    self.recover(load_state(self.path+self.pickle))
+    if self.writer.trialfunc=='':
+      self.writer.trialfunc=self.trialfunc.export(self.path)
+    if self.writer.trialfunc=='':
+      print(self.logname,": trial function still not ready.")
+      return False
+    self.writer.qwalk_input(self.path+self.infile)
+    save_state(self.path+self.pickle,self)
+    return self.writer.completed
 
-    os.chdir(cwd)
+  #------------------------------------------------
+  def _outfiles(self):
+    ''' Output of the first run, or of all the runs if more were planned.'''
+    if len(self.runs)==0:
+      return self.path+self.outfile
+    return [self.path+self.outfile]+[self.path+"%s.o"%run for run in self.runs]
+
+  #------------------------------------------------
+  def plan_restart(self):
+    ''' Instead of repeating the same DMC run, write and queue runs with as many blocks as the error so far
+    says are needed to reach the tolerance (see dmc.plan_nblock). 
+    Runs that saved their walkers are continued from them, appending to their logs, so no blocks are spent on
+    equilibration again. Each set of walkers continues only one run; further runs equilibrate from the trial 
+    function, so that no two runs share a starting point. Blocks that don't fit in the runner's walltime are split over several runs, submitted
+    separately unless bundled or the runner launches them together (autorunner.RunnerMPMD). 
+    Returns:
+      bool: whether runs were planned. False if the writer or reader doesn't support it.
+    '''
+    if not hasattr(self.writer,'nblock') or not hasattr(self.reader,'logstate') or len(self.reader.logstate)==0:
+      return False
+
+    # Time per block of the last segment run: from the start of its job (not its submission, which includes the 
+    # wait in the queue) to its last block.
+    chains=[self.infile]+self.runs
+    start=self.path+self.lastrun+'.start'
+    lastlog=os.path.abspath(self.path+self.lastrun+'.log')
+    sec_per_block=None
+    if lastlog in self.reader.logstate and os.path.exists(start) and os.path.exists(lastlog):
+      nrun=self.reader.logstate[lastlog]['weights'].size-self.segments.get(self.lastrun,0)
+      if nrun>0 and os.path.getmtime(lastlog)>os.path.getmtime(start):
+        sec_per_block=(os.path.getmtime(lastlog)-os.path.getmtime(start))/nrun
+
+    saved=[]
+    if getattr(self.writer,'storeconfig',False):
+      saved=[run for run in chains if os.path.exists(self.path+run+'.config')]
+
+    plan=None
+    for rewarm in (False,True):
+      plan=plan_nblock(list(self.reader.logstate.values()),self.reader.errtol,self.reader.minblocks,
+          sec_per_block=sec_per_block,walltime=walltime_seconds(getattr(self.runner,'walltime',None)),
+          rewarm=rewarm)
+      # Runs beyond the saved walkers start over, so they need to equilibrate.
+      if plan is None or plan['nruns']<=len(saved):
+        break
+    if plan is None:
+      return False
+    print(self.logname,": %s needs about %d more blocks (error ~ N^%.2f); planning %d run(s) of %d blocks, %d continued."%\
+        (self.name,plan['needed'],plan['slope'],plan['nruns'],plan['nblock'],min(len(saved),plan['nruns'])))
+
+    self.writer.nblock=plan['nblock']
+    for i in range(plan['nruns']):
+      if i<len(saved):
+        infile=saved[i]
+        self.writer.readconfig=infile+'.config'
+      else:
+        infile="%s_r%d"%(self.infile,len(self.runs)+1)
+        self.runs.append(infile)
+        # Not from another run's walkers: the runs are averaged as independent, so they mustn't share a start.
+        self.writer.readconfig=''
+      logfile=os.path.abspath(self.path+infile+'.log')
+      self.segments[infile]=self.reader.logstate[logfile]['weights'].size if logfile in self.reader.logstate else 0
+      self.writer.qwalk_input(self.path+infile)
+      self.lastrun=infile
+      self._add_run(infile,infile+'.out')
+      if plan['nruns']>1 and not self.bundle and not getattr(self.runner,'mpmd',False):
+        self.runner.submit(self.path.replace('/','-')+infile,loc=self.path)
+    self.writer.readconfig=''
+    return True
+
+  #------------------------------------------------
+  def release_commands(self):
+    ''' Release the runner of any commands it was tasked with and update the manager (for a bundler).'''
+    commands=self.runner.release_commands()
+    save_state(self.path+self.pickle,self)
+    return commands
 
   #------------------------------------------------
   def update_queueid(self,qid):
@@ -146,8 +311,7 @@ class QWalkManager:
     self._runready=False # After running, we won't run again without more analysis.
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #----------------------------------------
   def status(self):
@@ -164,11 +328,10 @@ class QWalkManager:
   def collect(self):
     ''' Call the collect routine for readers.'''
     print(self.logname,": collecting results.")
-    self.reader.collect(self.path+self.outfile)
+    self.reader.collect(self._outfiles())
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
 
   #----------------------------------------
   def export_qwalk(self):
@@ -178,7 +341,7 @@ class QWalkManager:
     # Theoretically more than just Jastrow can be provided, but practically that's the only type of wavefunction we tend to export.
 
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(load_state(self.path+self.pickle))
 
     assert self.writer.qmc_abr!='dmc',"DMC doesn't provide a wave function."
 
@@ -187,15 +350,21 @@ class QWalkManager:
       if not self.completed:
         return False
       print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
       self.qwfiles['wfout']="%s.wfout"%self.infile
-      newjast=separate_jastrow(self.qwfiles['wfout'])
+      newjast=separate_jastrow(self.path+self.qwfiles['wfout'])
       self.qwfiles['jastrow2']="%s.jast"%self.infile
-      with open(self.qwfiles['jastrow2'],'w') as outf:
+      with open(self.path+self.qwfiles['jastrow2'],'w') as outf:
         outf.write(newjast)
-      os.chdir(cwd)
 
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    save_state(self.path+self.pickle,self)
     return True
+
+#######################################################################
+if __name__=='__main__':
+  # Hook for chained jobs: write a manager's input on the node once the jobs it depends on are done.
+  from argparse import ArgumentParser
+  parser=ArgumentParser('Write the QWalk input of a saved QWalkManager.')
+  parser.add_argument('pickle',type=str,help="Path the manager is pickled under.")
+  args=parser.parse_args()
+  if not load_state(args.pickle).prepare_input():
+    sys.exit(1)
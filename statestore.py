@@ -0,0 +1,157 @@
+'''
+Project-level storage of manager state in a single SQLite file.
+
+By default managers save themselves into `<name>.pkl` next to their files.
+For large campaigns this means many small pickle reads and writes on a shared filesystem.
+Calling `use_store('project.db')` at the top of a driver instead stores every manager in one SQLite database.
+Each attribute of a manager is stored separately, so saving only writes the attributes that changed.
+Attributes that are the same object (like CrystalManager's runner and prunner by default) stay so when loaded.
+Wrapping a driver pass in `with store.transaction():` commits all saves of the pass at once.
+'''
+
+import os
+import pickle as pkl
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+#######################################################################
+class StateStore:
+  ''' Manager state database. Objects are stored one row per attribute, keyed by the absolute path of
+  the pickle file they would otherwise be saved to.'''
+  def __init__(self,dbfile='autogen_state.db'):
+    '''
+    Args:
+      dbfile (str): SQLite file to store the state in. Created if it doesn't exist.
+    '''
+    self.dbfile=os.path.abspath(dbfile)
+    self.conn=sqlite3.connect(self.dbfile,isolation_level=None,check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS state "
+        "(key TEXT, field TEXT, data BLOB, PRIMARY KEY (key,field))")
+    self.lock=threading.RLock()
+    self.depth=0
+    self.known={} # Serialized fields last read from or written to the database, for each key.
+
+  #------------------------------------------------
+  @contextmanager
+  def transaction(self):
+    ''' Group all saves inside the `with` block into one transaction (nesting is allowed).'''
+    with self.lock:
+      self.depth+=1
+      if self.depth==1: self.conn.execute("BEGIN")
+    try:
+      yield self
+    except:
+      with self.lock:
+        self.depth-=1
+        if self.depth==0:
+          self.conn.execute("ROLLBACK")
+          self.known={}
+      raise
+    else:
+      with self.lock:
+        self.depth-=1
+        if self.depth==0: self.conn.execute("COMMIT")
+
+  #------------------------------------------------
+  def _fetch(self,key):
+    rows=self.conn.execute("SELECT field,data FROM state WHERE key=?",(key,)).fetchall()
+    return dict(rows)
+
+  #------------------------------------------------
+  def exists(self,fn):
+    ''' Whether there is an object stored for pickle file name fn.'''
+    key=os.path.abspath(fn)
+    with self.lock:
+      if key in self.known: return True
+      row=self.conn.execute("SELECT 1 FROM state WHERE key=? LIMIT 1",(key,)).fetchone()
+    return row is not None
+
+  #------------------------------------------------
+  def load(self,fn):
+    ''' Rebuild the object stored for pickle file name fn.
+    Returns:
+      object or None: None if nothing is stored under fn.
+    '''
+    key=os.path.abspath(fn)
+    with self.lock:
+      fields=self._fetch(key)
+      if len(fields)==0:
+        return None
+      self.known[key]=fields
+    cls=pkl.loads(fields['__class__'])
+    obj=cls.__new__(cls)
+    aliases=pkl.loads(fields['__aliases__']) if '__aliases__' in fields else {}
+    for field,data in fields.items():
+      if field in ('__class__','__aliases__') or field in aliases: continue
+      obj.__dict__[field]=pkl.loads(data)
+    for field,other in aliases.items():
+      obj.__dict__[field]=obj.__dict__[other]
+    return obj
+
+  #------------------------------------------------
+  def save(self,fn,obj):
+    ''' Save obj under pickle file name fn, writing only the attributes that changed since the last load or save.'''
+    key=os.path.abspath(fn)
+    fields={'__class__':pkl.dumps(obj.__class__)}
+    aliases={} # Attribute -> earlier attribute that is the same object.
+    seen={}
+    for field,val in obj.__dict__.items():
+      if hasattr(val,'__dict__') or isinstance(val,(list,dict)):
+        if id(val) in seen:
+          aliases[field]=seen[id(val)]
+          continue
+        seen[id(val)]=field
+      fields[field]=pkl.dumps(val)
+    if len(aliases)>0:
+      fields['__aliases__']=pkl.dumps(aliases)
+
+    with self.lock:
+      if key not in self.known:
+        self.known[key]=self._fetch(key)
+      known=self.known[key]
+      changed=[(key,field,data) for field,data in fields.items() if known.get(field)!=data]
+      removed=[(key,field) for field in known if field not in fields]
+      if len(changed)+len(removed)==0:
+        return
+
+      if self.depth==0: self.conn.execute("BEGIN")
+      try:
+        self.conn.executemany("INSERT OR REPLACE INTO state (key,field,data) VALUES (?,?,?)",changed)
+        self.conn.executemany("DELETE FROM state WHERE key=? AND field=?",removed)
+      except sqlite3.Error:
+        if self.depth==0: self.conn.execute("ROLLBACK")
+        del self.known[key]
+        raise
+      if self.depth==0: self.conn.execute("COMMIT")
+      self.known[key]=fields
+
+  #------------------------------------------------
+  def close(self):
+    self.conn.close()
+
+#######################################################################
+# The store used by managers, if any.
+_active=None
+
+def use_store(dbfile='autogen_state.db'):
+  ''' Make managers save their state into dbfile instead of pickle files.
+  Args:
+    dbfile (str): SQLite file for the project. None switches back to pickle files.
+  Returns:
+    StateStore: the active store (None if switched off).
+  '''
+  global _active
+  if _active is not None:
+    _active.close()
+  if dbfile is None:
+    _active=None
+  else:
+    _active=StateStore(dbfile)
+  return _active
+
+def active_store():
+  ''' The store set by use_store, or None if managers use pickle files.'''
+  return _active
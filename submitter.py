@@ -21,47 +21,100 @@ class LocalSubmitter:
             returns a list of queue ids (list of strings)
   """
 #-------------------------------------------------------
+# Process-wide cache of the scheduler state, so that a driver pass over many
+# managers makes one scheduler round-trip instead of one per manager.
+QSTAT_TTL=30.0 # seconds a qstat table is trusted before querying again.
+_qstat_cache={'time':None,'table':None}
 
-def check_BW_stati(queueids):
-  """Utility function to determine the status of a set Blue Waters job.
-  Args: 
-    queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+#-------------------------------------------------------
+def clear_status_cache():
+  """ Forget the cached qstat table. Call after a submission or deletion so the next
+  status check sees the new job."""
+  _qstat_cache['time']=None
+  _qstat_cache['table']=None
+
+#-------------------------------------------------------
+def qstat_table(ttl=None):
+  """ Query the queue once per `ttl` seconds and parse the result into a dictionary.
+  Args:
+    ttl (float): age (in seconds) after which the cached table is refreshed (default: QSTAT_TTL).
+  Returns:
+    dict: split qstat line for each job, keyed by the job id without server suffix, e.g. '4819103'.
+      None if qstat failed.
   """
+  if ttl is None: ttl=QSTAT_TTL
+  now=time.time()
+  if _qstat_cache['table'] is not None and now-_qstat_cache['time'] < ttl:
+    return _qstat_cache['table']
+
   try:
+    # -t lists the subjobs of job arrays too, as e.g. 1234[5].
     qstat = sub.check_output(
-        "qstat ", stderr=sub.STDOUT, shell=True
+        "qstat -t", stderr=sub.STDOUT, shell=True
       ).decode()
   except sub.CalledProcessError:
+    return None
+
+  table={}
+  for line in qstat.split('\n'):
+    spl=line.split()
+    if len(spl) > 4:
+      table[spl[0].split('.')[0]]=spl
+  _qstat_cache['time']=now
+  _qstat_cache['table']=table
+  return table
+
+#-------------------------------------------------------
+def _check_stati(queueids,statcol):
+  """ Look up queueids in the cached qstat table.
+  Args: 
+    queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+    statcol (int): column of the qstat output containing the job state.
+  """
+  table=qstat_table()
+  if table is None:
     return "unknown"
-  qstat=qstat.split('\n')
   for qid in queueids:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[-2]
-        if stat == "R" or stat == "Q":
-          return "running"
+    if qid not in table and '[' in qid:
+      qid=qid[:qid.index('[')]+'[]' # Subjobs of arrays that haven't started may only be listed with the array.
+    if qid in table:
+      stat=table[qid][statcol]
+      if stat in ("R","Q","H","W","B"): # Held or waiting, e.g. for a dependency; B is an array that has begun.
+        return "running"
   return 'unknown'
 
+#-------------------------------------------------------
+def cancel_jobs(queueids):
+  """ Delete the jobs among queueids that are still queued or running (qdel works on PBS and Blue Waters).
+  Args: 
+    queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+  Returns:
+    list: queueids that were deleted.
+  """
+  table=qstat_table(ttl=0)
+  if table is None:
+    return []
+  active=[qid for qid in queueids if qid in table]
+  if len(active)>0:
+    try:
+      sub.check_output("qdel %s"%' '.join(active),stderr=sub.STDOUT,shell=True)
+    except sub.CalledProcessError as err:
+      print("cancel_jobs: qdel failed.\n\t{0}".format(err))
+  clear_status_cache()
+  return active
+
+#-------------------------------------------------------
+def check_BW_stati(queueids):
+  """Utility function to determine the status of a set Blue Waters job.
+  Args: 
+    queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+  """
+  return _check_stati(queueids,-2)
+
 #-------------------------------------------------------
 def check_PBS_stati(queueids):
   """Utility function to determine the status of a set PBS job.
   Args: 
     queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
   """
-  try:
-    qstat = sub.check_output(
-        "qstat ", stderr=sub.STDOUT, shell=True
-      ).decode()
-  except sub.CalledProcessError:
-    return "unknown"
-  qstat=qstat.split('\n')
-  for qid in queueids:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[4]
-        if stat == "R" or stat == "Q":
-          return "running"
-  return 'unknown'
-
+  return _check_stati(queueids,4)
@@ -0,0 +1,172 @@
+'''
+Run the tasks of a bundled job concurrently on the nodes of the allocation.
+
+Bundler writes a manifest (JSON) listing the tasks of a job and starts `python taskfarm.py manifest.json` in the job.
+Each task is a list of shell lines run in order in its directory, and needs `nn` nodes with `np` cores each.
+Tasks are started in order as soon as enough cores are free, so short tasks don't leave nodes idle while
+long ones finish.
+
+The start and stop time, nodes, and exit code of each task are recorded in `[loc]/[name].task.json`
+(see task_record), and for all tasks in the status file of the manifest.
+
+mpirun lines are given a machine file with the task's nodes. aprun places itself, so aprun lines are run as they are.
+'''
+
+import os
+import sys
+import json
+import time
+import subprocess as sub
+
+###################################################################
+def write_manifest(fname,tasks,ppn):
+  ''' Write a task manifest.
+  Args:
+    fname (str): manifest file.
+    tasks (list): dicts with 'name', 'loc' (directory), 'lines' (shell commands), 'nn' (nodes), and 'np' (cores per node, or 'allprocs').
+    ppn (int): cores per node of the allocation.
+  '''
+  with open(fname,'w') as outf:
+    json.dump({'ppn':ppn,'tasks':tasks},outf,indent=1)
+
+###################################################################
+def task_record(loc,name):
+  ''' Start, stop, nodes and exit code of a task run by the task farm.
+  Args:
+    loc (str): directory of the task (e.g. the manager's path).
+    name (str): name of the task (e.g. the manager's name).
+  Returns:
+    dict: 'state' ('running', 'done' or 'failed'), 'start', 'stop' (seconds since the epoch), 'nodes', 'exitcode'.
+      None if the task hasn't started.
+  '''
+  fname=os.path.join(loc,name+'.task.json')
+  if not os.path.exists(fname):
+    return None
+  with open(fname,'r') as inpf:
+    return json.load(inpf)
+
+def _dump(fname,obj):
+  ''' Write JSON atomically, so readers never see a partial file.'''
+  with open(fname+'.tmp','w') as outf:
+    json.dump(obj,outf,indent=1)
+  os.replace(fname+'.tmp',fname)
+
+###################################################################
+def allocation_nodes():
+  ''' Nodes of this job and the number of times each is listed, from $PBS_NODEFILE (this node if not set).'''
+  nodefile=os.environ.get('PBS_NODEFILE')
+  if nodefile is None or not os.path.exists(nodefile):
+    return {os.uname()[1]:os.cpu_count()}
+  nodes={}
+  with open(nodefile,'r') as inpf:
+    for line in inpf:
+      if line.strip()!='':
+        nodes[line.strip()]=nodes.get(line.strip(),0)+1
+  return nodes
+
+###################################################################
+class TaskFarm:
+  def __init__(self,manifest,nodes=None,poll=1.0):
+    '''
+    Args:
+      manifest (str): manifest file (see write_manifest).
+      nodes (dict): node name -> cores. Default: from allocation_nodes, with ppn cores each.
+      poll (float): seconds between checks on the running tasks.
+    '''
+    with open(manifest,'r') as inpf:
+      spec=json.load(inpf)
+    self.manifest=os.path.abspath(manifest)
+    self.statusfile=os.path.splitext(self.manifest)[0]+'.status.json'
+    self.ppn=spec['ppn']
+    if nodes is None:
+      nodes={node:self.ppn for node in allocation_nodes()}
+    self.free=dict(nodes)
+    self.pending=list(spec['tasks'])
+    self.running=[] # (task, process, nodes, cores per node)
+    self.status={}
+    self.poll=poll
+
+  #------------------------------------------------
+  def _cores(self,task):
+    return self.ppn if task.get('np','allprocs')=='allprocs' else int(task['np'])
+
+  #------------------------------------------------
+  def _place(self,task):
+    ''' Nodes with enough free cores for task, or None.'''
+    ncore=min(self._cores(task),self.ppn)
+    nodes=[node for node,free in self.free.items() if free>=ncore][:task.get('nn',1)]
+    if len(nodes)<task.get('nn',1):
+      return None
+    return nodes
+
+  #------------------------------------------------
+  def _record(self,task,record):
+    self.status[task['name']+'@'+task['loc']]=record
+    _dump(os.path.join(task['loc'],task['name']+'.task.json'),record)
+    _dump(self.statusfile,self.status)
+
+  #------------------------------------------------
+  def _start(self,task,nodes):
+    ncore=min(self._cores(task),self.ppn)
+    for node in nodes:
+      self.free[node]-=ncore
+    machinefile=os.path.join(task['loc'],task['name']+'.nodes')
+    with open(machinefile,'w') as outf:
+      outf.write('\n'.join([node for node in nodes for i in range(ncore)])+'\n')
+    lines=[]
+    for line in task['lines']:
+      if line.startswith('mpirun '):
+        line="mpirun -machinefile %s %s"%(machinefile,line[len('mpirun '):])
+      lines.append(line)
+    outf=open(os.path.join(task['loc'],task['name']+'.task.out'),'a')
+    proc=sub.Popen('\n'.join(lines),shell=True,cwd=task['loc'],stdout=outf,stderr=sub.STDOUT)
+    outf.close()
+    self.running.append((task,proc,nodes,ncore))
+    self._record(task,{'state':'running','start':time.time(),'stop':None,'nodes':nodes,'exitcode':None})
+    print("taskfarm: started %s in %s on %s"%(task['name'],task['loc'],','.join(nodes)))
+
+  #------------------------------------------------
+  def _reap(self):
+    ''' Release the nodes of finished tasks.'''
+    still=[]
+    for task,proc,nodes,ncore in self.running:
+      code=proc.poll()
+      if code is None:
+        still.append((task,proc,nodes,ncore))
+        continue
+      for node in nodes:
+        self.free[node]+=ncore
+      record=dict(self.status[task['name']+'@'+task['loc']])
+      record.update({'state':'done' if code==0 else 'failed','stop':time.time(),'exitcode':code})
+      self._record(task,record)
+      print("taskfarm: %s finished with exit code %d after %.0f s"%(task['name'],code,record['stop']-record['start']))
+    self.running=still
+
+  #------------------------------------------------
+  def run(self):
+    ''' Run all the tasks. Returns when they have all finished.
+    Returns:
+      int: number of tasks that failed.
+    '''
+    for task in self.pending:
+      if task.get('nn',1)>len(self.free) or min(self._cores(task),self.ppn)>max(self.free.values()):
+        raise AssertionError("taskfarm: task %s needs more than the allocation has."%task['name'])
+    while len(self.pending)>0 or len(self.running)>0:
+      self._reap()
+      # First fit in order: later small tasks can fill cores a big task is waiting for.
+      waiting=[]
+      for task in self.pending:
+        nodes=self._place(task)
+        if nodes is None:
+          waiting.append(task)
+        else:
+          self._start(task,nodes)
+      self.pending=waiting
+      if len(self.running)>0:
+        time.sleep(self.poll)
+    return sum([rec['state']=='failed' for rec in self.status.values()])
+
+###################################################################
+if __name__=='__main__':
+  nfailed=TaskFarm(sys.argv[1]).run()
+  sys.exit(1 if nfailed>0 else 0)
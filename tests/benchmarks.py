@@ -0,0 +1,415 @@
+'''
+Benchmarks of the file conversion and analysis routines against their previous implementations.
+Each benchmark also checks that the results agree.
+Run from this directory: `python3 benchmarks.py [name]`.
+'''
+
+import sys
+import os
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+sys.path.append('..')
+import crystal2qmc
+import average_tools
+
+###################################################################################################################
+# Helpers.
+def timeit(func,*args,repeat=3):
+  ''' Best time of several calls.
+  Returns:
+    (float,object): seconds, and the result of the last call.
+  '''
+  best=None
+  for i in range(repeat):
+    start=time.perf_counter()
+    res=func(*args)
+    elapsed=time.perf_counter()-start
+    if best is None or elapsed<best: best=elapsed
+  return best,res
+
+def peakmem(func,*args):
+  ''' Peak memory allocated during a call, in MB.'''
+  tracemalloc.start()
+  func(*args)
+  peak=tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return peak/1e6
+
+def same(a,b):
+  ''' Compare nested results of the readers.'''
+  if type(a)==dict:
+    return type(b)==dict and a.keys()==b.keys() and all([same(a[k],b[k]) for k in a])
+  if type(a) in (list,tuple):
+    return len(a)==len(b) and all([same(x,y) for x,y in zip(a,b)])
+  return np.array_equal(a,b)
+
+###################################################################################################################
+# read_gred.
+def read_gred_legacy(gred="GRED.DAT"):
+  ''' read_gred as it was before tokenizing into numpy (the parts that changed).'''
+  lat_parm = {}
+  ions = {}
+  basis = {}
+  pseudo = {}
+
+  gred = open(gred,'r').read()
+  gred = gred.replace("-"," -")
+  gred = gred.replace("E -","E-")
+
+  gred_words = gred.split()
+  nparms = [int(w) for w in gred_words[1:4]]
+  cursor = 4
+  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
+  cursor += sum(nparms)
+  lat_parm['struct_dim'] = int(info[9])
+  lat_parm['latvecs'] = \
+      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
+  cursor += 9
+  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
+  cursor += 9
+  lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
+  cursor += info[1] + 48*48 + 9*info[1] + 3*info[1]
+  cursor += info[4]+1 + info[78]*3 + info[4]+1 + info[4]+1 + info[78] + info[78]*3
+  natoms = info[23]
+  ions['charges'] = [float(w) for w in gred_words[cursor:cursor+natoms]]
+  cursor += natoms
+  ions['positions'] = np.array(gred_words[cursor:cursor+3*natoms],dtype=float).reshape(natoms,3)
+  cursor += 3*natoms
+  nshells = info[19]
+  nprim   = info[74]
+  for key in ['charges','adj_gaus']:
+    basis[key] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+    cursor += nshells
+  basis['positions'] = np.array(gred_words[cursor:cursor+3*nshells],dtype=float).reshape(nshells,3)
+  cursor += 3*nshells
+  for key in ['prim_gaus','coef_s','coef_p','coef_dfg','coef_max']:
+    basis[key] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+    cursor += nprim
+  cursor += 2*nprim
+  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms
+  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms + 1
+  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  for key in ['prim_shell','shell_type','nao_shell']:
+    basis[key] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+    cursor += nshells
+  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms + 1
+  ngauss = int(gred_words[cursor])
+  cursor += 1
+  headlen = int(gred_words[cursor])
+  cursor += 1
+  numpseudo = int(gred_words[cursor])
+  cursor += 1
+  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
+  cursor += ngauss
+  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
+  cursor += headlen
+  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
+  cursor += numpseudo + 1
+  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  npjlen = int(headlen / len(pseudo_start))
+  for aidx,atom in enumerate(ions['atom_nums']):
+    psidx = pseudo_atom[aidx]-1
+    start = pseudo_start[psidx]
+    if psidx+1 >= len(pseudo_start): end = ngauss
+    else                           : end = pseudo_start[psidx+1]
+    if atom not in pseudo.keys():
+      pseudo[atom] = {}
+      pseudo[atom]['prefactors'] = prefactors[start:end]
+      pseudo[atom]['r_exps'] = r_exps[start:end]
+      pseudo[atom]['n_per_j'] = n_per_j[npjlen*psidx:npjlen*(psidx+1)]
+      pseudo[atom]['exponents'] = exponents[start:end]
+
+  return info, lat_parm, ions, basis, pseudo
+
+def write_fake_gred(fname,natoms=1000,shells_per_atom=10,prims_per_shell=3,seed=0):
+  ''' Write a file with the layout read_gred expects, filled with random numbers.
+  Floats are written like CRYSTAL does (E19.12), so negative numbers run into the previous field.'''
+  rng=np.random.RandomState(seed)
+  nshells=natoms*shells_per_atom
+  nprim=nshells*prims_per_shell
+  ngauss=8
+  info=np.zeros(100,dtype=int)
+  info[1]=1; info[4]=5; info[78]=7; info[9]=3
+  info[23]=natoms; info[19]=nshells; info[74]=nprim
+
+  sections=[] # (is_int, values)
+  ints=lambda v: sections.append((True,np.asarray(v,dtype=int).ravel()))
+  floats=lambda v: sections.append((False,np.asarray(v,dtype=float).ravel()))
+  ints([0,100,5,5]); ints(info); ints(np.zeros(10))
+  floats(np.eye(3)*5.43); floats(np.eye(3))
+  floats(rng.randn(info[1]+48*48+12*info[1] + 3*(info[4]+1)+7*info[78]))
+  floats(np.full(natoms,4.0)); floats(rng.randn(3*natoms))
+  floats(rng.randn(5*nshells)); floats(rng.rand(nprim)*10); floats(rng.randn(6*nprim))
+  ints(np.full(natoms,214)); ints(np.arange(natoms+1)*shells_per_atom+1)
+  ints(np.arange(nshells+1)*prims_per_shell+1); ints(np.full(nshells,prims_per_shell))
+  ints(np.tile([0,0,2,2,3,0,2,3,3,4],natoms)[:nshells]); ints(np.tile([1,1,3,3,5,1,3,5,5,7],natoms)[:nshells])
+  ints(np.arange(nshells+1)); ints(np.repeat(np.arange(natoms)+1,shells_per_atom))
+  ints(np.ones(natoms)); ints([0,ngauss,3,1]); ints(-rng.randint(0,3,ngauss)); ints([4,2,2]); ints([0,0])
+  floats(rng.rand(ngauss)); floats(rng.randn(ngauss))
+
+  with open(fname,'w') as outf:
+    for is_int,vals in sections:
+      fmt,width=("%12d",6) if is_int else ("%19.12E",4)
+      for start in range(0,vals.size,width):
+        outf.write(''.join([fmt%v for v in vals[start:start+width]])+'\n')
+
+def bench_read_gred(natoms=1000):
+  with tempfile.TemporaryDirectory() as tmp:
+    fname=os.path.join(tmp,"GRED.DAT")
+    write_fake_gred(fname,natoms=natoms)
+    size=os.path.getsize(fname)/1e6
+    told,ref=timeit(read_gred_legacy,fname)
+    tnew,res=timeit(crystal2qmc.read_gred,fname)
+    mold=peakmem(read_gred_legacy,fname)
+    mnew=peakmem(crystal2qmc.read_gred,fname)
+  assert same(res[0],ref[0]) and all([same({k:v for k,v in res[i].items() if k in ref[i]},ref[i]) for i in range(1,5)]),\
+      "read_gred results disagree with the legacy reader."
+  print("read_gred   %6.1f MB file: legacy %7.3f s %7.1f MB peak, new %7.3f s %7.1f MB peak (%.1fx faster)"%(
+      size,told,mold,tnew,mnew,told/tnew))
+
+###################################################################################################################
+# read_kred and eigvec_lookup.
+def kred_offsets_legacy(kred="KRED.DAT"):
+  ''' The line-by-line scan read_kred did before the offsets were indexed.'''
+  charcount=0
+  kpt_file_start={}
+  kred=open(kred)
+  kred_words=[]
+  for lin in kred:
+    charcount+=len(lin)
+    if lin=='          0          0          0\n' and len(kred_words)>13:
+      break
+    kred_words += lin.split()
+  kpt_file_start[(0,0,0)]=[charcount]
+  for line in kred:
+    llen=len(line)
+    charcount+=llen
+    if llen==34:
+      kpt=tuple([int(i) for i in line.split()])
+      if kpt in kpt_file_start:
+        kpt_file_start[kpt].append(charcount)
+      else:
+        kpt_file_start[kpt] = [charcount]
+  return kpt_file_start
+
+def eigvec_lookup_legacy(kpt,eigsys,spin=0):
+  ''' eigvec_lookup before reading through mmap.'''
+  ncpnts = int(eigsys['nbands']* eigsys['nao'])
+  if eigsys['ikpt_iscmpx'][kpt]:
+    ncpnts *= 2
+  linesperkpt = ncpnts//4 + int(ncpnts%4>0)
+  kredf = open(eigsys['kred'],'r')
+  kredf.seek(eigsys['kpt_file_start'][kpt][spin])
+  eigvec=[]
+  for li,line in enumerate(kredf):
+    if li==linesperkpt: break
+    eigvec+=line.split()
+  eigvec = np.array(eigvec,dtype=float)
+  if eigsys['ikpt_iscmpx'][kpt]:
+    eigvec=eigvec.reshape(ncpnts//2,2)
+    eigvec=eigvec[:,0] + eigvec[:,1]*1j
+  return eigvec.reshape(eigsys['nbands'],eigsys['nao'])
+
+def write_fake_kred(fname,nao=500,nkdir=2,nspin=2,seed=0):
+  ''' Write a file with the layout read_kred expects, with random eigenvectors.
+  Returns:
+    (list,dict,dict): the k-points, and the info and basis arguments for read_kred.
+  '''
+  rng=np.random.RandomState(seed)
+  kpts=[(i,j,k) for i in range(nkdir) for j in range(nkdir) for k in range(nkdir)]
+  nikpts=len(kpts)
+  iscmpx=[0 if 2*max(kpt)!=nkdir and max(kpt)>0 else 1 for kpt in kpts]
+  info=np.zeros(100,dtype=int)
+  info[6]=nao; info[63]=nspin-1
+  basis={'nao_shell':np.array([nao])}
+
+  def ints(vals):
+    vals=list(vals)
+    return ''.join([''.join(["%12d"%v for v in vals[i:i+6]])+'\n' for i in range(0,len(vals),6)])
+  def floats(vals):
+    return ''.join([''.join(["%21.13E"%v for v in vals[i:i+4]])+'\n' for i in range(0,len(vals),4)])
+
+  with open(fname,'w') as outf:
+    outf.write(ints([nkdir]*3+[nikpts]))
+    outf.write(floats(np.eye(3).ravel()))
+    outf.write(ints(np.array(kpts).ravel()))
+    outf.write(ints(iscmpx))
+    outf.write(ints(np.zeros(9*48,dtype=int)))
+    outf.write(floats(np.ones(nikpts)/nikpts))
+    outf.write(floats(np.sort(rng.randn(nspin*nao*nikpts))))
+    outf.write(floats(rng.rand(nspin*nao*nikpts)))
+    for spin in range(nspin):
+      for kpt,cmpx in zip(kpts,iscmpx):
+        outf.write("%11d%11d%11d\n"%kpt)
+        outf.write(floats(rng.randn(nao*nao*(2-cmpx))))
+  return kpts,info,basis
+
+def bench_kred(nao=500):
+  with tempfile.TemporaryDirectory() as tmp:
+    fname=os.path.join(tmp,"KRED.DAT")
+    kpts,info,basis=write_fake_kred(fname,nao=nao)
+    size=os.path.getsize(fname)/1e6
+    tscan,ref=timeit(kred_offsets_legacy,fname,repeat=1)
+    tfirst,eigsys=timeit(crystal2qmc.read_kred,info,basis,fname,repeat=1)
+    tagain,eigsys=timeit(crystal2qmc.read_kred,info,basis,fname)
+    assert eigsys['kpt_file_start']==ref, "KRED offsets disagree with the legacy scan."
+
+    told=tnew=0.0
+    for kpt in kpts:
+      for spin in range(2):
+        t,old=timeit(eigvec_lookup_legacy,kpt,eigsys,spin,repeat=1)
+        told+=t
+        t,new=timeit(crystal2qmc.eigvec_lookup,kpt,eigsys,spin,repeat=1)
+        tnew+=t
+        assert np.array_equal(old,new), "Eigenvectors disagree with the legacy lookup."
+  print("read_kred   %6.1f MB file: legacy scan %7.3f s, first read %7.3f s, indexed read %7.3f s"%(size,tscan,tfirst,tagain))
+  print("eigvec_lookup all k-points: legacy %7.3f s, new %7.3f s (%.1fx)"%(told,tnew,told/tnew))
+
+###################################################################################################################
+# write_orb.
+def write_orb_legacy(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1):
+  ''' write_orb before the output was formatted in bulk.'''
+  outf=open(outfn,'w')
+  if maxmo_spin < 0:
+    maxmo_spin=basis['nmo']
+
+  eigvecs=[crystal2qmc.normalize_eigvec(crystal2qmc.eigvec_lookup(kpt,eigsys,spin),basis) for spin in range(eigsys['nspin'])]
+  atidxs = np.unique(basis['atom_shell'])-1
+  nao_atom = np.zeros(atidxs.size,dtype=int)
+  for shidx in range(len(basis['nao_shell'])):
+    nao_atom[basis['atom_shell'][shidx]-1] += basis['nao_shell'][shidx]
+  coef_cnt = 1
+  totnmo = maxmo_spin*eigsys['nspin']
+  for moidx in np.arange(totnmo)+1:
+    for atidx in atidxs+1:
+      for aoidx in np.arange(nao_atom[atidx-1])+1:
+        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
+            .format(moidx,aoidx,atidx,coef_cnt))
+        coef_cnt += 1
+  eigvec_flat = [e[0:maxmo_spin].flatten() for s in range(eigsys['nspin']) for e in eigvecs[s]]
+  print_cnt = 0
+  outf.write("COEFFICIENTS\n")
+  if eigsys['ikpt_iscmpx'][kpt]:
+    for eigv in eigvec_flat:
+      for r,i in zip(eigv.real,eigv.imag):
+        outf.write("({:<.12e},{:<.12e}) "\
+            .format(r,i))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+  else:
+    for eigr in eigvec_flat:
+      for r in eigr:
+        outf.write("{:< 15.12e} ".format(r))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+  outf.close()
+
+def bench_write_orb(nao=200,maxmo_spin=80):
+  with tempfile.TemporaryDirectory() as tmp:
+    kredfn=os.path.join(tmp,"KRED.DAT")
+    kpts,info,basis=write_fake_kred(kredfn,nao=nao,nkdir=3)
+    # s-orbitals only, 10 per atom.
+    basis['shell_type']=np.zeros(nao,dtype=int)
+    basis['nao_shell']=np.ones(nao,dtype=int)
+    basis['atom_shell']=np.arange(nao)//10+1
+    basis['nmo']=nao
+    eigsys=crystal2qmc.read_kred(info,basis,kredfn)
+
+    for kpt in [kpts[0],kpts[1]]:
+      kind="complex" if eigsys['ikpt_iscmpx'][kpt] else "real"
+      oldfn=os.path.join(tmp,"old.orb")
+      newfn=os.path.join(tmp,"new.orb")
+      told,_=timeit(write_orb_legacy,eigsys,basis,None,kpt,oldfn,maxmo_spin,repeat=1)
+      tnew,_=timeit(crystal2qmc.write_orb,eigsys,basis,None,kpt,newfn,maxmo_spin)
+      with open(oldfn,'rb') as f1, open(newfn,'rb') as f2:
+        assert f1.read()==f2.read(), "write_orb output differs from the legacy writer (%s k-point)."%kind
+      size=os.path.getsize(newfn)/1e6
+      print("write_orb   %7s %6.1f MB file: legacy %6.1f MB/s, new %6.1f MB/s (%.1fx)"%(
+          kind,size,size/told,size/tnew,told/tnew))
+
+###################################################################################################################
+# k-point averaging of density matrices.
+def kaverage_tbdm_legacy(data):
+  ''' _kaverage_tbdm as nested list comprehensions.'''
+  nkpt=len(data)
+  nstates=len(data[0]['states'])
+  res={'obdm':{},'tbdm':{}}
+  for key in ['up','down']:
+    res['obdm'][key]=[[sum([data[i]['obdm'][key][k][l] for i in range(nkpt)])/nkpt
+        for l in range(nstates)] for k in range(nstates)]
+  for key in ['upup','updown','downup','downdown']:
+    res['tbdm'][key]=[[[[sum([data[i]['tbdm'][key][k][l][m][n] for i in range(nkpt)])/nkpt
+        for n in range(nstates)] for m in range(nstates)] for l in range(nstates)] for k in range(nstates)]
+  return res
+
+def kaverage_deriv_legacy(data):
+  ''' _kaverage_deriv before stacking into arrays.'''
+  res={}
+  nparm=len(data[0]['dpenergy']['vals'])
+  nkpt=len(data)
+  for prop in ['dpenergy','dpwf']:
+    res[prop]=[sum([data[i][prop]['vals'][j] for i in range(nkpt)])/nkpt for j in range(nparm)]
+    res['%s_err'%prop]=[(sum([data[i][prop]['err'][j]**2 for i in range(nkpt)])/nkpt)**0.5 for j in range(nparm)]
+  res['tbdm']=kaverage_tbdm_legacy([data[k]['tbdm'] for k in range(nkpt)])
+  res['dprdm']=[kaverage_tbdm_legacy([data[k]['dprdm'][i]['tbdm'] for k in range(nkpt)]) for i in range(nparm)]
+  return res
+
+def fake_deriv_data(nstates=8,nkpt=4,nparm=10,seed=0):
+  ''' Derivative density matrix results for each k-point, as nested lists like the gosling json.'''
+  rng=np.random.RandomState(seed)
+  def tbdm():
+    return {
+        'states':list(range(nstates)),
+        'obdm':{key:rng.rand(nstates,nstates).tolist() for key in ['up','down']},
+        'tbdm':{key:rng.rand(nstates,nstates,nstates,nstates).tolist() for key in ['upup','updown','downup','downdown']}
+      }
+  return [{
+      'dpenergy':{'vals':rng.rand(nparm).tolist(),'err':rng.rand(nparm).tolist()},
+      'dpwf':{'vals':rng.rand(nparm).tolist(),'err':rng.rand(nparm).tolist()},
+      'tbdm':tbdm(),
+      'dprdm':[{'tbdm':tbdm()} for j in range(nparm)]
+    } for k in range(nkpt)]
+
+def close(a,b):
+  ''' Compare nested results, allowing for the order of summation.'''
+  if type(a)==dict:
+    return a.keys()==b.keys() and all([close(a[k],b[k]) for k in a])
+  return np.allclose(a,b,rtol=1e-12,atol=0)
+
+def bench_kaverage(nstates=8,nkpt=4,nparm=10):
+  data=fake_deriv_data(nstates,nkpt,nparm)
+  told,old=timeit(kaverage_deriv_legacy,data,repeat=1)
+  tnew,new=timeit(average_tools._kaverage_deriv,data)
+  for key in old:
+    if key=='dprdm':
+      assert all([close(o,n) for o,n in zip(old[key],new[key])]), "_kaverage_deriv differs from the legacy version (dprdm)."
+    else:
+      assert close(old[key],new[key]), "_kaverage_deriv differs from the legacy version (%s)."%key
+  print("kaverage    %d states, %d k-points, %d parameters: legacy %.3f s, new %.3f s (%.0fx)"%(
+      nstates,nkpt,nparm,told,tnew,told/tnew))
+
+###################################################################################################################
+benchmarks={
+    'read_gred':bench_read_gred,
+    'kred':bench_kred,
+    'write_orb':bench_write_orb,
+    'kaverage':bench_kaverage,
+  }
+
+if __name__=='__main__':
+  names=sys.argv[1:] if len(sys.argv)>1 else list(benchmarks.keys())
+  for name in names:
+    benchmarks[name]()
@@ -0,0 +1,124 @@
+'''
+Checks the native QWalk log reader (qwalklog.py) against qwalklog_sample.log, a DMC log with two wave functions
+and an average_derivative_dm generator, in the format written by QWalk.
+Run with pytest, or as a script.
+'''
+import os
+import re
+import sys
+import json
+import shutil
+import subprocess as sub
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import qwalklog
+
+sample=os.path.join(os.path.dirname(os.path.abspath(__file__)),'qwalklog_sample.log')
+
+def _column(name):
+  ''' (average, variance) of each block of a property section, read with a plain regex.'''
+  text=open(sample,'r').read()
+  return np.array(re.findall(r'\b%s \{ (\S+) (\S+) \}'%name,text),dtype=float)
+
+###################################################################
+def test_blocks():
+  state=qwalklog.read_log(sample)
+  weights=np.array(re.findall(r'totweight (\d+)',open(sample,'r').read()),dtype=float)
+  assert state['weights'].size==30
+  assert np.allclose(state['weights'],weights)
+  for name in ['total_energy','kinetic','potential','nonlocal','weight']:
+    assert state['blocks'][name].shape==(30,2)
+    # The first number is the block average, the second its variance, which isn't an average.
+    for func in range(2):
+      assert np.allclose(state['blocks'][name][:,func],_column('%s%d'%(name,func))[:,0])
+
+###################################################################
+def test_averages():
+  state=qwalklog.read_log(sample)
+  shapes={
+      'average_generator/dpenergy':(30,2),
+      'average_generator/dpwf':(30,2),
+    }
+  for prefix in ['tbdm_basis/','dprdm/tbdm_basis/','dprdm/tbdm_basis.1/']:
+    shapes.update({'average_generator/%sobdm_%s'%(prefix,k):(30,4) for k in ['up','down']})
+    shapes.update({'average_generator/%stbdm_%s'%(prefix,k):(30,16) for k in ['upup','updown','downup','downdown']})
+  assert dict((k,v.shape) for k,v in state['averages'].items())==shapes
+  assert state['generators']=={'average_generator':'average_derivative_dm'}
+
+  text=open(sample,'r').read()
+  obdm=np.array([row.split() for row in re.findall(r'^\t\t\tobdm_up \{ ([^}]*)\}',text,re.M)],dtype=float)
+  summary=qwalklog.summarize(state,warmup=0)
+  expect=(state['weights'][:,None]*obdm).sum(axis=0)/state['weights'].sum()
+  assert np.allclose(summary['averages']['average_generator/tbdm_basis/obdm_up']['value'],expect)
+
+###################################################################
+def test_derivative_dm():
+  ''' average_derivative_dm comes out in the layout the k-point average takes.'''
+  import average_tools
+  state=qwalklog.read_log(sample)
+  summary=qwalklog.summarize(state,warmup=0)
+  data=summary['properties']['derivative_dm']
+  assert np.allclose(data['dpenergy']['vals'],summary['averages']['average_generator/dpenergy']['value'])
+  assert np.array(data['tbdm']['obdm']['up']).shape==(2,2)
+  assert np.array(data['tbdm']['tbdm']['updown']).shape==(2,2,2,2)
+  assert len(data['dprdm'])==2
+  assert np.allclose(np.ravel(data['dprdm'][1]['tbdm']['tbdm']['upup']),
+      summary['averages']['average_generator/dprdm/tbdm_basis.1/tbdm_upup']['value'])
+
+  kavg=average_tools.KAverage()
+  assert kavg.add(data,0.5) and kavg.add(data,1.5)
+  res=kavg.result()
+  assert np.allclose(res['dpwf'],data['dpwf']['vals'])
+  assert np.allclose(res['dprdm'][0]['obdm']['down'],data['dprdm'][0]['tbdm']['obdm']['down'])
+
+###################################################################
+def test_incremental():
+  ''' Reading the log as it grows gives the same blocks as reading it at once.'''
+  text=open(sample,'rb').read()
+  part=os.path.join(os.path.dirname(sample),'qwalklog_partial.log')
+  try:
+    # Cut inside a record: the partial record is read on the next call.
+    with open(part,'wb') as outf:
+      outf.write(text[:len(text)//2])
+    state=qwalklog.read_log(part)
+    nfirst=state['weights'].size
+    with open(part,'ab') as outf:
+      outf.write(text[len(text)//2:])
+    state=qwalklog.read_log(part,state)
+  finally:
+    os.remove(part)
+  full=qwalklog.read_log(sample)
+  assert 0<nfirst<30
+  assert np.allclose(state['weights'],full['weights'])
+  for name in full['blocks']:
+    assert np.allclose(state['blocks'][name],full['blocks'][name])
+  for name in full['averages']:
+    assert np.allclose(state['averages'][name],full['averages'][name])
+
+###################################################################
+def test_summary():
+  summary=qwalklog.summarize(qwalklog.read_log(sample))
+  energy=summary['properties']['total_energy']
+  assert summary['total blocks']==30
+  assert 0<summary['warmup blocks']<15
+  blocks=_column('total_energy0')[summary['warmup blocks']:,0]
+  assert abs(energy['value'][0]-blocks.mean())<0.01
+  assert 0<energy['error'][0]<0.05
+
+###################################################################
+def test_gosling():
+  ''' Same energies as gosling, where it is installed.'''
+  if shutil.which('gosling') is None:
+    return
+  ref=json.loads(sub.check_output(['gosling','-json',sample]).decode())
+  summary=qwalklog.summarize(qwalklog.read_log(sample),warmup=ref['warmup blocks'])
+  for func in range(2):
+    ours=summary['properties']['total_energy']
+    theirs=ref['properties']['total_energy']
+    assert abs(ours['value'][func]-theirs['value'][func])<2*theirs['error'][func]
+
+if __name__=='__main__':
+  for name,test in sorted(globals().items()):
+    if name.startswith('test_'):
+      test()
+      print(name,'ok')
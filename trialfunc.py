@@ -1,6 +1,38 @@
 # You can easily define new wave functions here. 
 # The only requirement is to define the export() method, which defines how to generate the QWalk input. 
 import os
+from contextlib import contextmanager
+
+#######################################################################
+# Results of export_qwalk() shared between trial functions during a Workflow pass (see workflow.py).
+# Maps path+name of a manager to (ready, manager). None when no pass is in progress.
+_export_cache=None
+
+@contextmanager
+def export_cache(cache=None):
+  ''' Within this context, trial functions take export results from cache instead of calling export_qwalk() again.
+  Args:
+    cache (dict): path+name -> (bool ready, manager). Filled by the caller as managers are exported.
+  '''
+  global _export_cache
+  old=_export_cache
+  _export_cache={} if cache is None else cache
+  try:
+    yield _export_cache
+  finally:
+    _export_cache=old
+
+def _export(manager):
+  ''' Export manager, using the result cached for this pass if present.
+  Returns:
+    (bool,Manager): whether the export succeeded, and the manager whose qwfiles should be used.
+  '''
+  if _export_cache is not None:
+    key=manager.path+manager.name
+    if key not in _export_cache:
+      _export_cache[key]=(manager.export_qwalk(),manager)
+    return _export_cache[key]
+  return manager.export_qwalk(),manager
 
 #######################################################################
 class TrialFunction:
@@ -41,16 +73,20 @@ class SlaterJastrow(TrialFunction):
     # This assumes you're using 2-body, should be easy to make a new object or maybe an arg for 3body.
 
     # Ensure files are correctly generated.
-    if not (self.slatman.export_qwalk() and self.jastman.export_qwalk()):
+    slatready,slatman=_export(self.slatman)
+    if not slatready:
+      return ''
+    jastready,jastman=_export(self.jastman)
+    if not jastready:
       return ''
 
-    if type(self.slatman.qwfiles['slater'])==str:
-      slater=self.slatman.qwfiles['slater']
-      sys=self.slatman.qwfiles['sys']
+    if type(slatman.qwfiles['slater'])==str:
+      slater=slatman.qwfiles['slater']
+      sys=slatman.qwfiles['sys']
     else:
-      slater=self.slatman.qwfiles['slater'][self.kpoint]
-      sys=self.slatman.qwfiles['sys'][self.kpoint]
-    jastrow=self.jastman.qwfiles['jastrow2']
+      slater=slatman.qwfiles['slater'][self.kpoint]
+      sys=slatman.qwfiles['sys'][self.kpoint]
+    jastrow=jastman.qwfiles['jastrow2']
 
     # There may be a use case for these two to be different, but I want to check the first time this happens. 
     # You can have weird bugs if you use different system files for each wave function term, I think.
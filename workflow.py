@@ -0,0 +1,114 @@
+'''
+Advance a set of managers as a dependency graph.
+
+Managers depend on each other through their trial functions: a QWalkManager with a SlaterJastrow
+trial function needs the slater and Jastrow managers to export first.
+Calling nextstep() on every manager separately makes each one walk (and reload) its whole upstream chain,
+so a DMC manager for each k-point re-advances the same DFT and optimization managers.
+A Workflow finds these links, and on each pass advances every manager once, upstream first,
+sharing the export results with all the dependents.
+'''
+
+import trialfunc
+
+#######################################################################
+def _key(mgr):
+  return mgr.path+mgr.name
+
+#######################################################################
+def _upstream(mgr):
+  ''' Managers mgr needs exported before it can run.'''
+  tfunc=getattr(mgr,'trialfunc',None)
+  if tfunc is None:
+    return []
+  return [m for m in (getattr(tfunc,'slatman',None),getattr(tfunc,'jastman',None)) if m is not None]
+
+#######################################################################
+class Workflow:
+  def __init__(self,managers):
+    ''' Dependency graph of managers.
+
+    Args:
+      managers (list): managers to advance. Managers that these depend on through their trial function
+        are added automatically if not in the list.
+    '''
+    self.nodes={}     # key -> manager.
+    self.requires={}  # key -> set of keys it depends on.
+    self.dependents={} # key -> set of keys that depend on it.
+
+    for mgr in managers:
+      self.nodes[_key(mgr)]=mgr
+    todo=list(managers)
+    while len(todo)>0:
+      mgr=todo.pop()
+      key=_key(mgr)
+      self.requires.setdefault(key,set())
+      self.dependents.setdefault(key,set())
+      for up in _upstream(mgr):
+        upkey=_key(up)
+        if upkey not in self.nodes:
+          self.nodes[upkey]=up
+          todo.append(up)
+        self.requires[key].add(upkey)
+        self.dependents.setdefault(upkey,set()).add(key)
+
+    self.levels=self._sort()
+
+  #------------------------------------------------
+  def _sort(self):
+    ''' Group the managers into levels, such that each manager only depends on those in earlier levels.
+    Returns:
+      list: list of lists of keys.
+    '''
+    nreq={key:len(req) for key,req in self.requires.items()}
+    level=sorted([key for key,n in nreq.items() if n==0])
+    levels=[]
+    while len(level)>0:
+      levels.append(level)
+      nextlevel=[]
+      for key in level:
+        for dep in self.dependents[key]:
+          nreq[dep]-=1
+          if nreq[dep]==0:
+            nextlevel.append(dep)
+      level=sorted(nextlevel)
+    if sum([len(l) for l in levels])!=len(self.nodes):
+      raise AssertionError("Workflow: the manager dependencies have a cycle.")
+    return levels
+
+  #------------------------------------------------
+  def _advance(self,key,cache):
+    mgr=self.nodes[key]
+    if len(self.dependents[key])>0:
+      # export_qwalk also calls nextstep if the results aren't available yet.
+      cache[key]=(mgr.export_qwalk(),mgr)
+    else:
+      mgr.nextstep()
+
+  #------------------------------------------------
+  def nextstep(self,workers=None):
+    ''' Advance every manager once, in dependency order.
+    Args:
+      workers (int): if set, advance the managers of each level with this many threads (see manager_tools.advance_all).
+    '''
+    with trialfunc.export_cache() as cache:
+      for level in self.levels:
+        if workers is None or len(level)==1:
+          for key in level:
+            self._advance(key,cache)
+        else:
+          from concurrent.futures import ThreadPoolExecutor
+          with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda key:self._advance(key,cache),level))
+
+  #------------------------------------------------
+  def status(self):
+    ''' Status of each manager.
+    Returns:
+      dict: path+name -> 'ok' or 'not_finished'.
+    '''
+    return {key:mgr.status() for key,mgr in self.nodes.items()}
+
+  #------------------------------------------------
+  def completed(self):
+    return all([stat=='ok' for stat in self.status().values()])